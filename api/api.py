@@ -1,6 +1,6 @@
 from collections import defaultdict
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 import urllib.parse
 
@@ -34,6 +34,12 @@ def api_health():
     return {}
 
 
+@app.route('/api/poolStats', methods=['GET', 'POST'])
+@api_status_wrapper
+def api_pool_stats():
+    return db_get_pool_stats()
+
+
 @app.route('/api/fileDownload/<file_path>', methods=['get', 'post'])
 def api_file_download(file_path):
     file_path_list = file_path.split('>')
@@ -80,18 +86,24 @@ def api_hello():
 @api_status_wrapper
 def api_get_get_right_angle_trees():
     jo = get_in_json_obj(req=request)
-    res = get_right_angle_trees(jo=jo)
-    return res
+    res = get_right_angle_trees_json_bytes(jo=jo)
+    return Response(res, mimetype='application/json')
+
+
+@app.route('/api/getNestedValues', methods=['GET', 'POST'])
+@api_status_wrapper
+def api_get_nested_values():
+    jo = get_in_json_obj(req=request)
+    res = get_nested_values_json_bytes(**jo)
+    return Response(res, mimetype='application/json')
 
 
 @app.route('/api/getSelectOptions', methods=['GET', 'POST'])
 @api_status_wrapper
 def api_get_select_options():
     jo = get_in_json_obj(req=request)
-    con = get_con('data')
-    res = get_select_options(con, **jo)
-    con.close()
-    return res
+    with connect('data') as con:
+        return get_select_options(con, **jo)
 
 
 @app.route('/api/checkUnique', methods=['GET', 'POST'])
@@ -120,10 +132,8 @@ def api_stash():
 @app.route('/api/getStashList', methods=['GET', 'POST'])
 @api_status_wrapper
 def api_get_stash_list():
-    con = get_con('data')
-    res = get_stash_list(con=con)
-    con.close()
-    return res
+    with connect('data') as con:
+        return get_stash_list(con=con)
 
 
 @app.route('/api/genBookingXlSheet', methods=['GET', 'POST'])
@@ -160,6 +170,14 @@ def api_update_tree():
     return res
 
 
+@app.route('/api/updateTreeWithStats', methods=['GET', 'POST'])
+@api_status_wrapper
+def api_update_tree_with_stats():
+    jo = get_in_json_obj(req=request)
+    res = update_tree_with_stats(jo)
+    return res
+
+
 @app.route('/api/getSubmitPreviewTables', methods=['GET', 'POST'])
 @api_status_wrapper
 def api_get_submit_preview_tables():
@@ -168,6 +186,14 @@ def api_get_submit_preview_tables():
     return res
 
 
+@app.route('/api/getSubmitPreview', methods=['GET', 'POST'])
+@api_status_wrapper
+def api_get_submit_preview():
+    jo = get_in_json_obj(req=request)
+    res = get_submit_preview(jo)
+    return res
+
+
 @app.route('/api/exportTableToExcel', methods=['GET', 'POST'])
 @api_status_wrapper
 def api_export_table_to_excel():
@@ -177,6 +203,7 @@ def api_export_table_to_excel():
 
 
 if __name__ == '__main__':
+    warmup_tree_cache(TABLES)
     app.run(host='0.0.0.0', port=8083, debug=True)
 
 
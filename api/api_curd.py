@@ -1,9 +1,11 @@
 import sys
 import os
 
+import hashlib
+import json
 import subprocess
+import uuid
 
-from sqlalchemy.orm import sessionmaker
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -14,6 +16,9 @@ if parent_dir not in sys.path:
 from mint.helper_function.hf_data import is_equal
 from mint.sys_init import *
 from mint.db.tree import DataTree, Tree
+from mint.db.cache import invalidate_tables, PREVIEW_TOKENS
+from mint.db.writer import insert_relevant_data_set, execute_change_set, count_changes
+from mint.db.diff import TableDiff, check_snapshot
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -34,38 +39,33 @@ def create_tree(jo):
 
     dfs = json_to_dfs(submit_values)
 
-    engine = get_engine('data', auto_commit=False)
-    con = engine.connect()
-    dtree = DataTree(root=root, con=con, tables=TABLES)
-    dtree.from_relevant_data_set(dfs)
-    trimmed_relevant_data_set = dtree.relevant_data_set
-
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
     error_message = None
-    with engine.begin():
+    with connect('data', auto_commit=False) as con:
+        dtree = DataTree(root=root, con=con, tables=TABLES)
+        dtree.from_relevant_data_set(dfs)
+        trimmed_relevant_data_set = dtree.relevant_data_set
+
         try:
-            for root in dtree.booking_sequence:
-                df = trimmed_relevant_data_set[root]
-                print('-' * 50)
-                print(root)
-                print('-' * 50)
-                print(df)
-                print('*' * 100)
-                df.to_sql(name=root, con=con, if_exists='append', index=False)
-            session.commit()
+            rows = insert_relevant_data_set(
+                con=con,
+                tables=TABLES,
+                booking_sequence=dtree.booking_sequence,
+                relevant_data_set=trimmed_relevant_data_set
+            )
+            con.commit()
+            print(f'[sql] inserted {rows}')
         except SQLAlchemyError as e:
             # 1048 缺失值
             # 1452 引用外键约束
-            session.rollback()
+            con.rollback()
             print('发生错误，事务已回滚 ', e)
             raise e
         finally:
-            session.close()
+            invalidate_tables([
+                root for root in dtree.booking_sequence
+                if len(trimmed_relevant_data_set.get(root, [])) > 0
+            ])
 
-    con.close()
-    engine.dispose()
     return error_message
 
 
@@ -99,154 +99,213 @@ def delete_tree(jo):
     if index_value is None:
         return
 
-    con = get_con('data')
-    dtree = DataTree(root=root, con=con, tables=TABLES)
-    dtree.from_sql(index_col=index_col, index_values={index_value})
-
-    relevant_data_set = dtree.relevant_data_set
-
-    preview_data = []
-    bs = dtree.all_childhood_names()
-    bs = [root] + list(bs)
-    for table_root in bs:
-        try:
-            df = relevant_data_set[table_root].reset_index()
-        except KeyError:
-            continue
-        col_objs = [col for col in TABLES[table_root].cols
-                if col.web_visible == 1 or
-                   col.col_name == 'id']
-        preview_data.append({
-            'label': TABLES[table_root].label,
-            'headers': [{
-                'label': col.label,
-                'key': col.col_name
-            } for col in col_objs
-            ],
-            'data': df.to_dict(orient='records')
-        })
-    if preview:
-        con.close()
-        return preview_data
-    else:
+    with connect('data') as con:
+        dtree = DataTree(root=root, con=con, tables=TABLES)
+        # 删除前的预览和删除都基于数据库当前的数据
+        dtree.from_sql(index_col=index_col, index_values={index_value}, cache=False)
+
+        relevant_data_set = dtree.relevant_data_set
+
+        preview_data = []
+        bs = dtree.all_childhood_names()
+        bs = [root] + list(bs)
+        for table_root in bs:
+            try:
+                df = relevant_data_set[table_root].reset_index()
+            except KeyError:
+                continue
+            col_objs = [col for col in TABLES[table_root].cols
+                    if col.web_visible == 1 or
+                       col.col_name == 'id']
+            preview_data.append({
+                'label': TABLES[table_root].label,
+                'headers': [{
+                    'label': col.label,
+                    'key': col.col_name
+                } for col in col_objs
+                ],
+                'data': df.to_dict(orient='records')
+            })
+        if preview:
+            return preview_data
         df = relevant_data_set[root].reset_index()
         delete(con, root, df, index_col=index_col, index_values=[index_value])
-        con.close()
+    # 子表数据由外键级联删除
+    invalidate_tables(bs)
 
 
-def update_tree(jo):
-    root = jo['root']
-    index_col = jo['indexCol']
-    index_values = jo['indexValues']
-    submit_values = json_to_dfs(jo['submitValues'])
+def get_payload_hash(jo):
+    """
+    计算提交内容的哈希，用于确认提交的内容与预览时相同
+
+    Args:
+        jo: 请求参数
+
+    Returns:
+        str: 哈希值
+    """
+    payload = {key: jo.get(key) for key in ['root', 'indexCol', 'indexValues', 'submitValues']}
+    payload_str = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload_str.encode('utf-8')).hexdigest()
 
-    engine = get_engine('data', auto_commit=False)
-    con = engine.connect()
 
-    dtree = DataTree(con=con, root=root, tables=TABLES)
-    dtree.from_sql(index_col=index_col, index_values=index_values)
+def get_tree_diffs(con, jo):
+    """
+    从数据库加载数据树（不使用查询缓存），并与提交的数据比较
+
+    Args:
+        con: 数据库连接对象
+        jo: 请求参数
+
+    Returns:
+        tuple: (数据树, {表名: TableDiff})
+    """
+    dtree = DataTree(con=con, root=jo['root'], tables=TABLES)
+    dtree.from_sql(index_col=jo['indexCol'], index_values=jo['indexValues'], cache=False)
     prev_values = {
-        table_root: df.replace(np.nan, None).reset_index().to_dict(
-            orient='records')
+        table_root: df.reset_index()
         for table_root, df in dtree.relevant_data_set.items()
     }
-
-    res = check_update_all(
+    diffs = get_table_diffs(
         prev_values=prev_values,
-        submit_values=submit_values,
+        submit_values=json_to_dfs(jo['submitValues']),
         childhood_table_names=dtree.all_childhood_names()
     )
+    return dtree, diffs
 
-    sqls = []
-    for table_name in dtree.booking_sequence:
-        if table_name in res:
-            updates = res[table_name]
-            for update in updates:
-                if update[0] == 'insert':
-                    cols = [
-                        key.replace('__new', '') for key in update[1].keys()
-                    ]
-                    sql = 'INSERT INTO `{}` ({}) VALUES ({})'.format(
-                        table_name,
-                        ', '.join(cols),
-                        ', '.join([':{}'.format(col) for col in cols]),
-                    )
-                    sql = text(sql)
-                    params = {
-                        col: update[1][col + '__new'] for col in cols
-                    }
-                elif update[0] == 'delete':
-                    sql = 'DELETE FROM `{}` WHERE id = :id'.format(table_name)
-                    sql = text(sql)
-                    params = {'id': int(update[1]['id'])}
-                elif update[0] == 'update':
-                    sql = 'UPDATE `{}` SET {} WHERE id = :id'.format(
-                        table_name,
-                        ', '.join([
-                            '{} = :{}'.format(col1, col2)
-                            for col1, col2 in zip(
-                                list(update[1].keys()),
-                                list(update[2].keys())
-                            )
-                        ]))
-                    sql = text(sql)
-                    params = {**update[2], 'id': int(update[1]['id'])}
-                else:
-                    raise ValueError('Unknown update type: {}'.format(update[0]))
-                sqls.append((sql, params))
 
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def update_tree(jo):
+    """
+    提交数据树的修改
+
+    Args:
+        jo: 请求参数，见update_tree_with_stats
+
+    Returns:
+        dict: 写入的变更集 {表名: [(操作, 旧值, 新值)]}（只包含有变化的行和列），出错时返回错误信息
+    """
+    res = update_tree_with_stats(jo)
+    if isinstance(res, str):
+        return res
+    return res['changes']
+
+
+def update_tree_with_stats(jo):
+    """
+    提交数据树的修改，并返回写入的行数和单元格数
+
+    Args:
+        jo: 请求参数，previewToken为get_submit_preview返回的令牌（可选）
+
+    Returns:
+        dict: 写入的变更集changes、行数rowsWritten、单元格数cellsWritten、
+            是否使用了预览时的变更集previewReused，出错时返回错误信息
+    """
+    # 提交的内容与预览时相同时，使用预览时的变更集（令牌只能使用一次）
+    preview = None
+    if jo.get('previewToken') is not None:
+        preview = PREVIEW_TOKENS.pop(jo['previewToken'])
+        if preview is not None and preview['payloadHash'] != get_payload_hash(jo):
+            print('[preview] submit values changed since preview')
+            preview = None
+
+    with connect('data', auto_commit=False) as con:
+        try:
+            if preview is not None and check_snapshot(con, TABLES, preview['snapshot']):
+                res = preview['changes']
+                booking_sequence = preview['bookingSequence']
+            else:
+                if preview is not None:
+                    # 预览后数据已被修改，释放锁定的行，重新加载并比较
+                    con.rollback()
+                    preview = None
+                dtree, diffs = get_tree_diffs(con, jo)
+                # 只写入有变化的行和列
+                res = {
+                    table_name: diff.to_changes(compact=True)
+                    for table_name, diff in diffs.items()
+                }
+                res = {table_name: changes for table_name, changes in res.items() if len(changes) > 0}
+                booking_sequence = dtree.booking_sequence
+            rows_written, cells_written = count_changes(res)
+
+            execute_change_set(
+                con=con,
+                tables=TABLES,
+                booking_sequence=booking_sequence,
+                changes=res
+            )
+            con.commit()
+        except SQLAlchemyError as e:
+            # 1048 缺失值
+            # 1452 引用外键约束
+            con.rollback()
+            print('发生错误，事务已回滚 ', e)
+            return str(e)
+        except Exception:
+            # 比较或写入出错（如提交的id不存在）时也立即回滚，释放check_snapshot锁定的行
+            con.rollback()
+            raise
+    invalidate_tables(res.keys())
+
+    return {
+        'changes': res,
+        'rowsWritten': rows_written,
+        'cellsWritten': cells_written,
+        'previewReused': preview is not None,
+    }
+
 
-    sql = ''
-    params = {}
-    try:
-        for sql, params in sqls:
-            print('*' * 100)
-            print(sql)
-            print(params)
-            print('*' * 100)
-            con.execute(sql, params)
-    except SQLAlchemyError as e:
-        # 1048 缺失值
-        # 1452 引用外键约束
-        print(sql)
-        print(params)
-        session.rollback()
-        print('发生错误，事务已回滚 ', e)
-        session.close()
-        con.close()
-        engine.dispose()
-        return str(e)
-
-    con.commit()
-    session.close()
-    con.close()
-    engine.dispose()
+def get_submit_preview_tables(jo):
+    with connect('data') as con:
+        dtree, diffs = get_tree_diffs(con, jo)
+    return get_preview_tables(dtree, diffs)
 
-    return res
 
+def get_submit_preview(jo):
+    """
+    生成提交预览，并保存预览时的变更集，提交时传入令牌后直接使用
 
-def get_submit_preview_tables(jo):
-    root = jo['root']
-    index_col = jo['indexCol']
-    index_values = jo['indexValues']
-    submit_values = json_to_dfs(jo['submitValues'])
-    con = get_con('data')
+    Args:
+        jo: 请求参数
 
-    dtree = DataTree(con=con, root=root, tables=TABLES)
-    dtree.from_sql(index_col=index_col, index_values=index_values)
-    prev_values = {
-        table_root: df.replace(np.nan, None).reset_index().to_dict(
-            orient='records')
-        for table_root, df in dtree.relevant_data_set.items()
+    Returns:
+        dict: 预览表格tables（同get_submit_preview_tables）和令牌previewToken
+    """
+    with connect('data') as con:
+        dtree, diffs = get_tree_diffs(con, jo)
+
+    # 保存紧凑变更集和涉及行的原数据，提交时校验后直接使用
+    changes = {
+        table_name: diff.to_changes(compact=True)
+        for table_name, diff in diffs.items()
+    }
+    token = uuid.uuid4().hex
+    PREVIEW_TOKENS.put(token, {
+        'payloadHash': get_payload_hash(jo),
+        'bookingSequence': dtree.booking_sequence,
+        'changes': {table_name: c for table_name, c in changes.items() if len(c) > 0},
+        'snapshot': {table_name: diff.get_snapshot() for table_name, diff in diffs.items()},
+    }, tables=diffs.keys())
+    return {
+        'tables': get_preview_tables(dtree, diffs),
+        'previewToken': token,
     }
 
-    res = check_update_all(
-        prev_values=prev_values,
-        submit_values=submit_values,
-        childhood_table_names=dtree.all_childhood_names()
-    )
+
+def get_preview_tables(dtree, diffs):
+    """
+    生成预览表格
+
+    Args:
+        dtree: 数据树
+        diffs: {表名: TableDiff}
+
+    Returns:
+        list: 每张有变化的表的标签、表头和（原值, 新值）行
+    """
+    res = {table_name: diff.to_changes() for table_name, diff in diffs.items()}
+    res = {table_name: changes for table_name, changes in res.items() if len(changes) > 0}
     preview_tables = []
     for table_name in dtree.booking_sequence:
         if table_name in res:
@@ -299,14 +358,13 @@ def check_update(jo):
     dir_table_name = jo['dirTableName']
     value = jo['value']
     row_id = jo['rowId']
-    con = get_con('data')
     sql = 'SELECT `{}` FROM `{}` WHERE id = :row_id'.format(
         col_name,
         dir_table_name,
     )
-    result = con.execute(text(sql), {'value': value, 'row_id': row_id})
-    con.close()
-    value_in_db = result.fetchone()
+    with connect('data') as con:
+        result = con.execute(text(sql), {'value': value, 'row_id': row_id})
+        value_in_db = result.fetchone()
     res = None
     if value_in_db is not None and not is_equal(value_in_db[0], value):
         if value_in_db[0] is None:
@@ -319,73 +377,58 @@ def check_update(jo):
     return res
 
 
-def check_update_all(prev_values, submit_values, childhood_table_names):
+def get_table_diffs(prev_values, submit_values, childhood_table_names):
+    """
+    比较原数据和提交的数据
+
+    Args:
+        prev_values: 原数据 {表名: 数据（DataFrame或记录列表，包含id列）}
+        submit_values: 提交的数据 {表名: 数据}
+        childhood_table_names: 可以删除行的表（子孙表）
 
-    table_names = list(submit_values.keys())
+    Returns:
+        dict: {表名: TableDiff}
+    """
     res = {}
-    for table_name in table_names:
-        table_res = []
-        try:
-            pdf = pd.DataFrame(prev_values[table_name])
-        except KeyError:
-            pdf = pd.DataFrame(columns=[
-                col.col_name for col in TABLES[table_name].cols
-            ])
-        try:
-            vdf = pd.DataFrame(submit_values[table_name])
-        except KeyError:
-            vdf = pd.DataFrame(
-                columns=[
-                    col.col_name for col in TABLES[table_name].cols
-                ]
-            )
+    for table_name, submit in submit_values.items():
+        table_cols = [col.col_name for col in TABLES[table_name].cols]
+        pdf = pd.DataFrame(prev_values.get(table_name, []))
         if len(pdf) == 0:
-            pdf = pd.DataFrame(columns=[
-                col.col_name for col in TABLES[table_name].cols
-            ])
-        if not 'id' in vdf.columns.tolist():
-            vdf['id'] = np.nan
-
-        cols = vdf.columns.tolist()
-        cols_new = [col + '__new' for col in cols]
-
-        vdf['id__new'] = vdf['id']
-
-        compare = pd.merge(
-            left=pdf.replace({None: np.nan}),
-            right=vdf.replace({None: np.nan}),
-            how='outer',
-            on='id',
-            suffixes=('', '__new')
-        ).replace(np.nan, None)
-
-        for r, row in compare.iterrows():
-            if row['id'] is None and row['id__new'] is None:
-                table_res.append(
-                    ('insert', row[cols_new].to_dict())
-                )
-
-            elif (row['id'] is not None
-                  and all([
-                        row[col] is None for col in row.keys() if
-                        col.endswith('__new')
-                    ])
-                and table_name in childhood_table_names
-            ):
-                table_res.append(
-                    ('delete', row[cols].to_dict())
-                )
-            elif (row['id'] is not None and row['id__new'] is not None and
-                  row['id'] == row['id__new']):
-                table_res.append(
-                    ('update', row[cols].to_dict(), row[cols_new].to_dict())
-                )
-            else:
-                print(table_name)
-                print(row)
-                print(compare)
-                raise ValueError('Unknown case')
+            pdf = pd.DataFrame(columns=table_cols)
+        vdf = pd.DataFrame(submit)
+        if len(vdf.columns) == 0:
+            vdf = pd.DataFrame(columns=table_cols)
+
+        res[table_name] = TableDiff(
+            prev=pdf,
+            submit=vdf,
+            allow_delete=table_name in childhood_table_names,
+            table_name=table_name
+        )
+    return res
+
+
+def check_update_all(prev_values, submit_values, childhood_table_names, compact=False):
+    """
+    比较原数据和提交的数据，生成各表的变更集
+
+    Args:
+        prev_values: 原数据 {表名: 数据（DataFrame或记录列表，包含id列）}
+        submit_values: 提交的数据 {表名: 数据}
+        childhood_table_names: 可以删除行的表（子孙表）
+        compact: 是否只生成有变化的行和单元格，见TableDiff.to_changes
 
+    Returns:
+        dict: {表名: [(操作, 旧值, 新值)]}
+    """
+    diffs = get_table_diffs(
+        prev_values=prev_values,
+        submit_values=submit_values,
+        childhood_table_names=childhood_table_names
+    )
+    res = {}
+    for table_name, diff in diffs.items():
+        table_res = diff.to_changes(compact=compact)
         if len(table_res) > 0:
             res[table_name] = table_res
     return res
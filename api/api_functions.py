@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import os.path
 from typing import Literal
 import sys
@@ -19,6 +20,10 @@ from mint.db.utils import get_tables
 from mint.helper_function.hf_string import udf_format, to_json_obj, to_json_str
 from mint.helper_function.hf_file import mkdir
 from mint.db.tree import *
+from mint.db.tree_index import get_schema_index, join_json_array
+from mint.db.json_bytes import dumps, RawJson, frame_to_json_records
+from mint.db.dtypes import get_date_columns
+from mint.db.cache import REFERENCE_CACHE
 from mint.api.api_booking_xl_sheet import render_booking_xl_sheet
 from mint.helper_function.hf_crypto import gen_uuid
 
@@ -88,17 +93,16 @@ def migrate_data_from_xl_folder(
 
     table_names.sort(key=lambda x: booking_sequence.index(x))
 
-    con = get_con()
-    for table_name in table_names:
-        file_name = os.path.join(folder, table_name + '.xlsx')
-        print(f'migrating {file_name}')
-        migration_pandas(
-            con=con,
-            data_path=file_name,
-            schema=schema,
-            if_exists=if_exists
-        )
-    con.close()
+    with connect() as con:
+        for table_name in table_names:
+            file_name = os.path.join(folder, table_name + '.xlsx')
+            print(f'migrating {file_name}')
+            migration_pandas(
+                con=con,
+                data_path=file_name,
+                schema=schema,
+                if_exists=if_exists
+            )
 
 
 def get_cell_options(con, root, right_angle_trees, res=None, root_tree=None):
@@ -121,10 +125,11 @@ def get_cell_options(con, root, right_angle_trees, res=None, root_tree=None):
                         for root_child in root_tree.children
                     ]:
                         continue
-                    options = pd.read_sql(
-                        sql=f'select `{ref_col}` from `{ref_table}`',
-                        con=con
-                    )[ref_col].tolist()
+                    ref_data = REFERENCE_CACHE.get(con, TABLES, ref_table)
+                    if ref_col == ref_data.index.name:
+                        options = ref_data.index.tolist()
+                    else:
+                        options = ref_data[ref_col].tolist()
                     res[col.foreign_key] = options
 
         res = get_cell_options(con, root, t.children, res,
@@ -133,8 +138,16 @@ def get_cell_options(con, root, right_angle_trees, res=None, root_tree=None):
     return res
 
 
-def get_right_angle_trees(jo):
-    con = get_con('data')
+def get_right_angle_trees_json_bytes(jo):
+    """
+    获取直角树、数据、单元格选项和表对象，直接编码为JSON
+
+    Args:
+        jo: 请求参数
+
+    Returns:
+        bytes: JSON {'tree', 'values', 'options', 'tables'}
+    """
     root = jo['root']
     file_name_str = jo['fileNameStr']
     index_col = jo['indexCol']
@@ -142,92 +155,100 @@ def get_right_angle_trees(jo):
     stash_uuid = jo['stashUuid']
     print(jo)
     tables = get_tables('data')
-    tree = Tree(con=con, tables=tables, root=root)
-    if file_name_str is not None and file_name_str != '':
-        file_names = file_name_str.split(';')
-        file_path = os.path.join(PATH_UPLOAD, file_names[0])
-        dfs = pd.read_excel(file_path, sheet_name=None)
-        dtree = DataTree(tree=tree)
-        dtree.from_excel_booking_sheet(dfs=dfs)
-        values = {
-            k: df.reset_index().replace(np.nan, None).to_dict(orient='records')
-            for k, df in dtree.relevant_data_set.items()
-        }
-    else:
-        dtree = DataTree(tree=tree)
-        if index_values is not None and len(index_values) > 0:
-            dtree.from_sql(
-                index_col=index_col,
-                index_values=set(index_values),
-            )
-            dfs = {
-                k: df[[
-                    col.col_name for col in TABLES[k].cols if
-                    col.web_visible == 1
-                ]] for k, df in dtree.relevant_data_set.items()
-            }
-
+    with connect('data') as con:
+        tree = Tree(con=con, tables=tables, root=root)
+        if file_name_str is not None and file_name_str != '':
+            file_names = file_name_str.split(';')
+            file_path = os.path.join(PATH_UPLOAD, file_names[0])
+            dfs = pd.read_excel(file_path, sheet_name=None)
+            dtree = DataTree(tree=tree)
+            dtree.from_excel_booking_sheet(dfs=dfs)
             values = {
-                k: df.reset_index().replace(np.nan, None).to_dict(orient='records')
-                for k, df in dfs.items()
-                if k in [root] + [
-                    child.root for child in
-                    dtree.children
-                ] + [
-                    table_name for table_name in dtree.all_parenthood_names()
-                    if TABLES[table_name].fetchable_parent == 1
-                ]
+                k: df.reset_index()
+                for k, df in dtree.relevant_data_set.items()
             }
         else:
-            if stash_uuid is not None and stash_uuid != '':
-                relevant_data_set_res = con.execute(
-                    text(
-                        'select `root`, `values` from stash where stash_uuid = '
-                        ':stash_uuid'
-                    ),
-                    {'stash_uuid': stash_uuid}
+            dtree = DataTree(tree=tree)
+            if index_values is not None and len(index_values) > 0:
+                dtree.from_sql(
+                    index_col=index_col,
+                    index_values=set(index_values),
+                    columns='web_visible'
                 )
-                if relevant_data_set_res.rowcount > 0:
-                    values_str = relevant_data_set_res.fetchone()[1]
-                    print(stash_uuid, values_str)
-                    ds = to_json_obj(values_str)
-                    values = {
-                        k: pd.DataFrame(d).reset_index().replace(np.nan, None)[[
-                            col.col_name for col in TABLES[k].cols if
-                            col.web_visible == 1
-                        ]].to_dict(
-                            orient='records')
-                        for k, d in ds.items() if len(d) > 0
-                    }
-                else:
-                    values = {root: [{col.col_name: col.default for col in
-                                      dtree.table.cols}]}
+                dfs = {
+                    k: df[[
+                        col.col_name for col in TABLES[k].cols if
+                        col.web_visible == 1
+                    ]] for k, df in dtree.relevant_data_set.items()
+                }
+
+                values = {
+                    k: df.reset_index()
+                    for k, df in dfs.items()
+                    if k in [root] + [
+                        child.root for child in
+                        dtree.children
+                    ] + [
+                        table_name for table_name in dtree.all_parenthood_names()
+                        if TABLES[table_name].fetchable_parent == 1
+                    ]
+                }
             else:
-                values = {root: [
-                    {col.col_name: col.default for col in dtree.table.cols}]}
-    right_angle_trees = get_right_angle_trees_from_tree(tree=dtree)
-    right_angle_trees_json = [t.json_obj for t in right_angle_trees]
-
-    cell_options = get_cell_options(
-        con=con,
-        root=root,
-        right_angle_trees=right_angle_trees,
-    )
-
-    con.close()
+                if stash_uuid is not None and stash_uuid != '':
+                    relevant_data_set_res = con.execute(
+                        text(
+                            'select `root`, `values` from stash where stash_uuid = '
+                            ':stash_uuid'
+                        ),
+                        {'stash_uuid': stash_uuid}
+                    )
+                    if relevant_data_set_res.rowcount > 0:
+                        values_str = relevant_data_set_res.fetchone()[1]
+                        print(stash_uuid, values_str)
+                        ds = to_json_obj(values_str)
+                        values = {
+                            k: pd.DataFrame(d).reset_index().replace(np.nan, None)[[
+                                col.col_name for col in TABLES[k].cols if
+                                col.web_visible == 1
+                            ]].to_dict(
+                                orient='records')
+                            for k, d in ds.items() if len(d) > 0
+                        }
+                    else:
+                        values = {root: [{col.col_name: col.default for col in
+                                          dtree.table.cols}]}
+                else:
+                    values = {root: [
+                        {col.col_name: col.default for col in dtree.table.cols}]}
+        right_angle_trees = get_right_angle_trees_from_tree(tree=dtree)
+        # 第一个是数据树（包含数据），其余是按元数据版本缓存JSON的结构节点
+        right_angle_trees_json = join_json_array([
+            t.to_json_bytes() if isinstance(t, DataTree) else t.json_bytes
+            for t in right_angle_trees
+        ])
+
+        cell_options = get_cell_options(
+            con=con,
+            root=root,
+            right_angle_trees=right_angle_trees,
+        )
 
     res = {
-        'tree': right_angle_trees_json,
-        'values': values,
+        'tree': RawJson(right_angle_trees_json),
+        'values': {
+            k: RawJson(frame_to_json_records(v, date_columns=get_date_columns(TABLES[k])))
+            if isinstance(v, pd.DataFrame) else v
+            for k, v in values.items()
+        },
         'options': cell_options,
-        'tables': {key: table.to_json_obj() for key, table in TABLES.items()}
+        'tables': RawJson(get_schema_index(TABLES).tables_json(TABLES))
     }
 
-    return res
+    return dumps(res)
 
 
 # @profile_line_by_line
-def get_nested_values(
+def get_nested_values_json_bytes(
         root,
         limit=None,
         offset=None,
@@ -236,30 +257,26 @@ def get_nested_values(
         full_detail=False,
         **kwargs
 ):
-    con = get_con('data')
     tables = get_tables('data')
-    dtree = DataTree(root=root, con=con, tables=tables)
-    dtree.from_sql(limit=limit, offset=offset, index_col=index_col,
-                   index_values=index_values)
+    with connect('data') as con:
+        dtree = DataTree(root=root, con=con, tables=tables)
+        dtree.from_sql(limit=limit, offset=offset, index_col=index_col,
+                       index_values=index_values)
 
-    dtree.fill_na_with_none()
     json_obj = dtree.nested_values(full_detail=full_detail)
     json_obj['dataSource'][0].sort(key=lambda x: x['id'], reverse=True)
-    con.close()
 
-    json_str = to_json_str(json_obj=json_obj)
-    json_obj = to_json_obj(json_str=json_str)
-    return json_obj
+    return dumps(json_obj)
 
 
 def get_booking_structure(in_json_obj):
     branch = in_json_obj['branch']
-    con = get_con()
     tables = get_tables('data')
-    t_branch = Tree(con=con, tables=tables)
-    dtree = DataTree(con=con, tables=tables, root=branch)
+    with connect() as con:
+        t_branch = Tree(con=con, tables=tables)
+        dtree = DataTree(con=con, tables=tables, root=branch)
 
-    select_values = dtree.get_parents_select_values()
+        select_values = dtree.get_parents_select_values()
 
     json_obj = {'field_structure': t_branch.json_obj,
                 'select_values': select_values}
@@ -332,9 +349,11 @@ def mark_child_name(d_dfs, tree):
         name_ref_col = [col for col in name_ref_col if
                         col.foreign_key.split('.')[0] == naming_from][0]
         root_data_tree = DataTree(tree=tree)
+        # 新行的名称按现有行数生成，不能使用缓存的旧数据
         root_data_tree.from_sql(
             index_col=name_ref_col.col_name,
-            index_values={root_df[name_ref_col.col_name].values[0]}
+            index_values={root_df[name_ref_col.col_name].values[0]},
+            cache=False
         )
         root_df['name'] = root_df.apply(
             lambda x: '-'.join([x[name_ref_col.col_name], tree.root,
@@ -431,48 +450,47 @@ def tree_dict_to_json(tree_dict):
 
 
 def gen_booking_xl_sheet_file(jo):
-    con = get_con('data')
     root = jo['root']
     row_id = jo['rowId']
     index_col = jo['indexCol']
     index_value = jo['indexValue']
     values = jo['values']
     timestamp = dt.now().strftime("%Y%m%d_%H%M%S_%f")
-    if values is not None:
-        relevant_data_set = {
-            root: pd.DataFrame(vs)
-            for root, vs in values.items()
-        }
-        dtree = DataTree(root=root, con=con, tables=TABLES)
-        dtree.from_relevant_data_set(relevant_data_set)
-        p_name = values[root][0]['name']
-    else:
-        dtree = DataTree(root=root, con=con, tables=TABLES)
-        if row_id != "" and row_id is not None:
-            dtree.from_sql(index_col='id', index_values={row_id})
-            p_name = dtree.relevant_data_set[root]["name"].values[0]
+    with connect('data') as con:
+        if values is not None:
+            relevant_data_set = {
+                root: pd.DataFrame(vs)
+                for root, vs in values.items()
+            }
+            dtree = DataTree(root=root, con=con, tables=TABLES)
+            dtree.from_relevant_data_set(relevant_data_set)
+            p_name = values[root][0]['name']
         else:
-            if index_col is not None:
-                dtree.from_sql(index_col=index_col, index_values={index_value})
-                p_name = dtree.relevant_data_set[root][index_col].values[0]
+            dtree = DataTree(root=root, con=con, tables=TABLES)
+            if row_id != "" and row_id is not None:
+                dtree.from_sql(index_col='id', index_values={row_id})
+                p_name = dtree.relevant_data_set[root]["name"].values[0]
             else:
-                p_name = '录入模板'
-
-    template_path = os.path.join(PATH_ROOT, 'api', 'booking_xl_template.xlsm')
-    output_folder = os.path.join(PATH_OUTPUT, 'booking_xl_sheet')
-    mkdir(output_folder)
-    output_filename = f'booking_excel-{p_name}-{timestamp}.xlsm'
-    output_path = os.path.join(
-        output_folder,
-        output_filename
-    )
+                if index_col is not None:
+                    dtree.from_sql(index_col=index_col, index_values={index_value})
+                    p_name = dtree.relevant_data_set[root][index_col].values[0]
+                else:
+                    p_name = '录入模板'
+
+        template_path = os.path.join(PATH_ROOT, 'api', 'booking_xl_template.xlsm')
+        output_folder = os.path.join(PATH_OUTPUT, 'booking_xl_sheet')
+        mkdir(output_folder)
+        output_filename = f'booking_excel-{p_name}-{timestamp}.xlsm'
+        output_path = os.path.join(
+            output_folder,
+            output_filename
+        )
 
-    render_booking_xl_sheet(
-        output_path=output_path,
-        data_tree=dtree,
-        template_path=template_path
-    )
-    con.close()
+        render_booking_xl_sheet(
+            output_path=output_path,
+            data_tree=dtree,
+            template_path=template_path
+        )
     return {
         'filePath': output_path,
         'fileName': output_filename,
@@ -480,14 +498,13 @@ def gen_booking_xl_sheet_file(jo):
 
 
 def migrate_from_xlsx(folder, schema_tags=None):
-    con = get_con()
-
     if schema_tags is None:
         schema_tags = get_schema_tags()
 
-    cst_pki = get_cst_pki(con=con,
-                          schemas=[get_schema(schema_tag) for schema_tag in
-                                   schema_tags])
+    with connect() as con:
+        cst_pki = get_cst_pki(con=con,
+                              schemas=[get_schema(schema_tag) for schema_tag in
+                                       schema_tags])
     booking_sequence = get_booking_sequence(cst_pki=cst_pki)
 
     for schema_tag in schema_tags:
@@ -498,7 +515,6 @@ def migrate_from_xlsx(folder, schema_tags=None):
             schema=schema,
             booking_sequence=booking_sequence
         )
-    con.close()
 
 
 def stash(jo):
@@ -514,25 +530,16 @@ def stash(jo):
             'value': stash_uuid
         }
     )
-    con = get_con('data')
     if not is_exist:
         if stash_uuid is None:
             stash_uuid = gen_uuid()
         sql = ('INSERT INTO stash (`stash_uuid`, `root`, `values`, `comment`) '
                'VALUES (:stash_uuid, :root, :values, :comment)')
-        con.execute(
-            text(sql),
-            {
-                'root': root,
-                'stash_uuid': stash_uuid,
-                'values': to_json_str(submit_values, indent=0),
-                'comment': stash_comment,
-            }
-        )
     else:
         sql = ('UPDATE stash SET '
                '`root` = :root, `values` = :values, `comment` = :comment '
                'WHERE `stash_uuid` = :stash_uuid')
+    with connect('data') as con:
         con.execute(
             text(sql),
             {
@@ -585,20 +592,19 @@ def check_unique(jo):
     value = jo['value']
     row_id = jo.get('rowId', None)
 
-    con = get_con('data')
     if row_id is None:
         sql = 'SELECT * FROM {} WHERE {} = :value'.format(dir_table_name,
                                                           col_name)
-        result = con.execute(text(sql), {'value': value})
-
+        params = {'value': value}
     else:
         sql = 'SELECT * FROM {} WHERE {} = :value and id <> :row_id'.format(
             dir_table_name,
             col_name,
         )
-        result = con.execute(text(sql), {'value': value, 'row_id': row_id})
-    con.close()
-    return result.rowcount == 0
+        params = {'value': value, 'row_id': row_id}
+    with connect('data') as con:
+        result = con.execute(text(sql), params)
+        return result.rowcount == 0
 
 
 def export_table_to_excel(jo):
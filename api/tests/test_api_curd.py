@@ -1,4 +1,9 @@
+import time
+from decimal import Decimal
+
 from mint.api.api_curd import *
+from mint.db.writer import get_change_batches, count_changes
+from mint.db.diff import values_equal
 
 
 def test_create_tree():
@@ -33,5 +38,290 @@ def test_create_tree():
     create_tree(jo=jo)
 
 
+def test_create_tree_benchmark():
+    """to_sql逐表写入与批量写入的对比（在回滚的事务中执行，不保留数据）"""
+    booking_sequence = DataTree(root='project', con=get_con('data'), tables=TABLES).booking_sequence
+    for n in [10, 1000, 100000]:
+        dfs = {
+            'project': pd.DataFrame([{
+                'name': f'benchmark-{n}',
+                'st_date': dt(2025, 1, 1),
+                'notional': 0,
+                'type_ledger_detail': '其他',
+                'type_predict': '其他',
+                'type_scene': '不适用',
+                'project_credit_name': '未指定',
+                'off_balance_sheet_type': '不适用',
+                'annual_days': 365,
+                'is_fed_project': 0,
+                'project_structured_info': '不适用'
+            }]),
+            'project_level': pd.DataFrame({
+                'name': [f'benchmark-{n}-level{i}' for i in range(n)],
+                'project_name': f'benchmark-{n}',
+            }),
+        }
+        res = {}
+        for method in ['to_sql', 'bulk']:
+            con = get_engine('data', auto_commit=False).connect()
+            start = time.time()
+            try:
+                if method == 'to_sql':
+                    for root in booking_sequence:
+                        if root in dfs:
+                            dfs[root].to_sql(name=root, con=con, if_exists='append', index=False)
+                else:
+                    insert_relevant_data_set(
+                        con=con,
+                        tables=TABLES,
+                        booking_sequence=booking_sequence,
+                        relevant_data_set=dfs
+                    )
+                res[method] = time.time() - start
+            finally:
+                con.rollback()
+                con.close()
+        print(f'{n} rows, to_sql: {res["to_sql"]:.3f}s, bulk: {res["bulk"]:.3f}s')
+
+
+def test_get_change_batches():
+    changes = {'project_level': []}
+    for i in range(1, 5001):
+        if i % 3 == 0:
+            changes['project_level'].append(('delete', {'id': i, 'name': f'level{i}'}))
+        else:
+            changes['project_level'].append((
+                'update',
+                {'id': i, 'name': f'level{i}', 'update_time': None},
+                {'id__new': i, 'name__new': f'level{i}-new', 'update_time__new': None}
+            ))
+    changes['project_level'].append(('insert', {'id__new': None, 'name__new': 'level-new'}))
+    batches = get_change_batches(
+        tables=TABLES,
+        booking_sequence=['project', 'project_level'],
+        changes=changes,
+        batch_size=1000
+    )
+    # 删除2块，修改4批，新增1批
+    assert len(batches) == 7
+    assert sum(len(params['ids']) for sql, params in batches[:2]) == 1666
+    # 每批修改一条 UPDATE ... CASE id WHEN ... 语句
+    assert sum(len(params['ids']) for sql, params in batches[2:6]) == 3334
+    assert str(batches[2][0]).count('UPDATE') == 1
+    assert '`update_time` = CASE' not in str(batches[2][0])
+
+
+def merge_check_update_all(prev_values, submit_values, childhood_table_names):
+    """原来按outer merge和iterrows逐行比较的方式，用于对比"""
+    res = {}
+    for table_name, vdf in submit_values.items():
+        table_res = []
+        pdf = pd.DataFrame(prev_values[table_name])
+        vdf = vdf.copy()
+        cols = vdf.columns.tolist()
+        cols_new = [col + '__new' for col in cols]
+        vdf['id__new'] = vdf['id']
+        compare = pd.merge(
+            left=pdf.replace({None: np.nan}),
+            right=vdf.replace({None: np.nan}),
+            how='outer',
+            on='id',
+            suffixes=('', '__new')
+        )
+        compare = compare.astype(object).where(compare.notna(), None)
+        for r, row in compare.iterrows():
+            if row['id'] is None and row['id__new'] is None:
+                table_res.append(('insert', row[cols_new].to_dict()))
+            elif (row['id'] is not None
+                  and all([row[col] is None for col in row.keys() if col.endswith('__new')])
+                  and table_name in childhood_table_names):
+                table_res.append(('delete', row[cols].to_dict()))
+            elif row['id'] is not None and row['id__new'] is not None and row['id'] == row['id__new']:
+                table_res.append(('update', row[cols].to_dict(), row[cols_new].to_dict()))
+            else:
+                raise ValueError('Unknown case')
+        if len(table_res) > 0:
+            res[table_name] = table_res
+    return res
+
+
+def test_check_update_all_benchmark():
+    con = get_con('data')
+    dtree = DataTree(con=con, root='project', tables=TABLES)
+    dtree.from_sql()
+    con.close()
+    prev_values = {
+        table_root: df.reset_index()
+        for table_root, df in dtree.relevant_data_set.items()
+    }
+    # 删除每10行中的1行，新增1行
+    submit_values = {
+        table_root: pd.concat([
+            df[df.index % 10 != 0],
+            pd.DataFrame([{'id': None}], columns=df.columns)
+        ], ignore_index=True)
+        for table_root, df in prev_values.items()
+        if table_root != dtree.root
+    }
+    print({table_root: len(df) for table_root, df in submit_values.items()})
+    childhood_table_names = dtree.all_childhood_names()
+
+    start = time.time()
+    expected = merge_check_update_all(prev_values, submit_values, childhood_table_names)
+    merge_time = time.time() - start
+
+    start = time.time()
+    res = check_update_all(prev_values, submit_values, childhood_table_names)
+    diff_time = time.time() - start
+
+    assert res.keys() == expected.keys()
+    for table_name, changes in expected.items():
+        for operation in ['insert', 'update', 'delete']:
+            assert (
+                sorted(str(change[1].get('id')) for change in res[table_name] if change[0] == operation) ==
+                sorted(str(change[1].get('id')) for change in changes if change[0] == operation)
+            )
+    print(f'merge: {merge_time:.3f}s, vectorized: {diff_time:.3f}s')
+
+
+def test_check_update_all_compact():
+    prev = pd.DataFrame({
+        'id': [1, 2, 3],
+        'name': ['level1', 'level2', 'level3'],
+        'project_name': ['project1', 'project1', None],
+        'update_time': [dt(2025, 1, 1)] * 3,
+    })
+    submit = prev.assign(update_time='2025-01-02')
+    submit.loc[1, 'name'] = 'level2-new'
+    submit.loc[2, 'project_name'] = np.nan
+    res = check_update_all(
+        prev_values={'project_level': prev},
+        submit_values={'project_level': submit},
+        childhood_table_names=['project_level'],
+        compact=True
+    )
+    # 只有第2行有变化；None与NaN相等，update_time不参与比较
+    assert res == {'project_level': [
+        ('update', {'id': 2, 'name': 'level2'}, {'id__new': 2, 'name__new': 'level2-new'})
+    ]}
+    assert count_changes(res) == (1, 1)
+    sql, params = get_change_batches(TABLES, ['project_level'], res)[0]
+    assert '`id` =' not in str(sql).split('WHERE')[0]
+
+
+def test_count_changes():
+    # 单元格数与实际写入的一致：不含id、由数据库维护的列和新增时的空值
+    changes = {'project_level': [
+        ('insert', {'id__new': None, 'name__new': 'level4', 'project_name__new': None, 'create_time__new': None}),
+        ('update', {'id': 1, 'name': 'level1', 'create_time': None}, {'id__new': 1, 'name__new': 'level1-new', 'create_time__new': None}),
+        ('delete', {'id': 2, 'name': 'level2'}),
+    ]}
+    assert count_changes(changes) == (3, 2)
+
+
+def test_update_tree_preview_token():
+    con = get_con('data')
+    dtree = DataTree(con=con, root='project', tables=TABLES)
+    dtree.from_sql(index_col='name', index_values=['上海授信-20210628'], cache=False)
+    con.close()
+    jo = {
+        'root': 'project',
+        'indexCol': 'name',
+        'indexValues': ['上海授信-20210628'],
+        'submitValues': {
+            table_root: df.reset_index().to_dict(orient='records')
+            for table_root, df in dtree.relevant_data_set.items()
+        },
+    }
+    preview = get_submit_preview(jo)
+    # 提交的数据与数据库相同，使用预览令牌后不写入任何行
+    res = update_tree_with_stats({**jo, 'previewToken': preview['previewToken']})
+    assert res['previewReused']
+    assert res['rowsWritten'] == 0
+    # 令牌只能使用一次
+    res = update_tree_with_stats({**jo, 'previewToken': preview['previewToken']})
+    assert not res['previewReused']
+    assert res['rowsWritten'] == 0
+    # 预览后写入涉及的表，令牌失效
+    preview = get_submit_preview(jo)
+    invalidate_tables(['project'])
+    res = update_tree_with_stats({**jo, 'previewToken': preview['previewToken']})
+    assert not res['previewReused']
+    # 原接口的返回格式不变
+    assert get_submit_preview_tables(jo) == preview['tables']
+    assert update_tree(jo) == {}
+
+
+def test_update_tree_insert_refresh():
+    con = get_con('data')
+    dtree = DataTree(con=con, root='project', tables=TABLES)
+    dtree.from_sql(index_col='name', index_values=['上海授信-20210628'], cache=False)
+    jo = {
+        'root': 'project',
+        'indexCol': 'name',
+        'indexValues': ['上海授信-20210628'],
+        'submitValues': {
+            table_root: df.reset_index().to_dict(orient='records')
+            for table_root, df in dtree.relevant_data_set.items()
+        },
+    }
+    level_name = f'上海授信-20210628-level-{time.time_ns()}'
+    row = {col.col_name: None for col in TABLES['project_level'].cols}
+    row.update({'name': level_name, 'project_name': '上海授信-20210628'})
+    submit_values = dict(jo['submitValues'])
+    submit_values['project_level'] = submit_values.get('project_level', []) + [row]
+    try:
+        res = update_tree_with_stats({**jo, 'submitValues': submit_values})
+        assert res['rowsWritten'] == 1
+        # 新增的行的update_time由数据库填充，增量刷新可以读到
+        dtree.refresh()
+        assert level_name in dtree.relevant_data_set['project_level']['name'].tolist()
+    finally:
+        update_tree(jo)
+        con.close()
+
+
+def test_update_tree_unknown_id():
+    jo = {
+        'root': 'project',
+        'indexCol': 'name',
+        'indexValues': ['上海授信-20210628'],
+        'submitValues': {
+            'project_level': [{'id': -1, 'name': 'unknown', 'project_name': '上海授信-20210628'}],
+        },
+    }
+    try:
+        update_tree(jo)
+    except ValueError:
+        pass
+    else:
+        assert False
+    # 出错后事务已回滚，连接已归还连接池
+    assert get_engine('data', auto_commit=False).pool.checkedout() == 0
+
+
+def test_values_equal_mixed_numeric():
+    # 数值与字符串混合的列中，数值字符串按数值比较
+    res = values_equal(
+        ['1.50', Decimal('2'), 3.0, 'abc', None, Decimal('1.5')],
+        [Decimal('1.5'), '2.0', '3', 'abc', np.nan, 'x']
+    )
+    assert res.tolist() == [True, True, True, True, True, False]
+    # 都是字符串时仍按字符串比较
+    assert values_equal(['1.50'], ['1.5']).tolist() == [False]
+    # 整数与整数字符串精确比较，不经过浮点数
+    res = values_equal(
+        [2 ** 60, 2 ** 60, Decimal(2 ** 60), 'abc'],
+        [str(2 ** 60 + 1), str(2 ** 60), str(2 ** 60 + 1), 'abc']
+    )
+    assert res.tolist() == [False, True, False, True]
+    # 混合列中的日期逐个按日期比较
+    res = values_equal(
+        [dt(2025, 1, 1).date(), 'abc', 1, dt(2025, 1, 1, 12), dt(2025, 1, 2).date()],
+        ['2025-01-01', 'abc', '1', '2025-01-01 12:00:00', '2025-01-01']
+    )
+    assert res.tolist() == [True, True, True, True, False]
+
+
 if __name__ == '__main__':
     test_create_tree()
\ No newline at end of file
@@ -0,0 +1,373 @@
+"""
+查询结果缓存模块
+
+该模块提供进程内的查询结果缓存，支持：
+1. 按最近使用顺序淘汰（LRU），限制缓存条目数
+2. 每个条目有存活时间（TTL），过期后视为未命中
+3. 每个条目记录涉及的表，写入某些表后只失效涉及这些表的条目
+4. 线程安全，可在多线程的API服务中共用
+5. 参考表（父表选择值）缓存，每次使用前用MAX(update_time)、COUNT(*)校验是否有变化
+6. 提交预览令牌，保存预览时计算的变更集，提交时校验后直接使用；写入涉及的表时令牌失效
+
+查询结果缓存只在当前进程内有效，其他进程（或直接修改数据库）写入的数据
+最多在TTL之后才能读到，因此默认不启用（配置tree_query_cache_size为0），
+只在单进程部署或可以接受TTL内的旧数据时设置；参考表缓存每次校验，总能读到最新的数据。
+
+主要类：
+- QueryCache: LRU+TTL查询结果缓存
+- ReferenceCache: 参考表缓存
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+from sqlalchemy import text
+
+# 添加父目录到系统路径，以便导入mint模块
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+from mint.globals import (
+    TREE_QUERY_CACHE_SIZE, TREE_QUERY_CACHE_TTL,
+    TREE_PREVIEW_TOKEN_SIZE, TREE_PREVIEW_TOKEN_TTL
+)
+from mint.db.tree_index import get_schema_index
+
+
+class QueryCache:
+    """
+    LRU+TTL查询结果缓存
+
+    条目为 键 -> (值, 过期时间, 涉及的表)。缓存不复制值，
+    调用方需要保证存入后和取出后不会原地修改值。
+
+    每次失效使代数加1，并记录各表最后一次失效时的代数。调用方在查询数据库前
+    用generation()取得当前代数并在put时传入，查询期间涉及的表被失效过时不写入，
+    避免查询开始后写入的数据被旧的查询结果覆盖。
+    """
+
+    def __init__(self, maxsize=128, ttl=60):
+        """
+        初始化缓存
+
+        Args:
+            maxsize: 最多缓存的条目数，为0时不缓存
+            ttl: 条目的存活时间（秒），为None时不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._table_generations = {}
+        self._cleared_generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        获取缓存的值
+
+        Args:
+            key: 键（必须可哈希）
+            default: 未命中时的返回值
+
+        Returns:
+            缓存的值，未命中或已过期时返回default
+        """
+        with self._lock:
+            try:
+                value, expire_time, tables = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expire_time is not None and expire_time <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self):
+        """
+        获取当前代数，在查询数据库前调用，查询结果写入缓存时传给put
+
+        Returns:
+            int: 代数
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self, key, value, tables=(), generation=None):
+        """
+        写入缓存
+
+        Args:
+            key: 键（必须可哈希）
+            value: 值
+            tables: 值涉及的表名，写入这些表时条目失效
+            generation: 查询数据库前的代数（见generation），
+                之后涉及的表被失效过时不写入；为None时不检查
+
+        Returns:
+            bool: 是否写入
+        """
+        if self.maxsize <= 0:
+            return False
+        tables = frozenset(tables)
+        if self.ttl is None:
+            expire_time = None
+        else:
+            expire_time = time.monotonic() + self.ttl
+        with self._lock:
+            if generation is not None and (
+                    self._cleared_generation > generation or
+                    any(self._table_generations.get(table, 0) > generation for table in tables)
+            ):
+                return False
+            self._entries[key] = (value, expire_time, tables)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return True
+
+    def pop(self, key, default=None):
+        """
+        取出并删除缓存的值
+
+        Args:
+            key: 键
+            default: 未命中时的返回值
+
+        Returns:
+            缓存的值，未命中或已过期时返回default
+        """
+        with self._lock:
+            try:
+                value, expire_time, tables = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expire_time is not None and expire_time <= time.monotonic():
+                return default
+            return value
+
+    def invalidate(self, tables):
+        """
+        使涉及指定表的条目失效
+
+        Args:
+            tables: 被写入的表名
+
+        Returns:
+            int: 失效的条目数
+        """
+        tables = set(tables)
+        with self._lock:
+            self._generation += 1
+            for table in tables:
+                self._table_generations[table] = self._generation
+            keys = [
+                key for key, (value, expire_time, entry_tables) in self._entries.items()
+                if not entry_tables.isdisjoint(tables)
+            ]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._generation += 1
+            self._cleared_generation = self._generation
+            self._entries.clear()
+
+    def stats(self):
+        """
+        获取缓存的统计信息
+
+        Returns:
+            dict: 条目数、容量、TTL、命中次数和未命中次数
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class ReferenceCache:
+    """
+    参考表缓存
+
+    缓存整张表的id、主键、外键、被引用列及网页可见的列，条目为
+    (数据库, 表名) -> (版本, 数据)，版本为表的(MAX(update_time), COUNT(*))。
+    每次获取时先查询版本，版本不变时直接返回缓存的数据，
+    新增、删除和修改（update_time更新）都会使版本变化。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_columns(tables, table_name):
+        """
+        获取参考表缓存的列
+
+        Args:
+            tables: 表对象字典
+            table_name: 表名
+
+        Returns:
+            list: 列名列表（按表的列顺序）
+        """
+        key_columns = get_schema_index(tables).key_columns_by_table[table_name]
+        columns = [
+            col.col_name for col in tables[table_name].cols
+            if col.col_name in key_columns or col.web_visible == 1
+        ]
+        if 'id' not in columns:
+            columns.insert(0, 'id')
+        return columns
+
+    @staticmethod
+    def get_version(con, table):
+        """
+        查询表的版本
+
+        Args:
+            con: 数据库连接对象
+            table: 表对象
+
+        Returns:
+            tuple: (MAX(update_time), COUNT(*))
+        """
+        sql = f'SELECT MAX(`update_time`), COUNT(*) FROM {table.schema}.{table.table_name}'
+        return tuple(con.execute(text(sql)).one())
+
+    def get(self, con, tables, table_name):
+        """
+        获取参考表数据
+
+        返回的数据由所有调用方共用，不能原地修改。
+
+        Args:
+            con: 数据库连接对象
+            tables: 表对象字典
+            table_name: 表名
+
+        Returns:
+            pd.DataFrame: 参考表数据（以id为索引）
+        """
+        table = tables[table_name]
+        columns = self.get_columns(tables, table_name)
+        engine = getattr(con, 'engine', None)
+        if engine is None:
+            return self._read(con, table, columns)
+
+        key = (str(engine.url), table.schema, table_name, tuple(columns))
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # 同一张表同时只由一个线程校验和加载
+        with load_lock:
+            version = self.get_version(con, table)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+            data = self._read(con, table, columns)
+            with self._lock:
+                self._entries[key] = (version, data)
+            return data
+
+    @staticmethod
+    def _read(con, table, columns):
+        columns_str = ', '.join([f'`{col}`' for col in columns])
+        sql = f'SELECT {columns_str} FROM {table.schema}.{table.table_name}'
+        return pd.read_sql(sql=text(sql), con=con, index_col='id')
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        获取缓存的统计信息
+
+        Returns:
+            dict: 缓存的表数、命中次数和未命中次数
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def freeze(value):
+    """
+    将dict/list/set等转换为可哈希的值，用于生成缓存键
+
+    Args:
+        value: 值
+
+    Returns:
+        可哈希的值
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+# 数据树查询结果缓存
+QUERY_CACHE = QueryCache(maxsize=TREE_QUERY_CACHE_SIZE, ttl=TREE_QUERY_CACHE_TTL)
+
+# 参考表缓存
+REFERENCE_CACHE = ReferenceCache()
+
+# 提交预览令牌 -> 预览时的变更集及涉及行的原数据
+PREVIEW_TOKENS = QueryCache(maxsize=TREE_PREVIEW_TOKEN_SIZE, ttl=TREE_PREVIEW_TOKEN_TTL)
+
+
+def invalidate_tables(tables):
+    """
+    写入数据库后使涉及这些表的查询结果和提交预览令牌失效
+
+    令牌失效后提交时重新加载并比较，不会按预览时的变更集提交。
+
+    Args:
+        tables: 被写入的表名
+
+    Returns:
+        int: 失效的查询结果条目数
+    """
+    tables = set(tables)
+    PREVIEW_TOKENS.invalidate(tables)
+    return QUERY_CACHE.invalidate(tables)
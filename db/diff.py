@@ -0,0 +1,355 @@
+"""
+数据差异模块
+
+该模块按列比较一张表的原数据和提交的数据，支持：
+1. 向量化计算新增、修改、删除和未变化的行
+2. 逐单元格的变化标记（行 x 列的布尔矩阵）
+3. None/NaN视为相等，Decimal与浮点数按数值比较，日期与日期字符串按日期比较
+4. 输出与check_update_all兼容的变更集，或只包含变化单元格的紧凑变更集
+5. 校验变更涉及的行在数据库中是否仍与比较时相同（乐观并发）
+
+主要类：
+- TableDiff: 单表差异
+
+主要函数：
+- values_equal: 逐元素比较两列的值
+- check_snapshot: 乐观并发校验
+"""
+
+import os
+import re
+import sys
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text, bindparam
+
+# 添加父目录到系统路径，以便导入mint模块
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+from mint.globals import TREE_FETCH_CHUNK_SIZE
+from mint.db.writer import to_records, SYSTEM_COLUMNS
+
+
+NUMERIC_KINDS = {'integer', 'floating', 'mixed-integer-float', 'decimal', 'boolean'}
+DATETIME_KINDS = {'datetime', 'datetime64', 'date'}
+# 可能同时包含数值和字符串的类型
+MIXED_KINDS = {'mixed-integer', 'mixed'}
+_NUMBER_PATTERN = re.compile(r'^\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?\s*$')
+
+
+def _to_float(series):
+    """逐个转换为浮点数（Decimal、数值字符串均可），不能转换的值为NaN"""
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)
+
+
+def _to_exact(value):
+    """整数、Decimal和数值字符串转换为Decimal（精确），浮点数和其他值返回None"""
+    if isinstance(value, (int, np.integer, np.bool_)):
+        return Decimal(int(value))
+    if isinstance(value, Decimal):
+        return value if value.is_finite() else None
+    if isinstance(value, str) and _NUMBER_PATTERN.match(value):
+        return Decimal(value.strip())
+    return None
+
+
+def _is_date(value):
+    return isinstance(value, (date, np.datetime64))
+
+
+def _mixed_equal(left, right):
+    """
+    逐元素比较类型混合的两列
+
+    两边都是整数、Decimal或数值字符串时按Decimal精确比较，避免大整数经浮点数转换后误判相等，
+    其他元素按浮点数比较（不能解析为数值的值按==比较）；
+    日期与日期或字符串逐个按日期比较。
+
+    Args:
+        left: 左列（object类型的Series）
+        right: 右列
+
+    Returns:
+        np.ndarray: 布尔数组，相等为True
+    """
+    left_values = left.to_numpy()
+    right_values = right.to_numpy()
+    equal = np.asarray(
+        (_to_float(left) == _to_float(right)) | (left_values == right_values),
+        dtype=bool
+    )
+    for i in range(len(equal)):
+        left_exact = _to_exact(left_values[i])
+        right_exact = _to_exact(right_values[i])
+        if left_exact is not None and right_exact is not None:
+            equal[i] = left_exact == right_exact
+
+    left_dates = left.map(_is_date).to_numpy(dtype=bool)
+    right_dates = right.map(_is_date).to_numpy(dtype=bool)
+    for i in np.flatnonzero(left_dates | right_dates):
+        a, b = left_values[i], right_values[i]
+        if (_is_date(a) or isinstance(a, str)) and (_is_date(b) or isinstance(b, str)):
+            equal[i] = pd.to_datetime(a, errors='coerce') == pd.to_datetime(b, errors='coerce')
+    return equal
+
+
+def values_equal(left, right):
+    """
+    逐元素比较两列的值
+
+    两边都为空（None/NaN/NaT）时相等，只有一边为空时不相等；
+    两边都是数值（含Decimal）时按数值比较，数值与字符串混合时字符串按数值解析后比较
+    （整数、Decimal和数值字符串之间精确比较，见_mixed_equal）；
+    一边是日期时另一边的字符串按日期解析后比较，类型混合的列中的日期逐个按日期比较；
+    其他情况按Python的==比较。
+
+    Args:
+        left: 左列（Series或数组）
+        right: 右列（与left等长）
+
+    Returns:
+        np.ndarray: 布尔数组，相等为True
+    """
+    left = pd.Series(np.asarray(left, dtype=object), dtype=object)
+    right = pd.Series(np.asarray(right, dtype=object), dtype=object)
+    left_na = left.isna().to_numpy()
+    right_na = right.isna().to_numpy()
+    both = ~left_na & ~right_na
+    if not both.any():
+        return left_na & right_na
+
+    kinds = {
+        pd.api.types.infer_dtype(left, skipna=True),
+        pd.api.types.infer_dtype(right, skipna=True),
+    } - {'empty'}
+    if kinds <= {'integer', 'boolean'}:
+        # 整数直接比较，避免大整数转换为浮点数后丢失精度
+        equal = left.to_numpy() == right.to_numpy()
+    elif (
+            kinds <= NUMERIC_KINDS | MIXED_KINDS | {'string'} and
+            len(kinds & (NUMERIC_KINDS | MIXED_KINDS)) > 0
+    ) or (
+            len(kinds & MIXED_KINDS) > 0 and kinds <= MIXED_KINDS | DATETIME_KINDS | {'string'}
+    ):
+        # 数值与字符串混合时，字符串按数值解析后比较（如'1.50'与Decimal('1.5')相等），
+        # 不能解析为数值的值按==比较，混合列中的日期按日期比较
+        equal = _mixed_equal(left, right)
+    elif len(kinds & DATETIME_KINDS) > 0 and kinds <= DATETIME_KINDS | {'string'}:
+        equal = (
+            pd.to_datetime(left, errors='coerce', format='mixed') ==
+            pd.to_datetime(right, errors='coerce', format='mixed')
+        ).to_numpy()
+    else:
+        equal = left.to_numpy() == right.to_numpy()
+    return (left_na & right_na) | (both & np.asarray(equal, dtype=bool))
+
+
+class TableDiff:
+    """
+    单表差异
+
+    按id对齐原数据和提交的数据：提交的id为空的行为新增，id在原数据中的行为修改（或未变化），
+    原数据中没有被提交的行为删除。提交的id不在原数据中时报错。
+
+    属性：
+    - columns: 比较的列（提交数据中除id和ignore_columns以外的列）
+    - insert_mask: 提交数据中新增的行
+    - delete_mask: 原数据中删除的行
+    - prev_positions: 提交数据中每个已有行在原数据中的位置
+    - changed: 已有行 x columns 的变化标记
+    - update_mask: 已有行中有变化的行
+    """
+
+    def __init__(self, prev, submit, allow_delete=True, ignore_columns=SYSTEM_COLUMNS, table_name=None):
+        """
+        计算差异
+
+        Args:
+            prev: 原数据（包含id列）
+            submit: 提交的数据，没有id列时全部视为新增
+            allow_delete: 是否允许删除，为False时有未提交的原数据行会报错
+            ignore_columns: 不参与比较的列，默认为由数据库维护的create_time、update_time
+            table_name: 表名，只用于错误信息
+        """
+        prev = prev.reset_index(drop=True)
+        submit = submit.reset_index(drop=True)
+        if 'id' not in submit.columns:
+            submit = submit.assign(id=None)
+        self.prev = prev
+        self.submit = submit
+        self.submit_columns = submit.columns.tolist()
+        self.columns = [
+            col for col in self.submit_columns
+            if col != 'id' and col not in ignore_columns
+        ]
+
+        if 'id' in prev.columns:
+            prev_ids = pd.Index(prev['id'])
+        else:
+            prev_ids = pd.Index([])
+        submit_ids = submit['id']
+
+        self.insert_mask = submit_ids.isna().to_numpy()
+        self.match_mask = ~self.insert_mask
+        positions = prev_ids.get_indexer(submit_ids[self.match_mask])
+        if (positions == -1).any():
+            unknown = submit_ids[self.match_mask][positions == -1].tolist()
+            print(f'invalid ids of "{table_name}": {len(unknown)} not in previous values, e.g. {unknown[:10]}')
+            raise ValueError('Unknown case')
+        self.prev_positions = positions
+
+        self.delete_mask = np.ones(len(prev), dtype=bool)
+        self.delete_mask[positions] = False
+        if self.delete_mask.any() and not allow_delete:
+            missing = prev['id'][self.delete_mask].tolist()
+            print(f'cannot delete from "{table_name}": {len(missing)} rows not in submit values, e.g. {missing[:10]}')
+            raise ValueError('Unknown case')
+
+        self.changed = np.zeros((len(positions), len(self.columns)), dtype=bool)
+        matched = submit[self.match_mask]
+        for j, col in enumerate(self.columns):
+            if col in prev.columns:
+                old = prev[col].to_numpy(dtype=object)[positions]
+            else:
+                old = np.full(len(positions), None, dtype=object)
+            self.changed[:, j] = ~values_equal(old, matched[col])
+        self.update_mask = self.changed.any(axis=1)
+
+    def stats(self):
+        """
+        获取各类行数
+
+        Returns:
+            dict: 新增、修改、删除、未变化的行数及变化的单元格数
+        """
+        return {
+            'insert': int(self.insert_mask.sum()),
+            'update': int(self.update_mask.sum()),
+            'delete': int(self.delete_mask.sum()),
+            'unchanged': int((~self.update_mask).sum()),
+            'cells': int(self.changed.sum()),
+        }
+
+    def get_snapshot(self):
+        """
+        获取将被修改或删除的行的原数据，用于提交时的乐观并发校验（见check_snapshot）
+
+        Returns:
+            pd.DataFrame: 原数据中将被修改或删除的行（包含id列）
+        """
+        positions = np.concatenate([
+            self.prev_positions[self.update_mask],
+            np.flatnonzero(self.delete_mask),
+        ])
+        return self.prev.take(positions).reset_index(drop=True)
+
+    def to_changes(self, compact=False):
+        """
+        生成变更集
+
+        变更依次为删除、修改、新增，格式与check_update_all相同：
+        ('insert', {列名__new: 新值})、('delete', {列名: 原值})、
+        ('update', {列名: 原值}, {列名__new: 新值})。
+
+        Args:
+            compact: 为False时每个已有行都生成包含所有列的修改；
+                为True时跳过未变化的行，修改只包含id和变化的列
+
+        Returns:
+            list: 变更列表
+        """
+        cols = self.submit_columns
+        res = []
+
+        deletes = self.prev[self.delete_mask].reindex(columns=cols)
+        for old in to_records(deletes):
+            res.append(('delete', old))
+
+        old_data = self.prev.take(self.prev_positions).reindex(columns=cols)
+        new_data = self.submit[self.match_mask][cols]
+        if compact:
+            rows = np.flatnonzero(self.update_mask)
+            old_records = to_records(old_data.iloc[rows])
+            new_records = to_records(new_data.iloc[rows])
+            for old, new, changed in zip(old_records, new_records, self.changed[rows]):
+                changed_cols = [col for col, flag in zip(self.columns, changed) if flag]
+                res.append((
+                    'update',
+                    {col: old[col] for col in ['id'] + changed_cols},
+                    {f'{col}__new': new[col] for col in ['id'] + changed_cols},
+                ))
+        else:
+            for old, new in zip(to_records(old_data), to_records(new_data)):
+                res.append((
+                    'update',
+                    old,
+                    {f'{col}__new': value for col, value in new.items()},
+                ))
+
+        inserts = self.submit[self.insert_mask][cols]
+        for new in to_records(inserts):
+            res.append(('insert', {f'{col}__new': value for col, value in new.items()}))
+        return res
+
+
+def check_snapshot(con, tables, snapshot, lock=True, chunk_size=None):
+    """
+    校验数据库中的行是否仍与快照相同
+
+    按id分块查询快照中的行（lock为True时用FOR UPDATE锁定到事务结束），逐列与快照比较，
+    有行被删除或任何一列的值与快照不同时校验失败。比较整行而不只是update_time：
+    update_time精确到秒，与快照同一秒内的修改只比较update_time时无法发现。
+    修改后所有列的值与快照相同的写入无法发现，此时按快照提交的结果与重新比较相同。
+
+    Args:
+        con: 数据库连接对象（由调用方管理事务）
+        tables: 表对象字典
+        snapshot: 快照 {表名: 原数据}，见TableDiff.get_snapshot
+        lock: 是否锁定查询的行
+        chunk_size: 每条IN查询最多包含的id个数，为None时使用配置tree_fetch_chunk_size
+
+    Returns:
+        bool: 是否全部相同
+    """
+    if chunk_size is None:
+        chunk_size = TREE_FETCH_CHUNK_SIZE
+    for table_name, seen in snapshot.items():
+        if len(seen) == 0:
+            continue
+        table = tables[table_name]
+        table_cols = set(col.col_name for col in table.cols)
+        columns = ['id'] + [
+            col for col in seen.columns
+            if col != 'id' and (col in table_cols or col in SYSTEM_COLUMNS)
+        ]
+        sql = (
+            f'SELECT {", ".join([f"`{col}`" for col in columns])} '
+            f'FROM {table.schema}.{table.table_name} WHERE `id` IN :ids'
+        )
+        if lock:
+            sql += ' FOR UPDATE'
+        sql = text(sql).bindparams(bindparam('ids', expanding=True))
+        ids = seen['id'].tolist()
+        current = {}
+        for start in range(0, len(ids), chunk_size):
+            for row in con.execute(sql, {'ids': ids[start:start + chunk_size]}):
+                current[row[0]] = row
+        missing = [row_id for row_id in ids if row_id not in current]
+        if len(missing) > 0:
+            print(f'[snapshot] {len(missing)} rows of "{table_name}" were deleted, e.g. {missing[:10]}')
+            return False
+        equal = np.ones(len(ids), dtype=bool)
+        for j, col in enumerate(columns[1:], start=1):
+            equal &= values_equal(seen[col], [current[row_id][j] for row_id in ids])
+        if not equal.all():
+            changed = [row_id for row_id, flag in zip(ids, equal) if not flag]
+            print(f'[snapshot] {len(changed)} rows of "{table_name}" were modified, e.g. {changed[:10]}')
+            return False
+    return True
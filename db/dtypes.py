@@ -0,0 +1,247 @@
+"""
+数据类型模块
+
+该模块根据表对象中各列的data_type（如String(128)、DECIMAL(22,2)、DateTime、Integer）
+生成DataFrame的数据类型映射，在读取数据时直接转换，支持：
+1. 字符串使用Arrow存储（未安装pyarrow时使用pandas字符串类型）
+2. 取值重复较多的外键列使用categorical
+3. 日期时间使用datetime64
+4. DECIMAL默认保留Decimal（精确），可按配置转换为float或按小数位数放大的整数
+5. 按表统计数据集的内存占用
+"""
+
+import re
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# 默认的类型转换选项
+DEFAULT_DTYPE_OPTIONS = {
+    # 字符串类型：'arrow'、'python'或'object'（不转换）
+    'strings': 'arrow',
+    # 外键列不同值个数不超过行数的该比例时转换为categorical，为0时不转换
+    'categorical_fk_ratio': 0.5,
+    # DECIMAL类型：'object'（不转换，保留Decimal）、'scaled'（乘以10^小数位数后存为整数）
+    # 或'float'（有精度损失，需要显式指定）
+    'decimal': 'object',
+}
+
+_DATA_TYPE_PATTERN = re.compile(r'^\s*(\w+)\s*(?:\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\))?')
+
+_STRING_TYPES = {'string', 'text', 'varchar', 'char', 'longtext', 'mediumtext'}
+_INTEGER_TYPES = {'integer', 'int', 'biginteger', 'bigint', 'smallinteger', 'smallint', 'tinyint'}
+_FLOAT_TYPES = {'float', 'double', 'real'}
+_DECIMAL_TYPES = {'decimal', 'numeric'}
+_DATETIME_TYPES = {'datetime', 'date', 'timestamp'}
+_BOOLEAN_TYPES = {'boolean', 'bool'}
+
+
+def get_dtype_options(dtypes):
+    """
+    获取类型转换选项
+
+    Args:
+        dtypes: None或'infer'表示不转换（由pandas推断），'meta'表示使用默认选项
+            （DECIMAL保留Decimal），dict表示覆盖部分默认选项，如{'decimal': 'float'}
+
+    Returns:
+        dict: 类型转换选项，不转换时返回None
+    """
+    if dtypes is None or dtypes == 'infer':
+        return None
+    options = dict(DEFAULT_DTYPE_OPTIONS)
+    if isinstance(dtypes, dict):
+        options.update(dtypes)
+    elif dtypes != 'meta':
+        print(f'invalid dtypes: {dtypes}')
+        raise ValueError
+    return options
+
+
+def parse_data_type(data_type):
+    """
+    解析列的data_type
+
+    Args:
+        data_type: 如'String(128)'、'DECIMAL(22,2)'
+
+    Returns:
+        tuple: (小写类型名, 长度/精度, 小数位数)，无法解析时类型名为None
+    """
+    if data_type is None or pd.isna(data_type):
+        return None, None, None
+    match = _DATA_TYPE_PATTERN.match(str(data_type))
+    if match is None:
+        return None, None, None
+    name, length, scale = match.groups()
+    return (
+        name.lower(),
+        None if length is None else int(length),
+        None if scale is None else int(scale)
+    )
+
+
+def get_col_dtype(col, options):
+    """
+    获取列的目标类型
+
+    Args:
+        col: 列对象
+        options: 类型转换选项
+
+    Returns:
+        tuple: (类型, 参数)，类型为'string'、'integer'、'float'、'decimal'、
+            'datetime'、'boolean'或None（不转换）
+    """
+    name, length, scale = parse_data_type(col.data_type)
+    if name in _STRING_TYPES:
+        if options['strings'] == 'object':
+            return None, None
+        return 'string', None
+    if name in _INTEGER_TYPES:
+        return 'integer', None
+    if name in _FLOAT_TYPES:
+        return 'float', None
+    if name in _DECIMAL_TYPES:
+        if options['decimal'] == 'object':
+            return None, None
+        return 'decimal', scale or 0
+    if name in _DATETIME_TYPES:
+        return 'datetime', None
+    if name in _BOOLEAN_TYPES:
+        return 'boolean', None
+    return None, None
+
+
+def get_dtype_map(table, options):
+    """
+    获取表的类型映射
+
+    Args:
+        table: 表对象
+        options: 类型转换选项
+
+    Returns:
+        dict: {列名: (类型, 参数, 是否外键)}
+    """
+    res = {}
+    for col in table.cols:
+        kind, param = get_col_dtype(col, options)
+        if kind is None:
+            continue
+        res[col.col_name] = (kind, param, not pd.isna(col.foreign_key))
+    return res
+
+
+def get_date_columns(table):
+    """
+    获取表中只有日期（没有时间）的列
+
+    Args:
+        table: 表对象
+
+    Returns:
+        set: 列名集合
+    """
+    return set(
+        col.col_name for col in table.cols
+        if parse_data_type(col.data_type)[0] == 'date'
+    )
+
+
+def _string_dtype(options):
+    if options['strings'] == 'arrow' and HAS_PYARROW:
+        return pd.StringDtype(storage='pyarrow')
+    return pd.StringDtype(storage='python')
+
+
+def convert_column(series, kind, param, is_fk, options):
+    """
+    按目标类型转换一列数据
+
+    Args:
+        series: 数据列
+        kind: 目标类型，见get_col_dtype
+        param: 类型参数（DECIMAL的小数位数）
+        is_fk: 是否为外键列
+        options: 类型转换选项
+
+    Returns:
+        pd.Series: 转换后的数据列
+    """
+    if kind == 'string':
+        ratio = options['categorical_fk_ratio']
+        if is_fk and ratio and len(series) > 0 and series.nunique() <= len(series) * ratio:
+            return series.astype('category')
+        return series.astype(_string_dtype(options))
+    if kind == 'integer':
+        return pd.to_numeric(series, errors='coerce').astype('Int64')
+    if kind == 'float':
+        return pd.to_numeric(series, errors='coerce').astype('float64')
+    if kind == 'decimal':
+        values = pd.to_numeric(series.astype(object), errors='coerce').astype('float64')
+        if options['decimal'] == 'scaled':
+            return (values * 10 ** param).round().astype('Int64')
+        return values
+    if kind == 'datetime':
+        return pd.to_datetime(series, errors='coerce')
+    if kind == 'boolean':
+        return series.astype('boolean')
+    return series
+
+
+def apply_dtype_map(data, dtype_map, options):
+    """
+    按类型映射转换DataFrame（索引不转换）
+
+    Args:
+        data: DataFrame
+        dtype_map: 类型映射，见get_dtype_map
+        options: 类型转换选项
+
+    Returns:
+        pd.DataFrame: 转换后的DataFrame
+    """
+    converted = {
+        col: convert_column(data[col], kind, param, is_fk, options)
+        for col, (kind, param, is_fk) in dtype_map.items()
+        if col in data.columns
+    }
+    if len(converted) == 0:
+        return data
+    return data.assign(**converted)
+
+
+def memory_report(relevant_data_set):
+    """
+    统计数据集的内存占用
+
+    Args:
+        relevant_data_set: 相关数据集 {表名: 数据}
+
+    Returns:
+        pd.DataFrame: 每张表的行数、列数、内存占用（字节，包括索引和对象内容）
+            及占用最多的列，按内存占用倒序排列
+    """
+    rows = []
+    for node_name, data in relevant_data_set.items():
+        usage = data.memory_usage(deep=True)
+        col_usage = usage.drop('Index', errors='ignore')
+        rows.append({
+            'table': node_name,
+            'rows': len(data),
+            'columns': len(data.columns),
+            'bytes': int(usage.sum()),
+            'largest_column': col_usage.idxmax() if len(col_usage) > 0 else None,
+            'largest_column_bytes': int(col_usage.max()) if len(col_usage) > 0 else 0,
+        })
+    report = pd.DataFrame(
+        rows,
+        columns=['table', 'rows', 'columns', 'bytes', 'largest_column', 'largest_column_bytes']
+    )
+    return report.sort_values('bytes', ascending=False).set_index('table')
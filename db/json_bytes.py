@@ -0,0 +1,195 @@
+"""
+JSON序列化模块
+
+该模块将JSON对象和DataFrame直接编码为UTF-8的JSON字节串，支持：
+1. NaN/NaT/None编码为null，Decimal编码为数值，日期时间编码为字符串（与str()相同：
+   有微秒时保留微秒，日期列只输出日期），NumPy标量按对应的Python类型编码
+2. DataFrame按列编码后逐行拼接，不复制数据、不生成记录字典
+3. 已编码的JSON片段（RawJson）直接拼接
+"""
+
+import datetime
+import json
+import math
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+_NULL = b'null'
+_TRUE = b'true'
+_FALSE = b'false'
+
+# 日期时间的输出格式（与str(pd.Timestamp)一致，整秒时不输出微秒）
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATETIME_US_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class RawJson(bytes):
+    """已编码的JSON片段，序列化时原样输出"""
+
+
+def _encode_str(value):
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def _format_datetime(value):
+    if value.microsecond != 0:
+        return value.strftime(DATETIME_US_FORMAT)
+    return value.strftime(DATETIME_FORMAT)
+
+
+def _encode_float(value):
+    if math.isnan(value) or math.isinf(value):
+        return _NULL
+    return repr(value).encode('utf-8')
+
+
+def encode_value(value):
+    """
+    编码单个值
+
+    Args:
+        value: 值
+
+    Returns:
+        bytes: JSON片段
+    """
+    if value is None:
+        return _NULL
+    if isinstance(value, RawJson):
+        return bytes(value)
+    if isinstance(value, str):
+        return _encode_str(value)
+    if isinstance(value, (bool, np.bool_)):
+        return _TRUE if value else _FALSE
+    if isinstance(value, (int, np.integer)):
+        return str(int(value)).encode('utf-8')
+    if isinstance(value, (float, np.floating)):
+        return _encode_float(float(value))
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return _NULL
+        return str(value).encode('utf-8')
+    if value is pd.NaT or value is pd.NA:
+        return _NULL
+    if isinstance(value, datetime.datetime):
+        return _encode_str(_format_datetime(value))
+    if isinstance(value, datetime.date):
+        return _encode_str(value.strftime(DATE_FORMAT))
+    if isinstance(value, np.datetime64):
+        if np.isnat(value):
+            return _NULL
+        return _encode_str(_format_datetime(pd.Timestamp(value)))
+    if isinstance(value, dict):
+        return b'{' + b','.join(
+            _encode_str(str(k)) + b':' + encode_value(v) for k, v in value.items()
+        ) + b'}'
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return b'[' + b','.join(encode_value(v) for v in value) + b']'
+    if isinstance(value, pd.DataFrame):
+        return frame_to_json_records(value)
+    if isinstance(value, pd.Series):
+        return encode_column(value)
+    return _encode_str(str(value))
+
+
+def encode_column(series):
+    """
+    将一列数据编码为JSON数组
+
+    Args:
+        series: 数据列
+
+    Returns:
+        bytes: JSON数组
+    """
+    return b'[' + b','.join(encode_column_values(series)) + b']'
+
+
+def encode_column_values(series, date_only=False):
+    """
+    按列类型批量编码一列数据
+
+    Args:
+        series: 数据列
+        date_only: 是否为日期列（日期时间只输出日期）
+
+    Returns:
+        list: 每个值的JSON片段
+    """
+    dtype = series.dtype
+    kind = getattr(dtype, 'kind', 'O')
+    # 可空扩展类型（Int64、boolean等）按对象逐个编码
+    if pd.api.types.is_extension_array_dtype(dtype) and kind != 'M':
+        kind = 'O'
+
+    if kind in 'iu':
+        return [str(v).encode('utf-8') for v in series.to_numpy().tolist()]
+    if kind == 'f':
+        return [_encode_float(v) for v in series.to_numpy().tolist()]
+    if kind == 'b':
+        return [_TRUE if v else _FALSE for v in series.to_numpy().tolist()]
+    if kind == 'M':
+        na = series.isna().to_numpy()
+        if date_only:
+            formatted = series.dt.strftime(DATE_FORMAT)
+        else:
+            formatted = series.dt.strftime(DATETIME_FORMAT)
+            has_us = (series.dt.microsecond != 0).to_numpy()
+            if has_us.any():
+                formatted = formatted.where(~has_us, series.dt.strftime(DATETIME_US_FORMAT))
+        return [_NULL if is_na else _encode_str(v) for v, is_na in zip(formatted.tolist(), na)]
+
+    if date_only:
+        # 对象列中的datetime按日期输出
+        na = series.isna().to_numpy()
+        return [
+            _NULL if is_na else encode_value(v.date() if isinstance(v, datetime.datetime) else v)
+            for v, is_na in zip(series.tolist(), na)
+        ]
+
+    # 字符串、Decimal等其他类型逐个编码
+    na = series.isna().to_numpy()
+    return [
+        _NULL if is_na else encode_value(v)
+        for v, is_na in zip(series.tolist(), na)
+    ]
+
+
+def frame_to_json_records(data, columns=None, date_columns=()):
+    """
+    将DataFrame编码为JSON记录数组（与to_dict(orient='records')结构相同，不含索引）
+
+    Args:
+        data: DataFrame
+        columns: 输出的列，为None时输出所有列
+        date_columns: 只输出日期的列（表结构中data_type为date的列）
+
+    Returns:
+        bytes: JSON数组
+    """
+    if columns is None:
+        columns = list(data.columns)
+    if len(data) == 0:
+        return b'[]'
+    keys = [_encode_str(str(col)) + b':' for col in columns]
+    encoded = [encode_column_values(data[col], date_only=col in date_columns) for col in columns]
+    rows = []
+    for row in zip(*encoded):
+        rows.append(b'{' + b','.join([key + value for key, value in zip(keys, row)]) + b'}')
+    return b'[' + b','.join(rows) + b']'
+
+
+def dumps(json_obj):
+    """
+    将JSON对象编码为UTF-8的JSON字节串
+
+    Args:
+        json_obj: JSON对象（可以包含DataFrame、RawJson等）
+
+    Returns:
+        bytes: JSON
+    """
+    return encode_value(json_obj)
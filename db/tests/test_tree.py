@@ -1,5 +1,11 @@
+import json
+import time
+
 from mint.settings import *
 from mint.db.tree import *
+from mint.db.tree_index import SchemaIndex, get_schema_index, get_meta_version, load_schema_index
+from mint.db.dtypes import parse_data_type
+from mint.db.cache import QUERY_CACHE, REFERENCE_CACHE, invalidate_tables
 from mint.sys_init import *
 
 
@@ -17,6 +23,32 @@ def test_get_booking_sequence():
         cst_pki=get_cst_pki(con=con, schemas=[get_schema('data')]))
 
 
+def test_schema_index():
+    index = get_schema_index(tables)
+    assert get_schema_index(tables) is index
+    for edge in index.parents_by_table['project']:
+        print(edge)
+    for edge in index.children_by_table['project']:
+        print(edge)
+
+
+def test_schema_index_cache():
+    # 预热写入的缓存按元数据版本加载，结构与重新编译的一致
+    warmup_tree_cache(tables)
+    version = get_meta_version(tables)
+    index = load_schema_index(version=version)
+    assert index is not None
+    assert index.version == version
+    compiled = SchemaIndex(tables=tables, version=version)
+    for root in tables.keys():
+        assert index.booking_sequence(root) == compiled.booking_sequence(root)
+        assert index.reading_sequence(root) == compiled.reading_sequence(root)
+        assert (
+            Tree(con=None, tables=tables, root=root, schema_index=index).json_obj ==
+            Tree(con=None, tables=tables, root=root, schema_index=compiled).json_obj
+        )
+
+
 def test_tree():
     datat = DataTree(
         con=con,
@@ -31,5 +63,239 @@ def test_tree():
     print(to_json_str(jo))
 
 
+def test_to_json_bytes():
+    datat = DataTree(con=con, tables=tables, root='project')
+    datat.from_sql(index_col='name', index_values={'上海授信-20210628'})
+    jo = json.loads(datat.to_json_bytes(with_table=False))
+    assert jo['root'] == 'project'
+    assert len(jo['values']) == len(datat.data)
+
+
+def test_to_json_bytes_dates():
+    # 原来的to_json输出（infer时日期列为datetime.date）与按元数据转换为datetime64后的to_json_bytes输出相同
+    expected = DataTree(con=con, tables=tables, root='project')
+    expected.from_sql(limit=20, dtypes='infer', cache=False)
+    expected_values = json.loads(to_json_str(expected.json_obj_func(with_table=False)))['values']
+    datat = DataTree(con=con, tables=tables, root='project')
+    datat.from_sql(limit=20, dtypes='meta', cache=False)
+    values = json.loads(datat.to_json_bytes(with_table=False))['values']
+    date_cols = [
+        col.col_name for col in tables['project'].cols
+        if parse_data_type(col.data_type)[0] in ('date', 'datetime', 'timestamp')
+    ]
+    assert len(date_cols) > 0
+    for expected_row, row in zip(expected_values, values):
+        for col in date_cols:
+            assert row[col] == expected_row[col]
+
+
+def test_memory_report():
+    res = []
+    for dtypes in ['infer', 'meta']:
+        datat = DataTree(con=con, tables=tables, root='project')
+        datat.from_sql(limit=100, dtypes=dtypes)
+        report = datat.memory_report()
+        print(report)
+        res.append(report['bytes'].sum())
+    print(f'infer: {res[0]} bytes, meta: {res[1]} bytes')
+
+
+def test_from_sql_workers():
+    res = []
+    for workers in [1, 4]:
+        datat = DataTree(con=con, tables=tables, root='project')
+        datat.from_sql(limit=20, workers=workers)
+        res.append(datat.relevant_data_set)
+    assert list(res[0].keys()) == list(res[1].keys())
+    for node_name in res[0]:
+        assert res[0][node_name].equals(res[1][node_name])
+
+
+def test_from_sql_cache():
+    # 查询结果缓存默认不启用
+    QUERY_CACHE.clear()
+    datat = DataTree(con=con, tables=tables, root='project')
+    datat.from_sql(limit=20)
+    assert len(QUERY_CACHE) == 0
+    maxsize = QUERY_CACHE.maxsize
+    QUERY_CACHE.maxsize = 128
+    try:
+        datat = DataTree(con=con, tables=tables, root='project')
+        datat.from_sql(limit=20)
+        hits = QUERY_CACHE.stats()['hits']
+        cached = DataTree(con=con, tables=tables, root='project')
+        cached.from_sql(limit=20)
+        assert QUERY_CACHE.stats()['hits'] == hits + 1
+        for node_name, data in datat.relevant_data_set.items():
+            assert cached.relevant_data_set[node_name].equals(data)
+        assert invalidate_tables(['project']) == 1
+        assert len(QUERY_CACHE) == 0
+    finally:
+        QUERY_CACHE.maxsize = maxsize
+
+
+def test_from_sql_pool_exhausted():
+    engine = con.engine
+    held = []
+    try:
+        # 占满连接池，查询应改为使用当前连接顺序执行，而不是等待连接池超时
+        while get_pool_capacity(engine) > 0:
+            held.append(engine.connect())
+        start = time.time()
+        datat = DataTree(con=con, tables=tables, root='project')
+        datat.from_sql(limit=20, workers=4, cache=False)
+        assert time.time() - start < DB_POOL_TIMEOUT
+    finally:
+        for held_con in held:
+            held_con.close()
+
+
+def test_query_cache_generation():
+    # 查询期间涉及的表被失效时，查询结果不写入缓存
+    maxsize = QUERY_CACHE.maxsize
+    QUERY_CACHE.maxsize = 128
+    try:
+        generation = QUERY_CACHE.generation()
+        invalidate_tables(['project'])
+        assert not QUERY_CACHE.put('test', 1, tables=['project', 'inst'], generation=generation)
+        assert QUERY_CACHE.get('test') is None
+        generation = QUERY_CACHE.generation()
+        assert QUERY_CACHE.put('test', 1, tables=['project'], generation=generation)
+        QUERY_CACHE.pop('test')
+    finally:
+        QUERY_CACHE.maxsize = maxsize
+
+
+def test_refresh():
+    datat = DataTree(con=con, tables=tables, root='project')
+    datat.from_sql(index_col='name', index_values={'上海授信-20210628'}, cache=False)
+    relevant_data_set = datat.relevant_data_set
+    report = datat.refresh()
+    print(report)
+    assert datat.relevant_data_set is relevant_data_set
+    expected = DataTree(con=con, tables=tables, root='project')
+    expected.from_sql(index_col='name', index_values={'上海授信-20210628'}, cache=False)
+    assert set(datat.relevant_data_set) == set(expected.relevant_data_set)
+    for node_name, data in expected.relevant_data_set.items():
+        assert list(datat.relevant_data_set[node_name].index) == list(data.index)
+
+
+def test_reference_cache():
+    datat = DataTree(con=con, tables=tables, root='project')
+    res = datat.get_parents_select_values()
+    hits = REFERENCE_CACHE.stats()['hits']
+    assert datat.get_parents_select_values() == res
+    assert REFERENCE_CACHE.stats()['hits'] == hits + len(res)
+
+
+def test_itertrees():
+    datat = DataTree(con=con, tables=tables, root='project')
+    datat.from_sql(limit=20)
+    for i, t in datat.itertrees():
+        expected = DataTree(con=con, tables=tables, tree=datat, relevant_data_set={})
+        relevant_data_set = dict(datat.relevant_data_set)
+        relevant_data_set[datat.root] = datat.data.loc[[i]]
+        expected.from_relevant_data_set(relevant_data_set)
+        for node_name, data in expected.relevant_data_set.items():
+            assert list(t.relevant_data_set[node_name].index) == list(data.index)
+
+
+def eval_from_relevant_data_set(datat, relevant_data_set):
+    """原来按字符串拼接条件并eval的过滤方式，用于对比"""
+    relevant_data_set = copy(relevant_data_set)
+    root_data = relevant_data_set[datat.root]
+    values_map = datat.update_values_map(values_map={}, tree=datat, root_data=root_data)
+    for node_name in datat.reading_sequence:
+        if node_name not in relevant_data_set or node_name not in values_map:
+            continue
+        where_str_list = []
+        data = relevant_data_set[node_name]
+        for col, tree_values in values_map[node_name].items():
+            values_str = ', '.join([f'"{value}"' for value in tree_values['values']])
+            where_str_list.append(f'(data["{col}"].isin([{values_str}]))')
+        relevant_data_set[node_name] = eval(f'data[{" | ".join(where_str_list)}]')
+        for col, tree_values in values_map[node_name].items():
+            values_map = datat.update_values_map(
+                values_map=values_map, tree=tree_values['tree'], root_data=data)
+    return relevant_data_set
+
+
+def test_from_relevant_data_set_benchmark(repeat=20):
+    datat = DataTree(con=con, tables=tables, root='project')
+    datat.from_sql()
+    relevant_data_set = {
+        node_name: pd.concat([data] * repeat, ignore_index=True)
+        for node_name, data in datat.relevant_data_set.items()
+    }
+    print({node_name: len(data) for node_name, data in relevant_data_set.items()})
+
+    start = time.time()
+    expected = eval_from_relevant_data_set(datat, relevant_data_set)
+    eval_time = time.time() - start
+
+    start = time.time()
+    res = DataTree(con=con, tables=tables, tree=datat, relevant_data_set={})
+    res.from_relevant_data_set(relevant_data_set)
+    isin_time = time.time() - start
+
+    for node_name, data in expected.items():
+        assert len(res.relevant_data_set[node_name]) == len(data)
+    print(f'eval: {eval_time:.3f}s, isin: {isin_time:.3f}s')
+
+
+def groupby_nested_values(datat, ref_group=None, ignore_ref_col=None, full_detail=False):
+    """原来按组逐个loc并生成记录的嵌套值结构，用于对比"""
+    res = datat._nested_values(ignore_ref_col=ignore_ref_col, full_detail=full_detail)
+    data = datat.data.assign(key=datat.data.index.astype(str))
+    data['id'] = data.index
+    if ref_group:
+        display_data = data[['key'] + [col['dataIndex'] for col in res['columns']]]
+        res['dataSource'] = {
+            key: display_data.loc[names].to_dict(orient='records')
+            for key, names in ref_group.items()
+        }
+    for child in datat.cs:
+        child_data = child.data.sort_index()
+        gs_data = {key: value for key, value in data.groupby(by=child.reffed)}
+        child_ref_group = {
+            str(gs_data[ref_value].index[0]): group.index.to_list()
+            for ref_value, group in child_data.groupby(by=child.ref)
+        }
+        res['children'][child.root] = groupby_nested_values(
+            child,
+            ref_group=child_ref_group,
+            ignore_ref_col=child.ref,
+            full_detail=full_detail
+        )
+    return res
+
+
+def test_nested_values_benchmark():
+    datat = DataTree(con=con, tables=tables, root='inst')
+    datat.from_sql()
+    print({node_name: len(data) for node_name, data in datat.relevant_data_set.items()})
+
+    start = time.time()
+    expected = groupby_nested_values(datat)
+    groupby_time = time.time() - start
+
+    start = time.time()
+    res = datat.nested_values()
+    offsets_time = time.time() - start
+
+    assert repr(res) == repr(expected)
+    print(f'groupby: {groupby_time:.3f}s, offsets: {offsets_time:.3f}s')
+
+
+def test_iter_batches():
+    datat = DataTree(con=con, tables=tables, root='project')
+    ids = []
+    for batch in datat.iter_batches(batch_size=50):
+        assert len(batch) <= 50
+        ids.extend(batch.data.index.tolist())
+    assert ids == sorted(ids)
+    assert len(ids) == len(set(ids))
+
+
 if __name__ == '__main__':
     test_tree()
\ No newline at end of file
@@ -15,7 +15,12 @@
 import pandas as pd
 from pandas import ExcelWriter
 from openpyxl import Workbook
+from sqlalchemy import text, bindparam
+from sqlalchemy.pool import QueuePool
 from copy import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import json
 import os
 import sys
 
@@ -31,6 +36,36 @@ from mint.helper_function.hf_xl import fit_col_width
 from mint.helper_function.hf_func import *
 from mint.helper_function.hf_array import get_crop_from_df
 from mint.helper_function.hf_data import *
+from mint.globals import TREE_FETCH_WORKERS, TREE_FETCH_CHUNK_SIZE, TREE_DTYPES
+from mint.db.json_bytes import encode_value, frame_to_json_records
+from mint.db.dtypes import (
+    get_dtype_options, get_dtype_map, apply_dtype_map, memory_report, get_date_columns
+)
+from mint.db.cache import QUERY_CACHE, REFERENCE_CACHE, freeze
+from mint.db.tree_index import (
+    get_schema_index, topological_order, CycleError, join_json_object, join_json_array
+)
+
+
+def _copy_data_set(relevant_data_set):
+    """复制相关数据集，缓存的数据不会被调用方原地修改"""
+    return {node_name: data.copy() for node_name, data in relevant_data_set.items()}
+
+
+def get_pool_capacity(engine):
+    """
+    获取连接池中不需要等待即可取出的连接数
+
+    Args:
+        engine: 数据库引擎
+
+    Returns:
+        int: 空闲连接数加上还能新建的溢出连接数，连接池没有上限时返回None
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+        return None
+    return max(pool.size() + pool._max_overflow - pool.checkedout(), 0)
 
 
 # @profile_line_by_line
@@ -66,6 +101,9 @@ def get_booking_sequence(cst_pki, root_nodes=None):
     
     Returns:
         list: 表的录入顺序
+
+    Raises:
+        CycleError: 表之间存在循环引用
     """
     relation_info = cst_pki[['TABLE_NAME', 'REFERENCED_TABLE_NAME']].values.tolist()
     if root_nodes is not None:
@@ -82,19 +120,199 @@ def get_booking_sequence(cst_pki, root_nodes=None):
             cst_pki['REFERENCED_TABLE_NAME'].isin(related_tables)
         ].replace(np.nan, None)[['TABLE_NAME', 'REFERENCED_TABLE_NAME']].values.tolist()
 
-    booking_seq = topological_sort(relation_info=relation_info)
+    booking_seq = topological_order(relation_info=relation_info)
 
     return booking_seq
 
 
+def get_select_columns_str(columns=None):
+    """
+    生成SELECT子句中的列
+
+    Args:
+        columns: 列名列表，为None时查询所有列
+
+    Returns:
+        str: 列
+    """
+    if columns is None:
+        return '*'
+    return ', '.join([f'`{col}`' for col in columns])
+
+
+def get_select_in_queries(table_name, schema, conditions, chunk_size=None, suffix='', columns=None,
+                          extra_where=None, extra_params=None):
+    """
+    生成按列取值的查询语句（使用绑定参数）
+
+    所有列的值个数之和不超过chunk_size时生成一条 `a` IN (...) OR `b` IN (...) 语句；
+    否则按列、按chunk_size拆分为多条只含一个IN条件的语句，每条都可以使用该列的索引，
+    结果合并后等同于UNION。
+
+    Args:
+        table_name: 表名
+        schema: 数据库模式
+        conditions: [(列名, 值集合)]
+        chunk_size: 每条语句最多包含的值个数，为None时使用配置tree_fetch_chunk_size，
+            为0时不拆分
+        suffix: 附加在语句末尾的内容（如limit/offset，仅在不拆分时使用）
+        columns: 查询的列名列表，为None时查询所有列
+        extra_where: 与IN条件同时满足的附加条件（如 `update_time` >= :watermark），
+            参数名不能以v加数字命名
+        extra_params: 附加条件的参数字典
+
+    Returns:
+        list: [(语句, 参数字典)]
+    """
+    if chunk_size is None:
+        chunk_size = TREE_FETCH_CHUNK_SIZE
+
+    conditions = [
+        (col, [value.item() if isinstance(value, np.generic) else value for value in values])
+        for col, values in conditions
+    ]
+    select_str = f'SELECT {get_select_columns_str(columns)} FROM {schema}.{table_name}'
+    extra_str = '' if extra_where is None else f' AND ({extra_where})'
+    extra_params = extra_params or {}
+
+    total = sum(len(values) for col, values in conditions)
+    if chunk_size <= 0 or total <= chunk_size:
+        where_str_list = []
+        params = dict(extra_params)
+        bind_params = []
+        for i, (col, values) in enumerate(conditions):
+            param_name = f'v{i}'
+            where_str_list.append(f'(`{col}` IN :{param_name})')
+            params[param_name] = values
+            bind_params.append(bindparam(param_name, expanding=True))
+        all_where_str = ' OR '.join(where_str_list)
+        stmt = text(f'{select_str} WHERE ({all_where_str}){extra_str} {suffix}').bindparams(*bind_params)
+        return [(stmt, params)]
+
+    queries = []
+    for col, values in conditions:
+        stmt = text(f'{select_str} WHERE `{col}` IN :v0{extra_str}').bindparams(
+            bindparam('v0', expanding=True)
+        )
+        for start in range(0, len(values), chunk_size):
+            queries.append((stmt, {**extra_params, 'v0': values[start: start + chunk_size]}))
+    return queries
+
+
+def read_select_in(con, queries, index_col='id'):
+    """
+    执行get_select_in_queries生成的查询语句并合并结果
+
+    多条语句的结果按索引去重并排序。
+
+    Args:
+        con: 数据库连接对象
+        queries: [(语句, 参数字典)]
+        index_col: 索引列名
+
+    Returns:
+        pd.DataFrame: 查询结果
+    """
+    res = [
+        pd.read_sql(sql=stmt, con=con, params=params, index_col=index_col)
+        for stmt, params in queries
+    ]
+    if len(res) == 1:
+        return res[0]
+    data = pd.concat(res)
+    data = data[~data.index.duplicated(keep='first')]
+    return data.sort_index()
+
+
+class _RootValue:
+    """根数据行中某列的值的占位符（用于DataTree.itertrees）"""
+
+    __slots__ = ('col',)
+
+    def __init__(self, col):
+        self.col = col
+
+
+def _expand_root_values(values, row):
+    """
+    将值集合中的根数据行占位符替换为该行对应列的值
+
+    Args:
+        values: 值集合
+        row: 根数据行 {列名: 值}
+
+    Returns:
+        list: 值列表
+    """
+    res = []
+    for value in values:
+        if isinstance(value, _RootValue):
+            value = row.get(value.col)
+            if pd.isna(value):
+                continue
+        res.append(value)
+    return res
+
+
+def get_isin_mask(series, values):
+    """
+    按值集合过滤的布尔掩码
+
+    值按类型比较（整数、字符串、日期均可）。数据列与值的类型不一致时
+    （如提交的字符串与数据库中的整数），再按字符串比较。
+
+    Args:
+        series: 数据列
+        values: 值集合
+
+    Returns:
+        np.ndarray: 布尔掩码
+    """
+    values = list(values)
+    if len(values) == 0 or len(series) == 0:
+        return np.zeros(len(series), dtype=bool)
+
+    mask = series.isin(values).to_numpy(dtype=bool, copy=True)
+
+    value_is_str = [isinstance(value, str) for value in values]
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        if any(value_is_str):
+            dates = pd.to_datetime(pd.Series(values), errors='coerce').dropna()
+            mask |= series.isin(dates).to_numpy(dtype=bool)
+    elif pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        if any(value_is_str):
+            mask |= _isin_as_str(series, values)
+    elif not all(value_is_str):
+        mask |= _isin_as_str(series, values)
+    return mask
+
+
+def _isin_as_str(series, values):
+    """
+    按字符串比较的isin掩码（空值不匹配）
+
+    Args:
+        series: 数据列
+        values: 值列表
+
+    Returns:
+        np.ndarray: 布尔掩码
+    """
+    str_values = set(str(value) for value in values if not pd.isna(value))
+    return (series.notna() & series.astype(str).isin(str_values)).to_numpy(dtype=bool)
+
 class Tree(JsonObj):
     """
     基础树形结构类
     
     用于表示数据库表之间的层级关系，支持父子关系的管理
     和拓扑排序等功能。
+
+    父子关系、录入顺序等结构信息保存在按元数据版本共享的表关系索引中，
+    节点本身只保存少量属性。父节点和子节点在首次访问时才创建，同一棵树中
+    (表名, 引用列, 被引用列, 节点类型) 相同的节点只创建一次并被共享。
     """
-    
+
     def __init__(
             self,
             con,
@@ -105,6 +323,8 @@ class Tree(JsonObj):
             reffed=None,
             is_parent=False,
             parent_root=None,
+            schema_index=None,
+            forest=None,
     ):
         """
         初始化树形结构
@@ -118,6 +338,8 @@ class Tree(JsonObj):
             reffed: 被引用列名
             is_parent: 是否为父节点
             parent_root: 父根节点名
+            schema_index: 表关系索引，为None时按tables获取
+            forest: 同一棵树中共享的节点字典，为None时新建
         """
         if tree:
             # 如果提供了现有树对象，直接复制其属性
@@ -127,81 +349,126 @@ class Tree(JsonObj):
             self.reffed = tree.reffed
             self.table = tree.table
             self.tables = tree.tables
-            self.parents = tree.parents
-            self.children = tree.children
-            self.node_names = tree.node_names
-            self.booking_sequence = tree.booking_sequence
-            self.reading_sequence = tree.reading_sequence
+            self.schemas = tree.schemas
+            self._schema_index = tree._schema_index
+            self._node_key = tree._node_key
+            self._forest = tree._forest
+            self._parents = tree._parents
+            self._children = tree._children
             return
 
         # 初始化基本属性
+        if schema_index is None:
+            schema_index = get_schema_index(tables)
         self.con = con
         self.root = root
-        self.schemas = list(set([table.schema for table in tables.values()]))
+        self._schema_index = schema_index
+        self._node_key = (root, is_parent, parent_root)
+        self.schemas = list(schema_index.schemas)
         self.tables = tables
         self.table = tables[root]
         self.ref = ref
         self.reffed = reffed
-        self.parents = []
-        self.children = []
+        self._parents = None
+        self._children = None
 
         JsonObj.__init__(self)
 
-        # 处理父节点关系
-        ref_cols = [
-            col for col in self.table.cols if not pd.isna(col.foreign_key)
-        ]
+        if forest is None:
+            forest = {}
+            # 新建的树在此处检查循环引用
+            schema_index.booking_sequence(*self._node_key)
+        self._forest = forest
 
-        for ref_col in ref_cols:
-            fk = ref_col.foreign_key
-            col_parent_root = fk.split('.')[1]
-            if col_parent_root == parent_root:
-                continue
-            ref = ref_col.col_name
-            reffed = fk.split('.')[2]
+    def _get_node(self, root, ref, reffed, is_parent, parent_root):
+        """
+        获取同一棵树中共享的节点，不存在时创建
 
-            parent = Tree(
-                con=con,
-                tables=self.tables,
-                root=col_parent_root,
-                ref=ref,
-                reffed=reffed,
-                is_parent=True
-            )
-            self.parents.append(parent)
-
-        # 处理子节点关系
-        if not is_parent:
-            reffed_table_and_cols = []
-            for child_root, table_obj in tables.items():
-                if child_root != self.root:
-                    for col_obj in table_obj.cols:
-                        fk = col_obj.foreign_key
-                        if not pd.isna(fk):
-                            schema, reffed_table_name, reffed = fk.split('.')
-                            if reffed_table_name == self.root:
-                                reffed_table_and_cols.append((child_root, col_obj.col_name, reffed))
-            for child_root, ref, reffed in reffed_table_and_cols:
-                child = Tree(
-                    con=con,
-                    tables=self.tables,
-                    root=child_root,
-                    ref=ref,
-                    reffed=reffed,
-                    parent_root=self.root
+        Args:
+            root: 节点表名
+            ref: 引用列名
+            reffed: 被引用列名
+            is_parent: 是否为父节点
+            parent_root: 父根节点名
+
+        Returns:
+            Tree: 节点对象
+        """
+        key = (root, ref, reffed, is_parent, parent_root)
+        try:
+            return self._forest[key]
+        except KeyError:
+            pass
+        node = Tree(
+            con=self.con,
+            tables=self.tables,
+            root=root,
+            ref=ref,
+            reffed=reffed,
+            is_parent=is_parent,
+            parent_root=parent_root,
+            schema_index=self._schema_index,
+            forest=self._forest
+        )
+        self._forest[key] = node
+        return node
+
+    @property
+    def parents(self):
+        """父节点列表（按表顺序排序）"""
+        if self._parents is None:
+            parent_root = self._node_key[2]
+            self._parents = [
+                self._get_node(
+                    root=edge.table,
+                    ref=edge.ref,
+                    reffed=edge.reffed,
+                    is_parent=True,
+                    parent_root=None
                 )
-                self.children.append(child)
+                for edge in self._schema_index.parents_by_table[self.root]
+                if edge.table != parent_root
+            ]
+        return self._parents
 
-        # 按表顺序排序父节点和子节点
-        self.parents.sort(key=lambda x: self.tables[x.root].order)
-        self.children.sort(key=lambda x: self.tables[x.root].order)
+    @property
+    def children(self):
+        """子节点列表（按表顺序排序），父节点没有子节点"""
+        if self._children is None:
+            if self._node_key[1]:
+                self._children = []
+            else:
+                self._children = [
+                    self._get_node(
+                        root=edge.table,
+                        ref=edge.ref,
+                        reffed=edge.reffed,
+                        is_parent=False,
+                        parent_root=self.root
+                    )
+                    for edge in self._schema_index.children_by_table[self.root]
+                ]
+        return self._children
 
-        # 生成录入顺序和读取序列
-        self.booking_sequence = self.get_booking_sequence()
-        self.reading_sequence = [item for item in self.booking_sequence.__reversed__()]
+    @property
+    def booking_sequence(self):
+        """录入顺序"""
+        return self.get_booking_sequence()
+
+    @property
+    def reading_sequence(self):
+        """读取顺序（录入顺序的逆序）"""
+        return list(self._schema_index.reading_sequence(*self._node_key))
 
-        self.node_names = self.get_node_names()
-        # self.sort_cols()
+    @property
+    def node_names(self):
+        """所有节点名称"""
+        return self.get_node_names()
+
+    @property
+    def node_spec(self):
+        """节点标识：(表名, 引用列, 被引用列, 是否为父节点, 父根节点名)"""
+        return (self.root, self.ref, self.reffed) + self._node_key[1:]
 
     def __bool__(self):
         """判断树是否有效"""
@@ -212,19 +479,19 @@ class Tree(JsonObj):
 
     def __gt__(self, other):
         """判断当前节点是否为其他节点的祖先"""
-        return self.root in [p for p in other.all_parenthood_names()]
+        return self.root in other.parenthood_names
 
     def __lt__(self, other):
         """判断当前节点是否为其他节点的后代"""
-        return self.root in [c for c in other.all_childhood_names()]
+        return self.root in other.childhood_names
 
     def __ge__(self, other):
         """判断当前节点是否为其他节点的祖先或等于其他节点"""
-        return self.root in [p for p in other.all_parenthood_names()] or self.root == other.root
+        return self.root in other.parenthood_names or self.root == other.root
 
     def __le__(self, other):
         """判断当前节点是否为其他节点的后代或等于其他节点"""
-        return self.root in [c for c in other.all_childhood_names()] or self.root == other.root
+        return self.root in other.childhood_names or self.root == other.root
 
     def __eq__(self, other):
         """判断两个节点是否相等"""
@@ -233,19 +500,26 @@ class Tree(JsonObj):
     def get_booking_sequence(self):
         """
         获取录入顺序（拓扑排序）
-        
+
+        由表关系索引按节点计算并缓存，耗时与树的节点数成线性关系。
+
         Returns:
             list: 包含所有相关表的录入顺序
+
+        Raises:
+            CycleError: 树中存在循环引用
         """
-        res = sum([
-            p.get_booking_sequence() for p in self.parents
-        ], start=[]) + [
-            self.root
-        ] + sum([
-            c.get_booking_sequence() for c in self.children
-        ], start=[])
+        return list(self._schema_index.booking_sequence(*self._node_key))
 
-        return [item for i, item in enumerate(res) if item not in res[:i]]
+    @property
+    def parenthood_names(self):
+        """祖先节点名称闭包（不可变集合，按元数据版本缓存）"""
+        return self._schema_index.parenthood_names(*self._node_key)
+
+    @property
+    def childhood_names(self):
+        """后代节点名称闭包（不可变集合，按元数据版本缓存）"""
+        return self._schema_index.childhood_names(*self._node_key)
 
     def all_parenthood_names(self):
         """
@@ -254,12 +528,7 @@ class Tree(JsonObj):
         Returns:
             set: 祖先节点名称集合
         """
-        res = set([p.root for p in self.parents])
-        for p in self.parents:
-            res |= p.all_parenthood_names()
-        for c in self.children:
-            res |= c.all_parenthood_names()
-        return res
+        return set(self.parenthood_names)
 
     def all_childhood_names(self):
         """
@@ -268,10 +537,7 @@ class Tree(JsonObj):
         Returns:
             set: 后代节点名称集合
         """
-        res = set([c.root for c in self.children])
-        for c in self.children:
-            res |= c.all_childhood_names()
-        return res
+        return set(self.childhood_names)
 
     def get_child_path(self, child_root: str):
         """
@@ -287,8 +553,9 @@ class Tree(JsonObj):
         for c in self.children:
             if c.root == child_root:
                 return [self.root, c.root]
-
-            res.extend(c.get_child_path(child_root=child_root))
+            # 只进入后代中包含目标节点的分支
+            if child_root in c.childhood_names:
+                res.extend(c.get_child_path(child_root=child_root))
         if len(res) > 0:
             res = [self.root] + res
 
@@ -301,11 +568,13 @@ class Tree(JsonObj):
         Returns:
             dict: 树的JSON表示
         """
-        json_obj = self.to_json_obj_raw(
-            include_attrs=['root', 'ref', 'reffed', 'parents', 'children']
-        )
-        json_obj['parents'] = []
-        json_obj['children'] = []
+        json_obj = {
+            'root': self.root,
+            'ref': self.ref,
+            'reffed': self.reffed,
+            'parents': [],
+            'children': [],
+        }
         for parent in self.parents:
             json_obj['parents'].append(parent.json_obj_base())
         for child in self.children:
@@ -313,10 +582,31 @@ class Tree(JsonObj):
         json_obj['table'] = self.table.to_json_obj()
         return json_obj
 
+    def _encode_json(self):
+        """
+        由父/子节点及表对象的JSON片段拼接本节点的JSON片段
+
+        Returns:
+            bytes: 与json_obj_base()相同结构的JSON
+        """
+        return join_json_object([
+            ('root', json.dumps(self.root, ensure_ascii=False).encode('utf-8')),
+            ('ref', json.dumps(self.ref, ensure_ascii=False).encode('utf-8')),
+            ('reffed', json.dumps(self.reffed, ensure_ascii=False).encode('utf-8')),
+            ('parents', join_json_array([parent.json_bytes for parent in self.parents])),
+            ('children', join_json_array([child.json_bytes for child in self.children])),
+            ('table', self._schema_index.table_json(self.table)),
+        ])
+
+    @property
+    def json_bytes(self):
+        """编码后的JSON表示（按元数据版本缓存）"""
+        return self._schema_index.tree_json(self.node_spec, self._encode_json)
+
     @property
     def json_obj(self):
         """获取JSON对象表示"""
-        return self.json_obj_base()
+        return json.loads(self.json_bytes)
 
     def p_(self, p_name, ref=None):
         """
@@ -392,14 +682,23 @@ class Tree(JsonObj):
         """
         if not res:
             res = {self.root: self}
-        for p in self.parents:
-            if p.root not in list(res.keys()):
-                res[p.root] = p
-                res.update(p.get_all_nodes(res=res))
-        for c in self.children:
-            if c.root not in list(res.keys()):
-                res[c.root] = c
-            res.update(c.get_all_nodes(res=res))
+        walked = set()
+
+        def walk(node):
+            # 同一节点的子树已遍历过时不会再产生新的节点
+            if node._node_key in walked:
+                return
+            walked.add(node._node_key)
+            for p in node.parents:
+                if p.root not in res:
+                    res[p.root] = p
+                    walk(p)
+            for c in node.children:
+                if c.root not in res:
+                    res[c.root] = c
+                walk(c)
+
+        walk(self)
         return res
 
     def get_all_parents(self, res=None):
@@ -414,12 +713,20 @@ class Tree(JsonObj):
         """
         if not res:
             res = {}
-        for p in self.parents:
-            if p.root not in list(res.keys()):
-                res[p.root] = p
-                res.update(p.get_all_parents(res=res))
-        for c in self.children:
-            res.update(c.get_all_parents(res=res))
+        walked = set()
+
+        def walk(node):
+            if node._node_key in walked:
+                return
+            walked.add(node._node_key)
+            for p in node.parents:
+                if p.root not in res:
+                    res[p.root] = p
+                    walk(p)
+            for c in node.children:
+                walk(c)
+
+        walk(self)
         return res
 
     def get_node_names(self):
@@ -429,12 +736,7 @@ class Tree(JsonObj):
         Returns:
             set: 节点名称集合
         """
-        res = {self.root}
-        for parent in self.parents:
-            res |= parent.node_names
-        for child in self.children:
-            res |= child.node_names
-        return res
+        return set(self._schema_index.node_names(*self._node_key))
 
     def get_parent_tree_structure(self):
         """
@@ -500,6 +802,10 @@ class DataTree(Tree):
             reffed=reffed,
         )
 
+        # from_sql的加载参数、水位及各表已查询的条件，用于增量刷新
+        self._load_state = None
+        self._coverage = {}
+
         # 初始化数据
         if relevant_data_set is None:
             relevant_data_set = dict(zip(
@@ -513,6 +819,60 @@ class DataTree(Tree):
             self.data = pd.DataFrame(columns=[col.col_name for col in self.table.cols])
         self.relevant_data_set = relevant_data_set
 
+    @property
+    def data(self):
+        """根表数据"""
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.clear_nav_cache()
+
+    @property
+    def relevant_data_set(self):
+        """相关数据集 {表名: 数据}"""
+        return self._relevant_data_set
+
+    @relevant_data_set.setter
+    def relevant_data_set(self, value):
+        self._relevant_data_set = value
+        self.clear_nav_cache()
+
+    def clear_nav_cache(self):
+        """
+        清空父/子节点数据树的缓存
+
+        重新赋值data或relevant_data_set时自动清空；
+        直接修改relevant_data_set中的数据后需要手动调用。
+        """
+        self._nav_cache = {}
+
+    def _get_nav_tree(self, tree):
+        """
+        获取父/子节点的数据树（按节点缓存）
+
+        Args:
+            tree: 父/子节点
+
+        Returns:
+            DataTree: 由本树的相关数据集过滤得到的数据树
+        """
+        key = tree.node_spec
+        try:
+            return self._nav_cache[key]
+        except KeyError:
+            pass
+        nav_tree = DataTree(
+            con=self.con,
+            tables=self.tables,
+            tree=tree,
+            relevant_data_set={}
+        )
+        nav_tree.from_relevant_data_set(self.relevant_data_set)
+        self._nav_cache[key] = nav_tree
+        return nav_tree
+
     def __len__(self):
         """返回数据行数"""
         return len(self.data)
@@ -537,23 +897,133 @@ class DataTree(Tree):
 
     def itertrees(self):
         """
-        迭代树结构
+        迭代树结构，每行根数据生成一个数据树
+
+        相关表的值只由根数据行和未过滤的相关表数据决定（见from_relevant_data_set），
+        因此先用占位的根数据行计算一次各表的过滤条件，再为各表的过滤列建立
+        {值: 行位置} 分组索引，每行只需按根数据行的值查找行位置，不复制整个相关数据集。
+        与该行无关的表在各数据树之间共享同一个DataFrame。
         
         Yields:
             tuple: (索引, DataTree对象)
         """
-        for i, row in self.iterrows():
-            relevant_data_set = deepcopy(self.relevant_data_set)
-            relevant_data_set[self.root] = row.to_frame().transpose()
+        root_columns = list(self.data.columns)
+        root_marker = pd.DataFrame(
+            [[_RootValue(col) for col in root_columns]],
+            columns=root_columns
+        )
+        marker_data_set = copy(self.relevant_data_set)
+        marker_data_set[self.root] = root_marker
+        steps = self._get_filter_steps(marker_data_set, root_marker)
+
+        # 预先计算各表与根数据行无关的部分
+        plans = []
+        for node_name, conditions in steps:
+            if conditions is None:
+                plans.append((node_name, 'fixed', pd.DataFrame(
+                    columns=[col.col_name for col in self.tables[node_name].cols]
+                )))
+                continue
+            if node_name == self.root:
+                plans.append((node_name, 'root', conditions))
+                continue
+
+            data = self.relevant_data_set[node_name]
+            static_mask = np.zeros(len(data), dtype=bool)
+            lookups = []
+            for col, values in conditions:
+                static_values = [v for v in values if not isinstance(v, _RootValue)]
+                root_cols = [v.col for v in values if isinstance(v, _RootValue)]
+                if len(static_values) > 0:
+                    static_mask |= get_isin_mask(data[col], static_values)
+                if len(root_cols) > 0:
+                    lookups.append((root_cols, data.groupby(col, sort=False).indices))
+            static_positions = np.flatnonzero(static_mask)
+            if len(lookups) == 0:
+                plans.append((node_name, 'fixed', data.take(static_positions)))
+            else:
+                plans.append((node_name, 'lookup', (data, static_positions, lookups)))
+
+        root_values = {col: self.data[col].to_numpy() for col in root_columns}
+        for pos, i in enumerate(self.data.index):
+            row = {col: root_values[col][pos] for col in root_columns}
+            root_data = self.data.iloc[[pos]]
+            relevant_data_set = copy(self.relevant_data_set)
+            relevant_data_set[self.root] = root_data
+
+            for node_name, kind, plan in plans:
+                if kind == 'fixed':
+                    relevant_data_set[node_name] = plan
+                elif kind == 'root':
+                    keep = False
+                    for col, values in plan:
+                        values = set(_expand_root_values(values, row))
+                        keep = keep or row.get(col) in values
+                    if not keep:
+                        relevant_data_set[node_name] = root_data.iloc[[]]
+                else:
+                    data, static_positions, lookups = plan
+                    positions = [static_positions]
+                    for root_cols, indices in lookups:
+                        for root_col in root_cols:
+                            value = row[root_col]
+                            if pd.isna(value):
+                                continue
+                            found = indices.get(value)
+                            if found is not None:
+                                positions.append(found)
+                    relevant_data_set[node_name] = data.take(np.unique(np.concatenate(positions)))
+
             datatree = DataTree(
                 con=self.con,
                 tables=self.tables,
                 tree=self,
-                relevant_data_set={}
+                relevant_data_set=relevant_data_set
             )
-            datatree.from_relevant_data_set(relevant_data_set)
+            datatree.data = root_data
             yield i, datatree
 
+    def _get_filter_steps(self, relevant_data_set, root_data):
+        """
+        按读取顺序计算各表的过滤条件
+
+        相关表的值由未过滤的相关表数据传播，过滤条件不依赖其他表的过滤结果。
+
+        Args:
+            relevant_data_set: 相关数据集字典
+            root_data: 根数据
+
+        Returns:
+            list: [(表名, 过滤条件)]，过滤条件为[(列名, 值集合)]，
+                为None时表示相关数据集中没有该表；不需要过滤的表不包含在内
+        """
+        values_map = self.update_values_map(
+            values_map={},
+            tree=self,
+            root_data=root_data
+        )
+
+        steps = []
+        for node_name in self.reading_sequence:
+            if node_name not in relevant_data_set:
+                steps.append((node_name, None))
+                continue
+            if node_name not in values_map:
+                continue
+            steps.append((node_name, [
+                (col, tree_values['values'])
+                for col, tree_values in values_map[node_name].items()
+            ]))
+
+            data = relevant_data_set[node_name]
+            for col, tree_values in values_map[node_name].items():
+                values_map = self.update_values_map(
+                    values_map=values_map,
+                    tree=tree_values['tree'],
+                    root_data=data
+                )
+        return steps
+
     @staticmethod
     def update_values_map(values_map, tree, root_data):
         """
@@ -606,39 +1076,77 @@ class DataTree(Tree):
         return values_map
 
     def fill_na_with_none(self):
-        """将NaN值替换为None"""
-        relevant_data_set_copy = deepcopy(self.relevant_data_set)
-        for name, df in relevant_data_set_copy.items():
-            df = df.fillna(np.nan).replace([np.nan], [None])
-            self.relevant_data_set[name] = df
+        """将NaN值替换为None（replace返回新的DataFrame，不修改原数据，无需先深拷贝）"""
+        for name, df in list(self.relevant_data_set.items()):
+            self.relevant_data_set[name] = df.fillna(np.nan).replace([np.nan], [None])
+        self.clear_nav_cache()
 
     def from_sql(
             self,
             index_col: str = None,
             index_values: Set[str] = None,
             limit=None,
-            offset=None
+            offset=None,
+            workers=None,
+            columns='all',
+            dtypes=None,
+            cache=True
     ):
         """
         从SQL查询加载数据
+
+        相关表按读取顺序查询，互不依赖的表在连接池的多个连接上同时查询，
+        查询结果与逐表顺序查询相同。
+
+        配置了tree_query_cache_size时，查询结果按（数据库、根节点、索引列、索引值、limit/offset、
+        查询列、类型转换、元数据版本）缓存，写入相关表后由invalidate_tables失效，见db/cache.py。
         
         Args:
             index_col: 索引列名
             index_values: 索引值集合
             limit: 限制行数
             offset: 偏移量
-        """
+            workers: 同时查询的最大线程数，为None时使用配置tree_fetch_workers
+            columns: 查询的列，见get_select_columns。遍历需要的主键、外键列总是被查询
+            dtypes: 类型转换规则，见get_dtype_options，为None时使用配置tree_dtypes
+            cache: 是否使用查询结果缓存
+        """
+        cache_key = None
+        if cache and QUERY_CACHE.maxsize > 0:
+            cache_key = self._get_cache_key(
+                index_col=index_col,
+                index_values=index_values,
+                limit=limit,
+                offset=offset,
+                columns=columns,
+                dtypes=dtypes
+            )
+        if cache_key is not None:
+            cached = QUERY_CACHE.get(cache_key)
+            if cached is not None:
+                relevant_data_set, load_state = cached
+                relevant_data_set = _copy_data_set(relevant_data_set)
+                self.data = relevant_data_set[self.root]
+                self.relevant_data_set = relevant_data_set
+                self._load_state = load_state
+                return
+
+        # 查询期间涉及的表被写入时，查询结果不写入缓存
+        cache_generation = QUERY_CACHE.generation()
+        load_args = {
+            'index_col': index_col,
+            'index_values': None if index_values is None else set(index_values),
+            'limit': limit,
+            'offset': offset,
+            'columns': columns,
+            'dtypes': dtypes,
+        }
+        watermark = self._get_db_time()
+
         # 查询根数据
         root_schema = self.table.schema
-        if index_col is None and index_values is None:
-            where_str = ''
-        else:
-            if index_col is None:
-                index_col = self.table.pk
-            if index_values is not None and len(index_values) == 0:
-                limit = 0
-            values_str = ', '.join([f'"{index_value}"' for index_value in index_values])
-            where_str = f'WHERE `{index_col}` in ({values_str})'
+        if index_values is not None and len(index_values) == 0:
+            limit = 0
 
         if limit is None:
             limit_str = ''
@@ -650,91 +1158,672 @@ class DataTree(Tree):
         else:
             offset_str = f'offset {str(offset)}'
 
-        sql = f'SELECT * FROM {root_schema}.{self.root} {where_str} {limit_str} {offset_str}'
-        root_data = pd.read_sql(sql=sql, con=self.con, index_col=self.table.pk)
+        if index_col is None and index_values is None:
+            where_str = ''
+            columns_str = get_select_columns_str(self.get_select_columns(self.root, columns))
+            sql = f'SELECT {columns_str} FROM {root_schema}.{self.root} {limit_str} {offset_str}'
+            root_data = pd.read_sql(sql=sql, con=self.con, index_col=self.table.pk)
+        else:
+            if index_col is None:
+                index_col = self.table.pk
+            where_str = f'WHERE `{index_col}` in (...)'
+            # 有limit/offset时不能拆分查询
+            if limit is None and offset is None:
+                chunk_size = None
+            else:
+                chunk_size = 0
+            queries = get_select_in_queries(
+                table_name=self.root,
+                schema=root_schema,
+                conditions=[(index_col, list(index_values))],
+                chunk_size=chunk_size,
+                suffix=f'{limit_str} {offset_str}',
+                columns=self.get_select_columns(self.root, columns)
+            )
+            root_data = read_select_in(con=self.con, queries=queries, index_col=self.table.pk)
+        root_data = self.apply_dtypes(self.root, root_data, dtypes=dtypes)
+
         if len(root_data) == 0:
             print(f'empty result for root: "{self.root}" \n'
                   f'with index col: "{where_str}" \n'
                   f'with values in {index_values}')
-            relevant_data_set = dict(zip(
+
+        self.from_root_data(root_data=root_data, workers=workers, columns=columns, dtypes=dtypes)
+        self._load_state = {'args': load_args, 'watermark': watermark, 'coverage': self._coverage}
+
+        if cache_key is not None:
+            QUERY_CACHE.put(
+                cache_key,
+                (_copy_data_set(self.relevant_data_set), self._load_state),
+                tables=set(self.node_names) | set(self.relevant_data_set),
+                generation=cache_generation
+            )
+
+    def _get_cache_key(self, index_col=None, index_values=None, limit=None, offset=None,
+                       columns='all', dtypes=None):
+        """
+        获取from_sql查询结果的缓存键
+
+        Args:
+            index_col: 索引列名
+            index_values: 索引值集合
+            limit: 限制行数
+            offset: 偏移量
+            columns: 查询列的规则
+            dtypes: 类型转换规则
+
+        Returns:
+            tuple: 缓存键，无法确定数据库（连接没有engine）时返回None
+        """
+        engine = getattr(self.con, 'engine', None)
+        if engine is None:
+            return None
+        if index_values is not None:
+            index_values = frozenset(index_values)
+        if dtypes is None:
+            dtypes = TREE_DTYPES
+        return (
+            str(engine.url),
+            self.node_spec,
+            index_col,
+            index_values,
+            limit,
+            offset,
+            freeze(columns),
+            freeze(dtypes),
+            self._schema_index.version,
+        )
+
+    def from_root_data(self, root_data, workers=None, columns='all', dtypes=None):
+        """
+        由根表数据查询相关表数据
+
+        Args:
+            root_data: 根表数据（以主键为索引）
+            workers: 同时查询的最大线程数，为None时使用配置tree_fetch_workers
+            columns: 查询列的规则，见get_select_columns
+            dtypes: 类型转换规则，见get_dtype_options，为None时使用配置tree_dtypes
+        """
+        coverage = {}
+        with self._node_fetcher(workers=workers, columns=columns, dtypes=dtypes) as fetch:
+            relevant_data_set = self._read_relevant_data(
+                root_data=root_data,
+                fetch=self._recording_fetch(fetch, coverage)
+            )
+
+        self._load_state = None
+        self._coverage = coverage
+        self.data = relevant_data_set[self.root]
+        self.relevant_data_set = relevant_data_set
+
+    def _read_relevant_data(self, root_data, fetch):
+        """
+        由根表数据按读取顺序获取相关表数据
+
+        Args:
+            root_data: 根表数据（以主键为索引）
+            fetch: 查询函数，见_node_fetcher
+
+        Returns:
+            dict: 相关数据集 {表名: 数据}
+        """
+        if len(root_data) == 0:
+            return dict(zip(
                 self.node_names,
                 [pd.DataFrame(columns=[col.col_name for col in self.tables[node_name].cols])
                  for node_name in self.node_names]
             ))
-        else:
-            relevant_data_set = {self.root: root_data}
 
-            values_map = self.update_values_map(
-                values_map={},
-                tree=self,
-                root_data=root_data
-            )
+        relevant_data_set = {self.root: root_data}
 
-            # 查询相关数据
-            reading_seq = list(self.reading_sequence)
-            reading_seq.remove(self.root)
+        values_map = self.update_values_map(
+            values_map={},
+            tree=self,
+            root_data=root_data
+        )
 
-            for node_name in reading_seq:
-                where_str_list = []
-                if node_name not in values_map:
-                    continue
-                for col, tree_values in values_map[node_name].items():
-                    values = tree_values['values']
+        # 查询相关数据
+        reading_seq = list(self.reading_sequence)
+        reading_seq.remove(self.root)
 
-                    # 该列没有值
-                    if len(values) == 0:
-                        continue
+        values_map = self._fetch_reading_sequence(
+            fetch=fetch,
+            reading_seq=reading_seq,
+            values_map=values_map,
+            relevant_data_set=relevant_data_set
+        )
 
-                    values_str = ', '.join(['"%s"' % value.replace('%', '%%') for value in values])
-                    where_str = f'(`{col}` in ({values_str}))'
-                    where_str_list.append(where_str)
+        # 不在录入顺序中的表，查询结果不再影响值映射，可以同时查询
+        futures = []
+        for node_name, value_map in values_map.items():
+            if node_name not in relevant_data_set:
+                conditions = self._get_values_conditions(value_map)
 
                 # 该表没有值
-                if len(where_str_list) == 0:
+                if len(conditions) == 0:
                     continue
+                futures.append((node_name, fetch(node_name, conditions)))
+        for node_name, future in futures:
+            relevant_data_set[node_name] = future.result()
 
-                all_where_str = ' or '.join(where_str_list)
+        return relevant_data_set
 
-                sql = f'SELECT * FROM {self.tables[node_name].schema}.{node_name} WHERE {all_where_str}'
-                data = pd.read_sql(sql=sql, con=self.con, index_col='id')
-                relevant_data_set[node_name] = data
+    @staticmethod
+    def _recording_fetch(fetch, coverage):
+        """
+        记录每张表实际查询条件的查询函数
 
-                for col, tree_values in values_map[node_name].items():
-                    values_map = self.update_values_map(
-                        values_map=values_map,
-                        tree=tree_values['tree'],
-                        root_data=data
-                    )
+        Args:
+            fetch: 查询函数，见_node_fetcher
+            coverage: 记录查询条件的字典 {表名: {列名: 值集合}}（结果写入其中）
 
-            for node_name, value_map in values_map.items():
-                if node_name not in relevant_data_set:
-                    where_str_list = []
-                    for col, tree_values in values_map[node_name].items():
-                        values = tree_values['values']
+        Returns:
+            function: 与fetch用法相同的查询函数
+        """
+        def recording_fetch(node_name, conditions):
+            node_coverage = coverage.setdefault(node_name, {})
+            for col, values in conditions:
+                node_coverage[col] = node_coverage.get(col, set()) | set(values)
+            return fetch(node_name, conditions)
+
+        return recording_fetch
+
+    def _get_db_time(self):
+        """
+        获取数据库的当前时间，作为增量刷新的水位
 
-                        # 该列没有值
-                        if len(values) == 0:
-                            continue
+        Returns:
+            数据库的当前时间
+        """
+        return self.con.execute(text('SELECT CURRENT_TIMESTAMP')).scalar()
 
-                        values_str = ', '.join(['"%s"' % value.replace('%', '%%') for value in values])
-                        where_str = f'(`{col}` in ({values_str}))'
-                        where_str_list.append(where_str)
+    def refresh(self, workers=None):
+        """
+        增量刷新由from_sql加载的数据
 
-                    # 该表没有值
-                    if len(where_str_list) == 0:
-                        continue
-                    all_where_str = ' or '.join(where_str_list)
+        只查询上次加载以来update_time有变化（包括新增）的行，以及已加载行中被删除的id，
+        变化的行限定在上次的查询条件和已加载的id内（见_get_changed_conditions），
+        合并到已加载的数据后按读取顺序重新遍历：上次已查询过的值直接从合并后的数据中取，
+        新关联的值才查询数据库。刷新后的结果与重新调用from_sql相同，
+        前提是所有写入都会更新update_time（外键级联更新不会更新update_time）。
 
-                    sql = f'SELECT * FROM {self.tables[node_name].schema}.{node_name} WHERE {all_where_str}'
-                    data = pd.read_sql(sql=sql, con=self.con, index_col='id')
-                    relevant_data_set[node_name] = data
+        相关数据集原地更新，持有该字典的对象可以读到刷新后的数据。
+        有limit/offset时无法增量确定根数据，改为重新查询。
+
+        Args:
+            workers: 同时查询的最大线程数，为None时使用配置tree_fetch_workers
+
+        Returns:
+            dict: 每张表的刷新统计 {表名: {'changed': 变化的行数, 'deleted': 删除的行数,
+                'fetched': 新关联而查询的行数}}，重新查询时返回None
+        """
+        state = self._load_state
+        if state is None:
+            print('refresh requires data loaded by from_sql')
+            raise ValueError
+
+        args = state['args']
+        if args['limit'] is not None or args['offset'] is not None:
+            self.from_sql(workers=workers, cache=False, **args)
+            return None
+
+        columns = args['columns']
+        dtypes = args['dtypes']
+        watermark = self._get_db_time()
+        report = {}
+
+        # 合并上次加载以来的变化
+        store = {}
+        for node_name in [self.root] + [t for t in state['coverage'] if t != self.root]:
+            data = self.relevant_data_set.get(node_name)
+            changed = self._read_changed(
+                node_name,
+                state['watermark'],
+                conditions=self._get_changed_conditions(node_name, data, state),
+                columns=columns,
+                dtypes=dtypes
+            )
+            deleted = 0
+            if data is not None and len(data) > 0:
+                queries = get_select_in_queries(
+                    table_name=node_name,
+                    schema=self.tables[node_name].schema,
+                    conditions=[('id', data.index.tolist())],
+                    columns=['id']
+                )
+                existing = read_select_in(con=self.con, queries=queries, index_col='id').index
+                kept = data.index.isin(existing)
+                deleted = int((~kept).sum())
+                data = data[kept & ~data.index.isin(changed.index)]
+                if len(changed) > 0:
+                    data = pd.concat([data, changed]).sort_index()
+            else:
+                data = changed.sort_index()
+            store[node_name] = data
+            report[node_name] = {'changed': len(changed), 'deleted': deleted, 'fetched': 0}
+
+        # 根数据
+        root_data = store[self.root]
+        index_col = args['index_col']
+        index_values = args['index_values']
+        if index_values is not None:
+            if len(index_values) == 0:
+                root_data = root_data.iloc[:0]
+            elif index_col is None or index_col == self.table.pk:
+                root_data = root_data[get_isin_mask(root_data.index.to_series(), index_values)]
+            else:
+                root_data = root_data[get_isin_mask(root_data[index_col], index_values)]
+
+        with self._node_fetcher(workers=workers, columns=columns, dtypes=dtypes) as fetch:
+            def fetch_merged(node_name, conditions):
+                report.setdefault(node_name, {'changed': 0, 'deleted': 0, 'fetched': 0})
+
+                # 上次没有查询过该表
+                if node_name not in store:
+                    future = fetch(node_name, conditions)
+                    report[node_name]['fetched'] += len(future.result())
+                    return future
+
+                node_coverage = state['coverage'].get(node_name, {})
+                missing = []
+                for col, values in conditions:
+                    covered = node_coverage.get(col, set())
+                    missing_values = [value for value in values if value not in covered]
+                    if len(missing_values) > 0:
+                        missing.append((col, missing_values))
+
+                data = store[node_name]
+                mask = np.zeros(len(data), dtype=bool)
+                for col, values in conditions:
+                    mask |= get_isin_mask(data[col], values)
+                data = data[mask]
+
+                # 新关联的值
+                if len(missing) > 0:
+                    fetched = fetch(node_name, missing).result()
+                    fetched = fetched[~fetched.index.isin(data.index)]
+                    report[node_name]['fetched'] += len(fetched)
+                    if len(fetched) > 0:
+                        data = pd.concat([data, fetched]).sort_index()
+
+                future = Future()
+                future.set_result(data)
+                return future
+
+            coverage = {}
+            relevant_data_set = self._read_relevant_data(
+                root_data=root_data,
+                fetch=self._recording_fetch(fetch_merged, coverage)
+            )
 
+        self._relevant_data_set.clear()
+        self._relevant_data_set.update(relevant_data_set)
         self.data = relevant_data_set[self.root]
-        self.relevant_data_set = relevant_data_set
+        self._load_state = {'args': args, 'watermark': watermark, 'coverage': coverage}
+        return report
+
+    def _get_changed_conditions(self, node_name, data, state):
+        """
+        增量刷新时查询某张表变化的行所用的条件
+
+        由上次加载的查询条件和已加载的id组成：新增或改为关联到已加载数据的行满足上次的查询条件，
+        改为不再关联的行在已加载的id中；其余的行与已加载的数据无关，新关联的值刷新时另行查询。
+        根表加载时没有指定index_values（查询整张表）时返回None，此时只能按update_time扫描，
+        数据量大时需要在该表的update_time列上建立索引。
+
+        Args:
+            node_name: 表名
+            data: 该表已加载的数据（以id为索引），可以为None
+            state: 加载状态，见from_sql
+
+        Returns:
+            list: [(列名, 值列表)]，或None
+        """
+        if node_name == self.root:
+            args = state['args']
+            if args['index_values'] is None:
+                return None
+            coverage = {args['index_col'] or self.table.pk: set(args['index_values'])}
+        else:
+            coverage = state['coverage'].get(node_name, {})
+
+        conditions = [
+            (col, list(values))
+            for col, values in coverage.items()
+            if len(values) > 0
+        ]
+        if data is not None and len(data) > 0:
+            conditions.append(('id', data.index.tolist()))
+        if len(conditions) == 0:
+            conditions = [('id', [])]
+        return conditions
+
+    def _read_changed(self, node_name, watermark, conditions=None, columns='all', dtypes=None):
+        """
+        查询某张表update_time不早于水位的行
+
+        Args:
+            node_name: 表名
+            watermark: 水位（上次加载时数据库的当前时间）
+            conditions: [(列名, 值列表)]，满足其中之一的行才查询，为None时查询整张表
+                （按update_time扫描，需要update_time列上的索引）
+            columns: 查询列的规则，见get_select_columns
+            dtypes: 类型转换规则，见get_dtype_options
+
+        Returns:
+            pd.DataFrame: 查询结果（以id为索引）
+        """
+        select_columns = self.get_select_columns(node_name, columns)
+        schema = self.tables[node_name].schema
+        if conditions is None:
+            sql = text(
+                f'SELECT {get_select_columns_str(select_columns)} FROM {schema}.{node_name} '
+                f'WHERE `update_time` >= :watermark'
+            )
+            data = pd.read_sql(sql=sql, con=self.con, params={'watermark': watermark}, index_col='id')
+        else:
+            queries = get_select_in_queries(
+                table_name=node_name,
+                schema=schema,
+                conditions=conditions,
+                columns=select_columns,
+                extra_where='`update_time` >= :watermark',
+                extra_params={'watermark': watermark}
+            )
+            data = read_select_in(con=self.con, queries=queries, index_col='id')
+        return self.apply_dtypes(node_name, data, dtypes=dtypes)
+
+    def iter_batches(self, batch_size=1000, order_by='id', workers=None, columns='all', dtypes=None):
+        """
+        按键值分页逐批读取根表数据，每批生成一个加载了相关数据的数据树
+
+        每批按 order_by > 上一批最后的值 查询，不使用offset，
+        内存占用只与每批的数据量有关。
+
+        Args:
+            batch_size: 每批根表数据的行数
+            order_by: 分页使用的列，必须唯一且非空
+            workers: 同时查询的最大线程数，为None时使用配置tree_fetch_workers
+            columns: 查询列的规则，见get_select_columns
+            dtypes: 类型转换规则，见get_dtype_options，为None时使用配置tree_dtypes
+
+        Yields:
+            DataTree: 每批的数据树
+        """
+        select_columns = self.get_select_columns(self.root, columns)
+        if select_columns is not None and order_by not in select_columns:
+            select_columns = select_columns + [order_by]
+        select_str = (
+            f'SELECT {get_select_columns_str(select_columns)} '
+            f'FROM {self.table.schema}.{self.root}'
+        )
+        order_str = f'ORDER BY `{order_by}` LIMIT {int(batch_size)}'
+
+        last_value = None
+        while True:
+            if last_value is None:
+                stmt = text(f'{select_str} {order_str}')
+                params = {}
+            else:
+                stmt = text(f'{select_str} WHERE `{order_by}` > :last_value {order_str}')
+                params = {'last_value': last_value}
+            root_data = pd.read_sql(sql=stmt, con=self.con, params=params)
+            if len(root_data) == 0:
+                return
+
+            last_value = root_data[order_by].iloc[-1]
+            if isinstance(last_value, np.generic):
+                last_value = last_value.item()
+            root_data = self.apply_dtypes(self.root, root_data.set_index(self.table.pk), dtypes=dtypes)
+
+            batch = DataTree(tree=self)
+            batch.from_root_data(root_data=root_data, workers=workers, columns=columns, dtypes=dtypes)
+            yield batch
+
+            if len(root_data) < batch_size:
+                return
+
+    @staticmethod
+    def _get_values_conditions(value_map):
+        """
+        由某张表的值映射生成查询条件
+
+        Args:
+            value_map: 值映射中该表的部分 {列名: {'tree': 树节点, 'values': 值集合}}
+
+        Returns:
+            list: [(列名, 值列表)]，没有值的列不包含在内
+        """
+        conditions = []
+        for col, tree_values in value_map.items():
+            values = tree_values['values']
+
+            # 该列没有值
+            if len(values) == 0:
+                continue
+
+            conditions.append((col, list(values)))
+        return conditions
+
+    def get_select_columns(self, node_name, columns='all'):
+        """
+        按查询列的规则获取某张表需要查询的列
+
+        Args:
+            node_name: 表名
+            columns: 查询列的规则
+                'all': 所有列
+                'web_visible': 网页可见的列
+                'keys': 只查询遍历需要的列
+                dict: {表名: 列名列表}，未指定的表查询所有列
+                除'all'外，遍历需要的列（id、主键、外键列及被引用的列）总是被查询
+
+        Returns:
+            list: 列名列表（按表的列顺序），查询所有列时返回None
+        """
+        if isinstance(columns, dict):
+            if node_name not in columns:
+                return None
+            selected = set(columns[node_name])
+        elif columns == 'all':
+            return None
+        elif columns == 'web_visible':
+            selected = set(col.col_name for col in self.tables[node_name].cols if col.web_visible == 1)
+        elif columns == 'keys':
+            selected = set()
+        else:
+            print(f'invalid columns: {columns}')
+            raise ValueError
+
+        key_columns = self._schema_index.key_columns_by_table[node_name]
+        res = [
+            col.col_name for col in self.tables[node_name].cols
+            if col.col_name in selected or col.col_name in key_columns
+        ]
+        if 'id' not in res:
+            res.insert(0, 'id')
+        return res
+
+    def apply_dtypes(self, node_name, data, dtypes=None):
+        """
+        按表结构中各列的data_type转换数据类型
+
+        Args:
+            node_name: 表名
+            data: 数据
+            dtypes: 类型转换规则，见get_dtype_options，为None时使用配置tree_dtypes
+
+        Returns:
+            pd.DataFrame: 转换后的数据
+        """
+        if dtypes is None:
+            dtypes = TREE_DTYPES
+        options = get_dtype_options(dtypes)
+        if options is None:
+            return data
+        return apply_dtype_map(data, get_dtype_map(self.tables[node_name], options), options)
+
+    def memory_report(self):
+        """
+        统计相关数据集各表的内存占用
+
+        Returns:
+            pd.DataFrame: 每张表的行数、列数、内存占用（字节）及占用最多的列
+        """
+        return memory_report(self.relevant_data_set)
+
+    def _read_node(self, con, node_name, conditions, columns='all', dtypes=None):
+        """
+        查询某张表满足条件的数据
+
+        Args:
+            con: 数据库连接对象
+            node_name: 表名
+            conditions: [(列名, 值列表)]
+            columns: 查询列的规则，见get_select_columns
+            dtypes: 类型转换规则，见get_dtype_options
+
+        Returns:
+            pd.DataFrame: 查询结果（以id为索引）
+        """
+        queries = get_select_in_queries(
+            table_name=node_name,
+            schema=self.tables[node_name].schema,
+            conditions=conditions,
+            columns=self.get_select_columns(node_name, columns)
+        )
+        data = read_select_in(con=con, queries=queries, index_col='id')
+        return self.apply_dtypes(node_name, data, dtypes=dtypes)
+
+    @contextmanager
+    def _node_fetcher(self, workers=None, columns='all', dtypes=None):
+        """
+        获取表数据的查询函数
+
+        并发时每个查询从连接池取一个连接，否则使用当前连接顺序查询。
+        调用方已占用一个连接，查询线程不能因为等待连接池而阻塞：
+        线程数不超过连接池当前的剩余容量，发出查询时连接池没有剩余容量（减去已排队的查询）
+        则改为在当前线程中用当前连接查询。
+
+        Args:
+            workers: 同时查询的最大线程数，为None时使用配置tree_fetch_workers
+            columns: 查询列的规则，见get_select_columns
+            dtypes: 类型转换规则，见get_dtype_options
+
+        Yields:
+            function: fetch(node_name, conditions)，返回查询结果的Future
+        """
+        if workers is None:
+            workers = TREE_FETCH_WORKERS
+        engine = getattr(self.con, 'engine', None)
+        if engine is not None:
+            capacity = get_pool_capacity(engine)
+            if capacity is not None:
+                workers = min(workers, capacity)
+
+        def read_node_on_con(node_name, conditions):
+            future = Future()
+            future.set_result(self._read_node(
+                self.con, node_name, conditions, columns=columns, dtypes=dtypes
+            ))
+            return future
+
+        if workers <= 1 or engine is None:
+            yield read_node_on_con
+            return
+
+        def read_node_on_pool(node_name, conditions):
+            with engine.connect() as con:
+                return self._read_node(con, node_name, conditions, columns=columns, dtypes=dtypes)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+
+            def fetch(node_name, conditions):
+                capacity = get_pool_capacity(engine)
+                if capacity is not None:
+                    queued = len([
+                        future for future in futures
+                        if not future.running() and not future.done()
+                    ])
+                    if capacity - queued <= 0:
+                        return read_node_on_con(node_name, conditions)
+                future = executor.submit(read_node_on_pool, node_name, conditions)
+                futures.append(future)
+                return future
+
+            yield fetch
+
+    def _fetch_reading_sequence(self, fetch, reading_seq, values_map, relevant_data_set):
+        """
+        按读取顺序查询相关表，并用查询结果更新值映射
+
+        某张表的查询条件只取决于读取顺序中排在它前面、与它直接相连的表。
+        这些表都已处理完时即可提前发出查询（同一批可同时发出多个查询），
+        查询结果仍按读取顺序依次写入，因此结果与逐表顺序查询相同。
+
+        Args:
+            fetch: 查询函数，见_node_fetcher
+            reading_seq: 读取顺序（不含根节点）
+            values_map: 值映射字典
+            relevant_data_set: 相关数据集字典（结果写入其中）
+
+        Returns:
+            dict: 更新后的值映射
+        """
+        index = self._schema_index
+        position = {node_name: i for i, node_name in enumerate(reading_seq)}
+
+        # 每张表的查询条件依赖的最后一张表在读取顺序中的位置
+        last_dependency = []
+        for i, node_name in enumerate(reading_seq):
+            neighbours = set(edge.table for edge in index.parents_by_table.get(node_name, ()))
+            neighbours |= set(edge.table for edge in index.children_by_table.get(node_name, ()))
+            last_dependency.append(max(
+                [position[t] for t in neighbours if t in position and position[t] < i],
+                default=-1
+            ))
+
+        # 已发出的查询 {位置: Future或None（该表没有值）}
+        launched = {}
+        next_launch = 0
+        for committing, node_name in enumerate(reading_seq):
+            # 发出所有依赖已处理完的查询
+            while next_launch < len(reading_seq) and last_dependency[next_launch] < committing:
+                launching = reading_seq[next_launch]
+                if launching in values_map:
+                    conditions = self._get_values_conditions(values_map[launching])
+                else:
+                    conditions = []
+                if len(conditions) == 0:
+                    launched[next_launch] = None
+                else:
+                    launched[next_launch] = fetch(launching, conditions)
+                next_launch += 1
+
+            future = launched.pop(committing)
+
+            # 该表没有值
+            if future is None:
+                continue
+
+            data = future.result()
+            relevant_data_set[node_name] = data
+
+            for col, tree_values in values_map[node_name].items():
+                values_map = self.update_values_map(
+                    values_map=values_map,
+                    tree=tree_values['tree'],
+                    root_data=data
+                )
+
+        return values_map
 
     def from_relevant_data_set(self, relevant_data_set=None):
         """
         从相关数据集加载数据
+
+        各表按值映射中的值集合过滤，过滤使用按列向量化的isin。
         
         Args:
             relevant_data_set: 相关数据集字典
@@ -760,46 +1849,21 @@ class DataTree(Tree):
                  for node_name in self.node_names]
             ))
         else:
-            values_map = self.update_values_map(
-                values_map={},
-                tree=self,
-                root_data=root_data
-            )
-
             # 处理相关数据
-            for node_name in self.reading_sequence:
-                if node_name not in relevant_data_set_copy:
+            steps = self._get_filter_steps(relevant_data_set_copy, root_data)
+            for node_name, conditions in steps:
+                if conditions is None:
                     relevant_data_set_copy[node_name] = pd.DataFrame(
                         columns=[col.col_name for col in self.tables[node_name].cols]
                     )
                     continue
-                if node_name not in values_map:
-                    continue
-                where_str_list = []
-                data = pd.DataFrame(columns=[col.col_name for col in self.table.cols])
-                for col, tree_values in values_map[node_name].items():
-                    values = tree_values['values']
-                    values_str = ', '.join([f'"{value}"' for value in values])
-                    data = relevant_data_set_copy[node_name]
-                    where_str = f'(data["{col}"].isin([{values_str}]))'
-                    where_str_list.append(where_str)
-
-                all_where_str = ' | '.join(where_str_list)
-
-                try:
-                    relevant_data_set_copy[node_name] = eval(f'data[{all_where_str}]')
-                except SyntaxError:
-                    print(where_str_list)
-                    print(all_where_str)
-                    raise SyntaxError
-
-                for col, tree_values in values_map[node_name].items():
-                    values_map = self.update_values_map(
-                        values_map=values_map,
-                        tree=tree_values['tree'],
-                        root_data=data
-                    )
+                data = relevant_data_set_copy[node_name]
+                mask = np.zeros(len(data), dtype=bool)
+                for col, values in conditions:
+                    mask |= get_isin_mask(data[col], values)
+                relevant_data_set_copy[node_name] = data[mask]
 
+        self._load_state = None
         self.data = root_data
         self.relevant_data_set = relevant_data_set_copy
 
@@ -837,14 +1901,7 @@ class DataTree(Tree):
         Returns:
             DataTree: 父节点数据树对象
         """
-        p_tree = Tree.p_(self, p_name=p_name, ref=ref)
-        p = DataTree(
-            con=self.con,
-            tables=self.tables,
-            tree=p_tree
-        )
-        p.from_relevant_data_set(self.relevant_data_set)
-        return p
+        return self._get_nav_tree(Tree.p_(self, p_name=p_name, ref=ref))
 
     def c_(self, c_name, reffed=None):
         """
@@ -857,13 +1914,7 @@ class DataTree(Tree):
         Returns:
             DataTree: 子节点数据树对象
         """
-        c = DataTree(
-            con=self.con,
-            tables=self.tables,
-            tree=Tree.c_(self, c_name=c_name, reffed=reffed)
-        )
-        c.from_relevant_data_set(self.relevant_data_set)
-        return c
+        return self._get_nav_tree(Tree.c_(self, c_name=c_name, reffed=reffed))
 
     @property
     def p(self):
@@ -884,13 +1935,7 @@ class DataTree(Tree):
             DataTree: 父节点数据树对象
         """
         for parent in self.parents:
-            p = DataTree(
-                con=self.con,
-                tables=self.tables,
-                tree=parent
-            )
-            p.from_relevant_data_set(self.relevant_data_set)
-            yield p
+            yield self._get_nav_tree(parent)
 
     @property
     def cs(self):
@@ -901,13 +1946,7 @@ class DataTree(Tree):
             DataTree: 子节点数据树对象
         """
         for child in self.children:
-            c = DataTree(
-                con=self.con,
-                tables=self.tables,
-                tree=child
-            )
-            c.from_relevant_data_set(self.relevant_data_set)
-            yield c
+            yield self._get_nav_tree(child)
 
     def json_obj_base(self, with_value=False, with_table=True):
         """
@@ -920,20 +1959,20 @@ class DataTree(Tree):
         Returns:
             dict: 数据树的JSON表示
         """
-        json_obj = self.to_json_obj_raw(
-            include_attrs=['root', 'ref', 'reffed', 'parents', 'children']
-        )
-        json_obj['parents'] = []
-        json_obj['children'] = []
-        data = self.data.copy(deep=True)
-        data = data.replace(np.nan, None)
+        json_obj = {
+            'root': self.root,
+            'ref': self.ref,
+            'reffed': self.reffed,
+            'parents': [],
+            'children': [],
+        }
         for parent in self.ps:
             json_obj['parents'].append(parent.json_obj_base(with_value=with_value, with_table=with_table))
         for child in self.cs:
             json_obj['children'].append(child.json_obj_base(with_value=with_value, with_table=with_table))
 
         if with_value:
-            json_obj['values'] = data.to_dict(orient='records')
+            json_obj['values'] = self.data.replace(np.nan, None).to_dict(orient='records')
 
         if with_table:
             json_obj['table'] = self.table.to_json_obj()
@@ -958,16 +1997,81 @@ class DataTree(Tree):
         """
         return self.json_obj_base(with_value=with_value, with_table=with_table)
 
+    def to_json_bytes(self, with_value=True, with_table=True):
+        """
+        获取编码后的JSON表示（结构与json_obj_base相同）
+
+        数据按列直接编码，表对象使用按元数据版本缓存的JSON片段。
+
+        Args:
+            with_value: 是否包含数据值
+            with_table: 是否包含表信息
+
+        Returns:
+            bytes: JSON
+        """
+        items = [
+            ('root', encode_value(self.root)),
+            ('ref', encode_value(self.ref)),
+            ('reffed', encode_value(self.reffed)),
+            ('parents', join_json_array([
+                parent.to_json_bytes(with_value=with_value, with_table=with_table)
+                for parent in self.ps
+            ])),
+            ('children', join_json_array([
+                child.to_json_bytes(with_value=with_value, with_table=with_table)
+                for child in self.cs
+            ])),
+        ]
+        if with_value:
+            items.append(('values', frame_to_json_records(
+                self.data, date_columns=get_date_columns(self.table)
+            )))
+        if with_table:
+            items.append(('table', self._schema_index.table_json(self.table)))
+        return join_json_object(items)
+
     # @profile_line_by_line
     def nested_values(self, ref_group=None, ignore_ref_col=None, full_detail=False):
         """
         获取嵌套值结构
+
+        每个节点的数据只生成一次记录：子节点数据按外键排序一次，
+        各父节点对应的dataSource按分组的偏移量从记录列表中切分。
         
         Args:
-            ref_group: 引用分组
+            ref_group: 引用分组 {父节点key: 本节点索引列表}
             ignore_ref_col: 忽略的引用列
             full_detail: 是否包含完整详情
             
+        Returns:
+            dict: 嵌套值结构
+        """
+        groups = None
+        if ref_group:
+            indexers = [self.data.index.get_indexer_for(names) for names in ref_group.values()]
+            positions = np.concatenate(indexers).astype(np.intp)
+            if (positions < 0).any():
+                missing = [
+                    name for names in ref_group.values() for name in names
+                    if name not in self.data.index
+                ]
+                print(f'ref group names not in data: {missing}')
+                raise KeyError(missing)
+            offsets = np.concatenate([[0], np.cumsum([len(indexer) for indexer in indexers])])
+            groups = (list(ref_group.keys()), positions, offsets)
+        return self._nested_values(groups=groups, ignore_ref_col=ignore_ref_col, full_detail=full_detail)
+
+    def _nested_values(self, groups=None, ignore_ref_col=None, full_detail=False):
+        """
+        获取嵌套值结构
+
+        Args:
+            groups: 按父节点的分组 (父节点key列表, 各组行位置依次拼接, 各组的偏移量)，
+                为None时不分组
+            ignore_ref_col: 忽略的引用列
+            full_detail: 是否包含完整详情
+
         Returns:
             dict: 嵌套值结构
         """
@@ -995,27 +2099,22 @@ class DataTree(Tree):
         ]
         data = self.data.assign(key=self.data.index.astype(str))
         data['id'] = data.index
-        data.sort_index()
         display_data = data[display_column_names]
 
-        if not ref_group:
+        if groups is None:
             data_source = {0: display_data.to_dict(orient='records')}
         else:
+            keys, positions, offsets = groups
+            records = display_data.take(positions).to_dict(orient='records')
             data_source = {
-                key: display_data.loc[names].to_dict(orient='records')
-                for key, names in ref_group.items()
+                key: records[offsets[i]:offsets[i + 1]]
+                for i, key in enumerate(keys)
             }
 
         children = {}
         for child in self.cs:
-            child_data = child.data.sort_index()
-            gs_data = {key: value for key, value in data.groupby(by=child.reffed)}
-            ref_group = {
-                str(gs_data[ref_value].index[0]): group.index.to_list()
-                for ref_value, group in child_data.groupby(by=child.ref)
-            }
-            children[child.root] = child.nested_values(
-                ref_group=ref_group,
+            children[child.root] = child._nested_values(
+                groups=self._get_child_groups(data, child),
                 ignore_ref_col=child.ref,
                 full_detail=full_detail
             )
@@ -1029,73 +2128,38 @@ class DataTree(Tree):
 
         return res
 
-    # @profile_line_by_line
-    def nested_values2(self, data=None, parent_ref=None):
+    @staticmethod
+    def _get_child_groups(data, child):
         """
-        获取嵌套值结构（版本2）
-        
+        将子节点数据按引用列分组
+
+        子节点数据按索引排序后按引用列的值稳定排序一次，各组为连续的一段；
+        每组对应被引用列取该值的第一个父节点行。
+
         Args:
-            data: 数据DataFrame
-            parent_ref: 父引用列
-            
+            data: 父节点数据
+            child: 子节点数据树
+
         Returns:
-            dict: 嵌套值结构
+            tuple: (父节点key列表, 各组行位置依次拼接, 各组的偏移量)，没有分组时返回None
         """
-        if not isinstance(data, pd.DataFrame):
-            data = self.data
-        col_items = [
-            item for item in self.table.cols
-            if not pd.isna(item[1].web_list_order)
-            and item[1].col_name != parent_ref
-        ]
-        col_items.sort(key=lambda x: x[1].web_list_order)
-        display_column_names, display_columns = zip(*col_items)
-        display_column_names = ['key'] + list(display_column_names)
-        columns = [
-            {
-                'key': i,
-                'dataIndex': col.col_name,
-                'title': col.label,
-                'dataType': col.data_type
-            } for i, col in enumerate(display_columns)
-        ]
-        data = data.assign(key=data.index.astype(str))
-        data['id'] = data.index
-        data.sort_index()
+        sorter = child.data.index.argsort()
+        codes, uniques = pd.factorize(child.data[child.ref].take(sorter), sort=True)
+        if len(uniques) == 0:
+            return None
 
-        if not parent_ref:
-            display_data = data[display_column_names]
-            data_source = {0: display_data.to_dict(orient='records')}
-        else:
-            gs_data = data.groupby(by=parent_ref)
-            data_source = {
-                key: g_data[display_column_names].to_dict(orient='records')
-                for key, g_data in gs_data
-            }
+        # 空值不分组
+        order = np.argsort(codes, kind='stable')
+        order = order[codes[order] >= 0]
+        counts = np.bincount(codes[order], minlength=len(uniques))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
 
-        children = {}
-        for child in self.cs:
-            parent_data = pd.DataFrame(
-                data=data[['id', child.reffed]]
-            )
-            parent_data.columns = [f'id_from_{self.root}', child.reffed]
-            child_data = pd.merge(left=child.data,
-                                  right=parent_data,
-                                  left_on=child.ref, right_on=child.reffed,
-                                  suffixes=('', f'_from_{self.root}'))
-            children[child.root] = child.nested_values2(
-                data=child_data,
-                parent_ref=f'id_from_{self.root}'
-            )
+        reffed = data[child.reffed]
+        first = (~reffed.duplicated() & reffed.notna()).to_numpy()
+        parent_keys = dict(zip(reffed[first].tolist(), data.index[first].astype(str)))
+        keys = [parent_keys[value] for value in uniques]
 
-        res = {
-            'tag': self.table.label,
-            'columns': columns,
-            'dataSource': data_source,
-            'children': children
-        }
-
-        return res
+        return keys, sorter[order], offsets
 
     def get_all_parents_with_values(self, res=None):
         """
@@ -1125,6 +2189,9 @@ class DataTree(Tree):
     def get_all_parents_with_full_value(self):
         """
         获取所有带完整值的父节点
+
+        父表的完整数据从参考表缓存（见db/cache.py的ReferenceCache）获取，
+        只包含id、主键、外键、被引用列及网页可见的列，相关数据集只包含该父表。
         
         Returns:
             dict: 所有带完整值的父节点字典
@@ -1132,12 +2199,13 @@ class DataTree(Tree):
         res = {}
         all_parents = self.get_all_parents()
         for p_name, p in all_parents.items():
+            data = REFERENCE_CACHE.get(self.con, self.tables, p.root)
             dp = DataTree(
                 con=self.con,
                 tables=self.tables,
-                tree=p
+                tree=p,
+                relevant_data_set={p.root: data}
             )
-            dp.from_sql()
             res[p.root] = dp
         return res
 
@@ -1365,6 +2433,8 @@ class DataTree(Tree):
 def get_right_angle_trees_from_tree(tree: Tree, res=None, include_root=True):
     """
     从树中获取直角树列表
+
+    从根节点开始获取时，节点列表按元数据版本缓存。
     
     Args:
         tree: 树对象
@@ -1374,22 +2444,40 @@ def get_right_angle_trees_from_tree(tree: Tree, res=None, include_root=True):
     Returns:
         list: 直角树列表
     """
-    if include_root:
-        if res is None:
-            res = [tree]
-        else:
-            for item in res:
-                if item.root == tree.root:
-                    break
-            else:
-                res.append(tree)
-
-    if tree.parents:
-        for parent in tree.parents:
-            get_right_angle_trees_from_tree(parent, res)
-    if tree.children:
-        for child in tree.children:
-            get_right_angle_trees_from_tree(child, res, include_root=False)
+    if res is None and include_root:
+        specs = tree._schema_index.right_angle_specs(
+            tree._node_key,
+            lambda: [t.node_spec for t in _get_right_angle_trees_from_tree(tree)[1:]]
+        )
+        return [tree] + [tree._get_node(*spec) for spec in specs]
+    return _get_right_angle_trees_from_tree(tree, res=res, include_root=include_root)
+
+
+def _get_right_angle_trees_from_tree(tree: Tree, res=None, include_root=True, roots=None):
+    """
+    从树中获取直角树列表（逐节点遍历）
+
+    Args:
+        tree: 树对象
+        res: 结果列表（递归使用）
+        include_root: 是否包含根节点
+        roots: 结果中已有的节点名称（递归使用）
+
+    Returns:
+        list: 直角树列表
+    """
+    if res is None:
+        res = []
+    if roots is None:
+        roots = set(item.root for item in res)
+    if include_root and tree.root not in roots:
+        res.append(tree)
+        roots.add(tree.root)
+
+    for parent in tree.parents:
+        _get_right_angle_trees_from_tree(parent, res, roots=roots)
+    for child in tree.children:
+        _get_right_angle_trees_from_tree(child, res, include_root=False, roots=roots)
     return res
 
 
@@ -0,0 +1,654 @@
+"""
+表关系索引模块
+
+该模块将表对象中各列的外键定义一次性编译为不可变的邻接索引，支持：
+1. 按表查询父表、子表以及对应的引用列/被引用列
+2. 按元数据版本缓存索引，元数据不变时所有树共用同一份索引
+3. 线性时间的录入顺序/读取顺序（拓扑排序），按根节点缓存
+4. 祖先/后代闭包，树节点间的比较只需一次集合查找
+5. 将编译好的索引（包括树的JSON表示和直角树列表）持久化到快照目录，
+   新进程按元数据版本直接加载
+6. 按元数据版本缓存表对象和树结构编码后的JSON片段，响应直接拼接片段
+
+主要类：
+- TreeEdge: 一条外键关系
+- SchemaIndex: 编译后的表关系索引
+- CycleError: 表关系存在循环引用时抛出的异常
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+from collections import namedtuple, OrderedDict
+from copy import deepcopy
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+
+# 添加父目录到系统路径，以便导入mint模块
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+from mint.globals import PATH_SNAPSHOT
+from mint.helper_function.hf_string import to_json_str
+
+
+# 一条外键关系：table为关系另一端的表名，ref为引用列，reffed为被引用列
+TreeEdge = namedtuple('TreeEdge', ['table', 'ref', 'reffed'])
+
+# 参与元数据版本计算的属性类型
+_META_SCALAR_TYPES = (str, int, float, bool, type(None), np.generic)
+
+# 最多缓存的元数据版本数量
+_MAX_CACHED_VERSIONS = 8
+
+# id(tables) -> (tables, version)，持有tables引用以保证id不被复用
+_META_VERSIONS = OrderedDict()
+
+# version -> SchemaIndex
+_SCHEMA_INDEXES = OrderedDict()
+
+# 索引缓存文件目录及格式版本，索引结构变化时需要提升格式版本
+PATH_TREE_CACHE = os.path.join(PATH_SNAPSHOT, 'tree_cache')
+TREE_CACHE_FORMAT = 3
+
+
+# 遍历结束标记
+_END = object()
+
+
+class CycleError(ValueError):
+    """表关系中存在循环引用"""
+
+    def __init__(self, cycle):
+        self.cycle = list(cycle)
+        super().__init__(f'cyclic table relation: {" -> ".join(map(str, self.cycle))}')
+
+
+def _dfs_order(start_keys, expand):
+    """
+    按深度优先顺序生成录入顺序（拓扑排序引擎）
+
+    expand(key) 返回 (前置节点, 标签, 后置节点)：先展开全部前置节点，
+    再输出标签，最后展开后置节点。每个节点只展开一次，重复的标签只保留
+    第一次出现的位置，总耗时与节点数和边数成线性关系。
+
+    Args:
+        start_keys: 起始节点
+        expand: 节点展开函数
+
+    Returns:
+        list: 标签序列
+
+    Raises:
+        CycleError: 展开过程中回到了路径上的节点
+    """
+    res = []
+    emitted = set()
+    done = set()
+
+    for start in start_keys:
+        if start in done:
+            continue
+        # 路径帧：[节点, 标签, 前置节点迭代器, 后置节点迭代器, 是否已输出标签]
+        path = []
+        on_path = set()
+        key = start
+        while True:
+            if key is not None:
+                before, label, after = expand(key)
+                path.append([key, label, iter(before), iter(after), False])
+                on_path.add(key)
+                key = None
+            if not path:
+                break
+
+            frame = path[-1]
+            if not frame[4]:
+                nxt = next(frame[2], _END)
+                if nxt is _END:
+                    frame[4] = True
+                    if frame[1] not in emitted:
+                        emitted.add(frame[1])
+                        res.append(frame[1])
+                    continue
+            else:
+                nxt = next(frame[3], _END)
+                if nxt is _END:
+                    path.pop()
+                    on_path.discard(frame[0])
+                    done.add(frame[0])
+                    continue
+
+            if nxt in done:
+                continue
+            if nxt in on_path:
+                i = next(i for i, f in enumerate(path) if f[0] == nxt)
+                raise CycleError([f[1] for f in path[i:]] + [path[i][1]])
+            key = nxt
+
+    return res
+
+
+def topological_order(relation_info):
+    """
+    根据表引用关系获取录入顺序，被引用表排在引用表之前
+
+    Args:
+        relation_info: [(表名, 被引用表名), ...]，被引用表名可为空
+
+    Returns:
+        list: 表的录入顺序
+
+    Raises:
+        CycleError: 表之间存在循环引用（表对自身的引用不计）
+    """
+    referenced = OrderedDict()
+    for table_name, referenced_table_name in relation_info:
+        referenced.setdefault(table_name, [])
+        if referenced_table_name is None or pd.isna(referenced_table_name):
+            continue
+        if referenced_table_name == table_name:
+            continue
+        referenced[table_name].append(referenced_table_name)
+        referenced.setdefault(referenced_table_name, [])
+
+    return _dfs_order(
+        start_keys=list(referenced.keys()),
+        expand=lambda table_name: (referenced[table_name], table_name, ())
+    )
+
+
+def _meta_attrs(obj):
+    """
+    获取对象中参与版本计算的标量属性
+
+    Args:
+        obj: 表对象或列对象
+
+    Returns:
+        list: (属性名, 属性值repr) 列表
+    """
+    return sorted(
+        (key, repr(value)) for key, value in vars(obj).items()
+        if isinstance(value, _META_SCALAR_TYPES)
+    )
+
+
+def get_meta_version(tables):
+    """
+    计算表对象字典的元数据版本
+
+    版本为所有表及列标量属性的哈希值，同一个tables对象只计算一次。
+
+    Args:
+        tables: 表对象字典
+
+    Returns:
+        str: 元数据版本
+    """
+    cached = _META_VERSIONS.get(id(tables))
+    if cached is not None and cached[0] is tables:
+        _META_VERSIONS.move_to_end(id(tables))
+        return cached[1]
+
+    h = hashlib.sha1()
+    for table_name in sorted(tables.keys()):
+        table = tables[table_name]
+        h.update(repr((table_name, _meta_attrs(table))).encode('utf-8'))
+        for col in table.cols:
+            h.update(repr(_meta_attrs(col)).encode('utf-8'))
+    version = h.hexdigest()
+
+    _META_VERSIONS[id(tables)] = (tables, version)
+    while len(_META_VERSIONS) > _MAX_CACHED_VERSIONS:
+        _META_VERSIONS.popitem(last=False)
+    return version
+
+
+class SchemaIndex:
+    """
+    表关系索引
+
+    在构建时解析所有外键字符串，按表记录父表关系和子表关系，
+    并按表顺序排好序。构建后索引不可修改。
+    """
+
+    def __init__(self, tables, version=None):
+        """
+        编译表关系索引
+
+        Args:
+            tables: 表对象字典
+            version: 元数据版本，为None时自动计算
+        """
+        if version is None:
+            version = get_meta_version(tables)
+
+        orders = {table_name: table.order for table_name, table in tables.items()}
+
+        parents = {table_name: [] for table_name in tables}
+        children = {table_name: [] for table_name in tables}
+        reffed_cols = {table_name: set() for table_name in tables}
+        for child_root, table in tables.items():
+            for col in table.cols:
+                fk = col.foreign_key
+                if pd.isna(fk):
+                    continue
+                fk_parts = fk.split('.')
+                parent_root, reffed = fk_parts[1], fk_parts[2]
+                parents[child_root].append(TreeEdge(parent_root, col.col_name, reffed))
+                reffed_cols.setdefault(parent_root, set()).add(reffed)
+                if parent_root != child_root:
+                    children.setdefault(parent_root, []).append(
+                        TreeEdge(child_root, col.col_name, reffed)
+                    )
+
+        # 按表顺序排序（稳定排序，保持同顺序表的列顺序），不存在的表排在最后
+        def order_key(edge):
+            order = orders.get(edge.table)
+            return order is None, order
+
+        self.version = version
+        self.orders = MappingProxyType(orders)
+        self.schemas = tuple(set(table.schema for table in tables.values()))
+        self.parents_by_table = MappingProxyType({
+            table_name: tuple(sorted(edges, key=order_key))
+            for table_name, edges in parents.items()
+        })
+        self.children_by_table = MappingProxyType({
+            table_name: tuple(sorted(edges, key=order_key))
+            for table_name, edges in children.items()
+        })
+
+        # 遍历树时需要的列：主键、id、外键列及被其他表引用的列（按表的列顺序）
+        self.key_columns_by_table = MappingProxyType({
+            table_name: tuple(
+                col.col_name for col in table.cols
+                if col.col_name in ('id', table.pk)
+                or not pd.isna(col.foreign_key)
+                or col.col_name in reffed_cols[table_name]
+            )
+            for table_name, table in tables.items()
+        })
+
+        # 按节点缓存的录入顺序和祖先/后代闭包
+        self._booking_sequences = {}
+        self._node_names = {}
+        self._parenthood_names = {}
+        self._childhood_names = {}
+
+        # 按节点缓存的树JSON片段和直角树列表
+        self._tree_json = {}
+        self._right_angle_specs = {}
+
+        # 按表缓存的表对象JSON片段，以及按表名列表缓存的表对象字典JSON
+        self._table_json = {}
+        self._tables_json = {}
+
+    def __setattr__(self, key, value):
+        if key in self.__dict__:
+            raise AttributeError(f'SchemaIndex is immutable: {key}')
+        super().__setattr__(key, value)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key, value in state.items():
+            if isinstance(value, MappingProxyType):
+                state[key] = dict(value)
+        return state
+
+    def __setstate__(self, state):
+        for key in ['orders', 'parents_by_table', 'children_by_table', 'key_columns_by_table']:
+            state[key] = MappingProxyType(state[key])
+        self.__dict__.update(state)
+
+    def _expand_node(self, node_key):
+        """
+        展开树节点：父节点在前，子节点在后
+
+        树节点由 (表名, 是否为父节点, 父根节点名) 唯一确定，与Tree的构建规则一致：
+        父节点不展开子节点，子节点不回溯到来源的父表。
+
+        Args:
+            node_key: 树节点
+
+        Returns:
+            tuple: (父节点列表, 表名, 子节点列表)
+        """
+        root, is_parent, parent_root = node_key
+        parent_keys = [
+            (edge.table, True, None)
+            for edge in self.parents_by_table[root]
+            if edge.table != parent_root
+        ]
+        if is_parent:
+            child_keys = ()
+        else:
+            child_keys = [
+                (edge.table, False, root)
+                for edge in self.children_by_table[root]
+            ]
+        return parent_keys, root, child_keys
+
+    def booking_sequence(self, root, is_parent=False, parent_root=None):
+        """
+        获取以root为根的树的录入顺序
+
+        Args:
+            root: 根表名
+            is_parent: 是否为父节点
+            parent_root: 父根节点名
+
+        Returns:
+            tuple: 录入顺序
+
+        Raises:
+            CycleError: 树中存在循环引用
+        """
+        node_key = (root, is_parent, parent_root)
+        try:
+            return self._booking_sequences[node_key]
+        except KeyError:
+            pass
+        res = tuple(_dfs_order(start_keys=[node_key], expand=self._expand_node))
+        self._booking_sequences[node_key] = res
+        return res
+
+    def reading_sequence(self, root, is_parent=False, parent_root=None):
+        """
+        获取以root为根的树的读取顺序（录入顺序的逆序）
+
+        Args:
+            root: 根表名
+            is_parent: 是否为父节点
+            parent_root: 父根节点名
+
+        Returns:
+            tuple: 读取顺序
+        """
+        return self.booking_sequence(
+            root=root,
+            is_parent=is_parent,
+            parent_root=parent_root
+        )[::-1]
+
+
+    def node_names(self, root, is_parent=False, parent_root=None):
+        """
+        获取树中所有节点名称
+
+        Args:
+            root: 根表名
+            is_parent: 是否为父节点
+            parent_root: 父根节点名
+
+        Returns:
+            frozenset: 节点名称集合
+        """
+        node_key = (root, is_parent, parent_root)
+        try:
+            return self._node_names[node_key]
+        except KeyError:
+            pass
+        res = frozenset(self.booking_sequence(*node_key))
+        self._node_names[node_key] = res
+        return res
+
+    def parenthood_names(self, root, is_parent=False, parent_root=None):
+        """
+        获取树中所有祖先节点名称（包括子节点的祖先）
+
+        Args:
+            root: 根表名
+            is_parent: 是否为父节点
+            parent_root: 父根节点名
+
+        Returns:
+            frozenset: 祖先节点名称集合
+        """
+        node_key = (root, is_parent, parent_root)
+        try:
+            return self._parenthood_names[node_key]
+        except KeyError:
+            pass
+        # 先检查循环引用，避免闭包计算无限递归
+        self.booking_sequence(*node_key)
+        parent_keys, _, child_keys = self._expand_node(node_key)
+        res = set(parent_key[0] for parent_key in parent_keys)
+        for key in list(parent_keys) + list(child_keys):
+            res |= self.parenthood_names(*key)
+        res = frozenset(res)
+        self._parenthood_names[node_key] = res
+        return res
+
+    def childhood_names(self, root, is_parent=False, parent_root=None):
+        """
+        获取树中所有后代节点名称
+
+        Args:
+            root: 根表名
+            is_parent: 是否为父节点
+            parent_root: 父根节点名
+
+        Returns:
+            frozenset: 后代节点名称集合
+        """
+        node_key = (root, is_parent, parent_root)
+        try:
+            return self._childhood_names[node_key]
+        except KeyError:
+            pass
+        self.booking_sequence(*node_key)
+        _, _, child_keys = self._expand_node(node_key)
+        res = set(child_key[0] for child_key in child_keys)
+        for key in child_keys:
+            res |= self.childhood_names(*key)
+        res = frozenset(res)
+        self._childhood_names[node_key] = res
+        return res
+
+    def tree_json(self, node_spec, build):
+        """
+        获取树节点编码后的JSON片段，首次获取时调用build生成并缓存
+
+        Args:
+            node_spec: 节点标识 (表名, 引用列, 被引用列, 是否为父节点, 父根节点名)
+            build: 生成JSON片段（bytes）的函数
+
+        Returns:
+            bytes: JSON片段
+        """
+        try:
+            return self._tree_json[node_spec]
+        except KeyError:
+            pass
+        fragment = build()
+        self._tree_json[node_spec] = fragment
+        return fragment
+
+    def table_json(self, table):
+        """
+        获取表对象编码后的JSON片段
+
+        Args:
+            table: 表对象
+
+        Returns:
+            bytes: JSON片段
+        """
+        try:
+            return self._table_json[table.table_name]
+        except KeyError:
+            pass
+        fragment = to_json_str(json_obj=table.to_json_obj()).encode('utf-8')
+        self._table_json[table.table_name] = fragment
+        return fragment
+
+    def tables_json(self, tables):
+        """
+        获取全部表对象（{表名: 表对象}）编码后的JSON，由各表的JSON片段拼接而成
+
+        Args:
+            tables: 表对象字典
+
+        Returns:
+            bytes: JSON
+        """
+        key = tuple(tables.keys())
+        try:
+            return self._tables_json[key]
+        except KeyError:
+            pass
+        fragment = join_json_object([
+            (table_name, self.table_json(table))
+            for table_name, table in tables.items()
+        ])
+        self._tables_json[key] = fragment
+        return fragment
+
+    def right_angle_specs(self, node_key, build):
+        """
+        获取树节点的直角树节点标识列表，首次获取时调用build生成并缓存
+
+        Args:
+            node_key: 树节点 (表名, 是否为父节点, 父根节点名)
+            build: 生成节点标识列表的函数
+
+        Returns:
+            tuple: 节点标识列表
+        """
+        try:
+            return self._right_angle_specs[node_key]
+        except KeyError:
+            pass
+        specs = tuple(build())
+        self._right_angle_specs[node_key] = specs
+        return specs
+
+
+def join_json_object(items):
+    """
+    将 (键, JSON片段) 列表拼接为JSON对象
+
+    Args:
+        items: (键, 已编码的JSON片段) 列表
+
+    Returns:
+        bytes: JSON对象
+    """
+    return b'{' + b','.join(
+        json.dumps(key, ensure_ascii=False).encode('utf-8') + b':' + fragment
+        for key, fragment in items
+    ) + b'}'
+
+
+def join_json_array(fragments):
+    """
+    将JSON片段列表拼接为JSON数组
+
+    Args:
+        fragments: 已编码的JSON片段列表
+
+    Returns:
+        bytes: JSON数组
+    """
+    return b'[' + b','.join(fragments) + b']'
+
+
+def get_schema_index(tables):
+    """
+    获取表对象字典对应的关系索引
+
+    同一元数据版本只编译一次。
+
+    Args:
+        tables: 表对象字典
+
+    Returns:
+        SchemaIndex: 表关系索引
+    """
+    version = get_meta_version(tables)
+    index = _SCHEMA_INDEXES.get(version)
+    if index is None:
+        index = load_schema_index(version=version)
+        if index is None:
+            index = SchemaIndex(tables=tables, version=version)
+        _SCHEMA_INDEXES[version] = index
+        while len(_SCHEMA_INDEXES) > _MAX_CACHED_VERSIONS:
+            _SCHEMA_INDEXES.popitem(last=False)
+    else:
+        _SCHEMA_INDEXES.move_to_end(version)
+    return index
+
+
+def get_tree_cache_path(version):
+    """
+    获取索引缓存文件路径
+
+    Args:
+        version: 元数据版本
+
+    Returns:
+        str: 缓存文件路径
+    """
+    return os.path.join(
+        PATH_TREE_CACHE,
+        f'tree_cache-v{TREE_CACHE_FORMAT}-{version}.pkl'
+    )
+
+
+def save_schema_index(index):
+    """
+    将索引（包括已缓存的顺序、闭包、JSON表示等）写入缓存文件
+
+    先写入临时文件再替换，避免其他进程读到写了一半的文件。
+
+    Args:
+        index: 表关系索引
+
+    Returns:
+        str: 缓存文件路径
+    """
+    path = get_tree_cache_path(index.version)
+    os.makedirs(PATH_TREE_CACHE, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(
+            {'format': TREE_CACHE_FORMAT, 'version': index.version, 'index': index},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_schema_index(version):
+    """
+    从缓存文件加载索引
+
+    Args:
+        version: 元数据版本
+
+    Returns:
+        SchemaIndex: 表关系索引，缓存文件不存在或不可用时返回None
+    """
+    path = get_tree_cache_path(version)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            cache = pickle.load(f)
+    except Exception as e:
+        print(f'tree cache "{path}" is not readable: {e}')
+        return None
+    if cache.get('format') != TREE_CACHE_FORMAT or cache.get('version') != version:
+        print(f'tree cache "{path}" is out of date')
+        return None
+    return cache['index']
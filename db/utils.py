@@ -5,6 +5,7 @@
 主要用于处理数据库连接、数据验证、缺失值填充等操作。
 """
 
+import threading
 import traceback
 from copy import copy
 from datetime import datetime as dt
@@ -30,6 +31,10 @@ if parent_dir not in sys.path:
 from mint.globals import *
 from mint.meta.table_objs import get_tables_from_info
 
+# 引擎注册表：URL -> 引擎，进程内共用
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
 
 def db_get_schema(schema_tag, sys_mode, project_name):
     """
@@ -92,7 +97,10 @@ def db_get_url(**db_params):
 
 def db_get_engine(**db_params):
     """
-    创建SQLAlchemy数据库引擎
+    获取SQLAlchemy数据库引擎
+
+    同一个URL（即同一个schema和自动提交模式）在进程内只创建一个引擎，
+    所有调用共用该引擎的连接池。
     
     Args:
         **db_params: 数据库连接参数
@@ -101,7 +109,43 @@ def db_get_engine(**db_params):
         sqlalchemy.engine.Engine: 数据库引擎对象
     """
     url = db_get_url(**db_params)
-    return create_engine(url=url, pool_recycle=1800, pool_pre_ping=True)
+    with _ENGINES_LOCK:
+        try:
+            return _ENGINES[url]
+        except KeyError:
+            pass
+        engine = create_engine(
+            url=url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=True
+        )
+        _ENGINES[url] = engine
+        return engine
+
+
+def db_get_pool_stats():
+    """
+    获取所有连接池的状态
+
+    Returns:
+        dict: {URL（隐藏密码）: {'size': 连接池大小, 'checked_in': 空闲连接数,
+            'checked_out': 使用中的连接数, 'overflow': 超出的连接数}}
+    """
+    with _ENGINES_LOCK:
+        engines = list(_ENGINES.values())
+    res = {}
+    for engine in engines:
+        pool = engine.pool
+        res[engine.url.render_as_string(hide_password=True)] = {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        }
+    return res
 
 
 def db_connect_db(create_if_not_exist=True, auto_commit=True, **db_params):
@@ -148,7 +192,6 @@ def db_connect_db(create_if_not_exist=True, auto_commit=True, **db_params):
                     charset=charset
                 ).cursor().execute(f'create schema {schema}')
                 print(f'schema "{schema}" created')
-                engine = create_engine(url=url)
                 con = engine.connect()
             else:
                 traceback.format_exc()
@@ -623,22 +666,21 @@ def get_tables(schema_tag: str = None):
         filter_sql = f' where `schema_tag` = "{schema_tag}" or `schema_tag` is Null'
     else:
         filter_sql = ''
-    con = get_con('core')
-    tables_info = pd.read_sql(
-        sql='select * from tables' + filter_sql,
-        con=con
-    ).replace(np.nan, None)
-    table_names = tables_info['table_name'].tolist()
-    table_names_sql_filter = ', '.join([f'"{table_name}"' for table_name in table_names])
-    cols_info = pd.read_sql(
-        sql=f'select * from cols where `table_name` in ({table_names_sql_filter})',
-        con=con
-    ).replace(np.nan, None)
+    with get_con('core') as con:
+        tables_info = pd.read_sql(
+            sql='select * from tables' + filter_sql,
+            con=con
+        ).replace(np.nan, None)
+        table_names = tables_info['table_name'].tolist()
+        table_names_sql_filter = ', '.join([f'"{table_name}"' for table_name in table_names])
+        cols_info = pd.read_sql(
+            sql=f'select * from cols where `table_name` in ({table_names_sql_filter})',
+            con=con
+        ).replace(np.nan, None)
     res = get_tables_from_info(
         tables_info=tables_info,
         cols_info=cols_info,
         get_schema=lambda x: db_get_schema(x, SYS_MODE, PROJECT_NAME)
     )
-    con.close()
     return res
 
@@ -0,0 +1,403 @@
+"""
+批量写入模块
+
+该模块将数据树的相关数据集批量写入数据库，支持：
+1. 每张表按批次执行多行INSERT（executemany），批次大小可配置
+2. 所有表在调用方的同一个事务中按录入顺序写入
+3. 按自然键（唯一列）批量查询新生成的id，并替换子表中引用这些行临时id的外键
+4. 变更集（新增、修改、删除）按(表, 操作, 列)分组批量执行，删除和修改都按id分块，每块一条语句
+5. 新增时不写入空值和由数据库维护的列（create_time、update_time），由数据库的默认值填充
+"""
+
+import os
+import sys
+
+import pandas as pd
+from sqlalchemy import text, bindparam
+
+# 添加父目录到系统路径，以便导入mint模块
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+from mint.globals import TREE_WRITE_BATCH_SIZE, TREE_FETCH_CHUNK_SIZE
+from mint.db.tree_index import get_schema_index
+
+
+# 由数据库维护的列，新增时不写入，修改时update_time由数据库更新
+SYSTEM_COLUMNS = ('create_time', 'update_time')
+
+
+def to_records(data, columns=None):
+    """
+    将DataFrame转换为参数字典列表，空值转换为None，NumPy标量转换为Python类型
+
+    Args:
+        data: DataFrame
+        columns: 转换的列，为None时转换所有列
+
+    Returns:
+        list: [{列名: 值}]
+    """
+    if columns is None:
+        columns = list(data.columns)
+    data = data[columns].astype(object)
+    return data.where(data.notna(), None).to_dict(orient='records')
+
+
+def get_natural_key(table):
+    """
+    获取表的自然键（第一个唯一且不是id的列）
+
+    Args:
+        table: 表对象
+
+    Returns:
+        str: 列名，没有时返回None
+    """
+    for col in table.cols:
+        if col.col_name == 'id':
+            continue
+        if col.unique is not None and not pd.isna(col.unique) and int(col.unique) == 1:
+            return col.col_name
+    return None
+
+
+def get_insert_sql(table, columns):
+    """
+    生成INSERT语句
+
+    Args:
+        table: 表对象
+        columns: 写入的列
+
+    Returns:
+        TextClause: INSERT语句（参数名与列名相同）
+    """
+    return text(
+        f'INSERT INTO {table.schema}.{table.table_name} '
+        f'({", ".join([f"`{col}`" for col in columns])}) '
+        f'VALUES ({", ".join([f":{col}" for col in columns])})'
+    )
+
+
+def group_insert_records(records):
+    """
+    将要新增的记录按非空的列分组
+
+    空值和由数据库维护的列不写入，由数据库的默认值（server_default）填充，
+    显式写入NULL会覆盖默认值（如update_time为NULL时DataTree.refresh无法按update_time读到该行）。
+
+    Args:
+        records: [{列名: 值}]
+
+    Returns:
+        dict: {列名元组: [{列名: 值}]}，按各组第一次出现的顺序
+    """
+    res = {}
+    for record in records:
+        params = {
+            col: value for col, value in record.items()
+            if value is not None and col not in SYSTEM_COLUMNS
+        }
+        res.setdefault(tuple(params.keys()), []).append(params)
+    return res
+
+
+def bulk_insert(con, table, data, batch_size=None):
+    """
+    按批次执行多行INSERT
+
+    记录按非空的列分组（见group_insert_records），每组每批一次executemany，
+    驱动将其合并为多行INSERT语句。
+
+    Args:
+        con: 数据库连接对象（由调用方管理事务）
+        table: 表对象
+        data: 要写入的数据（列名与表的列名相同）
+        batch_size: 每批的行数，为None时使用配置tree_write_batch_size
+
+    Returns:
+        int: 写入的行数
+    """
+    if len(data) == 0:
+        return 0
+    if batch_size is None:
+        batch_size = TREE_WRITE_BATCH_SIZE
+    records = to_records(data)
+    for columns, params in group_insert_records(records).items():
+        sql = get_insert_sql(table, columns)
+        for start in range(0, len(params), batch_size):
+            con.execute(sql, params[start:start + batch_size])
+    return len(records)
+
+
+def fetch_ids(con, table, key_col, keys, chunk_size=None):
+    """
+    按自然键批量查询id
+
+    Args:
+        con: 数据库连接对象
+        table: 表对象
+        key_col: 自然键列名
+        keys: 自然键的值
+        chunk_size: 每条IN查询最多包含的值个数，为None时使用配置tree_fetch_chunk_size
+
+    Returns:
+        dict: {自然键: id}
+    """
+    if chunk_size is None:
+        chunk_size = TREE_FETCH_CHUNK_SIZE
+    keys = list(keys)
+    sql = text(
+        f'SELECT `id`, `{key_col}` FROM {table.schema}.{table.table_name} '
+        f'WHERE `{key_col}` IN :keys'
+    ).bindparams(bindparam('keys', expanding=True))
+    res = {}
+    for start in range(0, len(keys), chunk_size):
+        for row_id, key in con.execute(sql, {'keys': keys[start:start + chunk_size]}):
+            res[key] = row_id
+    return res
+
+
+def insert_relevant_data_set(con, tables, booking_sequence, relevant_data_set, batch_size=None):
+    """
+    按录入顺序批量写入相关数据集
+
+    各表的id列为空时由数据库生成；id列是临时id（子表外键引用它）时不写入，
+    写入后按自然键查询生成的id，并替换子表外键中的临时id。
+    所有写入使用调用方的事务，出错时由调用方回滚。
+
+    Args:
+        con: 数据库连接对象（由调用方管理事务）
+        tables: 表对象字典
+        booking_sequence: 录入顺序
+        relevant_data_set: 相关数据集 {表名: 数据}
+        batch_size: 每批的行数，为None时使用配置tree_write_batch_size
+
+    Returns:
+        dict: {表名: 写入的行数}
+    """
+    index = get_schema_index(tables)
+    relevant_data_set = dict(relevant_data_set)
+    res = {}
+    for table_name in booking_sequence:
+        data = relevant_data_set.get(table_name)
+        if data is None or len(data) == 0:
+            continue
+        table = tables[table_name]
+
+        # 引用本表id的子表外键
+        id_refs = [
+            edge for edge in index.children_by_table.get(table_name, ())
+            if edge.reffed == 'id' and edge.table in relevant_data_set
+        ]
+
+        temp_ids = None
+        if 'id' in data.columns:
+            if data['id'].isna().all():
+                data = data.drop(columns=['id'])
+            elif len(id_refs) > 0:
+                temp_ids = data['id']
+                data = data.drop(columns=['id'])
+
+        res[table_name] = bulk_insert(con, table, data, batch_size=batch_size)
+
+        if temp_ids is None:
+            continue
+
+        key_col = get_natural_key(table)
+        if key_col is None:
+            print(f'cannot resolve generated ids of "{table_name}": no unique column')
+            raise ValueError
+        ids = fetch_ids(con, table, key_col, data[key_col].dropna().unique().tolist())
+        id_map = {
+            temp_id: ids[key]
+            for temp_id, key in zip(temp_ids.tolist(), data[key_col].tolist())
+            if not pd.isna(temp_id) and key in ids
+        }
+        for edge in id_refs:
+            child_data = relevant_data_set[edge.table]
+            if edge.ref not in child_data.columns:
+                continue
+            relevant_data_set[edge.table] = child_data.assign(**{
+                edge.ref: child_data[edge.ref].map(
+                    lambda value: id_map.get(value, value)
+                ).astype(object)
+            })
+    return res
+
+
+def get_update_sql(table, cols, rows):
+    """
+    生成按id修改多行的UPDATE语句
+
+    每列的新值用 CASE `id` WHEN :id_i THEN :vj_i ... END 按id选择，条件为 `id` IN :ids，
+    一条语句修改一块中的所有行（executemany对UPDATE仍逐行执行）。
+
+    Args:
+        table: 表对象
+        cols: 修改的列 [(列名, 新值的参数名)]
+        rows: 行数
+
+    Returns:
+        TextClause: UPDATE语句，参数见get_update_params
+    """
+    sets = []
+    for j, (col, _) in enumerate(cols):
+        cases = ' '.join([f'WHEN :id_{i} THEN :v{j}_{i}' for i in range(rows)])
+        sets.append(f'`{col}` = CASE `id` {cases} END')
+    sets.append('`update_time` = CURRENT_TIMESTAMP')
+    return text(
+        f'UPDATE {table.schema}.{table.table_name} SET {", ".join(sets)} WHERE `id` IN :ids'
+    ).bindparams(bindparam('ids', expanding=True))
+
+
+def get_update_params(cols, params):
+    """
+    生成get_update_sql的参数
+
+    Args:
+        cols: 修改的列 [(列名, 新值的参数名)]
+        params: 每行的参数 [{新值的参数名: 新值, 'id': id}]
+
+    Returns:
+        dict: {'ids': [id], 'id_i': id, 'vj_i': 新值}
+    """
+    res = {'ids': [row['id'] for row in params]}
+    for i, row in enumerate(params):
+        res[f'id_{i}'] = row['id']
+        for j, (_, key) in enumerate(cols):
+            res[f'v{j}_{i}'] = row[key]
+    return res
+
+
+def get_change_batches(tables, booking_sequence, changes, batch_size=None):
+    """
+    将变更集按(表, 操作, 列)分组为批次
+
+    变更集为check_update_all的结果 {表名: [(操作, 旧值, 新值)]}，修改可以只包含变化的列（紧凑变更集），
+    列相同的修改分为一组。各表按录入顺序处理，表内依次为删除、修改、新增，先删除的行可以释放唯一键给新增的行使用。
+    删除合并为按id分块的 DELETE ... WHERE id IN (...)；
+    修改按列分组，每组每块一条 UPDATE ... SET 列 = CASE id WHEN ... END WHERE id IN (...)（见get_update_sql）；
+    新增按非空的列分组（见group_insert_records），每组按批次执行executemany，驱动将其合并为多行INSERT。
+
+    Args:
+        tables: 表对象字典
+        booking_sequence: 录入顺序
+        changes: 变更集 {表名: [(操作, 旧值, 新值)]}
+        batch_size: 每批的行数（或IN中的id个数），为None时使用配置tree_write_batch_size
+
+    Returns:
+        list: [(sql, 参数)]，参数为字典列表（INSERT的executemany）或包含ids的字典（DELETE、UPDATE）
+    """
+    if batch_size is None:
+        batch_size = TREE_WRITE_BATCH_SIZE
+    res = []
+    for table_name in booking_sequence:
+        if table_name not in changes:
+            continue
+        table = tables[table_name]
+        full_name = f'{table.schema}.{table.table_name}'
+
+        deletes = []
+        groups = {'update': {}}
+        inserts = []
+        for change in changes[table_name]:
+            if change[0] == 'insert':
+                inserts.append({
+                    key.replace('__new', ''): value for key, value in change[1].items()
+                })
+            elif change[0] == 'delete':
+                deletes.append(int(change[1]['id']))
+            elif change[0] == 'update':
+                # id只用于条件；create_time、update_time由数据库维护，DataTree.refresh按update_time增量刷新
+                cols = tuple(
+                    (col1, col2)
+                    for col1, col2 in zip(change[1].keys(), change[2].keys())
+                    if col1 != 'id' and col1 not in SYSTEM_COLUMNS
+                )
+                params = {**change[2], 'id': int(change[1]['id'])}
+                groups['update'].setdefault(cols, []).append(params)
+            else:
+                print(f'invalid change type: {change[0]}')
+                raise ValueError
+
+        if len(deletes) > 0:
+            sql = text(
+                f'DELETE FROM {full_name} WHERE `id` IN :ids'
+            ).bindparams(bindparam('ids', expanding=True))
+            for start in range(0, len(deletes), batch_size):
+                res.append((sql, {'ids': deletes[start:start + batch_size]}))
+
+        for cols, params in groups['update'].items():
+            if len(cols) == 0:
+                continue
+            for start in range(0, len(params), batch_size):
+                chunk = params[start:start + batch_size]
+                res.append((get_update_sql(table, cols, len(chunk)), get_update_params(cols, chunk)))
+
+        for cols, params in group_insert_records(inserts).items():
+            sql = get_insert_sql(table, cols)
+            for start in range(0, len(params), batch_size):
+                res.append((sql, params[start:start + batch_size]))
+    return res
+
+
+def execute_change_set(con, tables, booking_sequence, changes, batch_size=None):
+    """
+    按批次执行变更集
+
+    Args:
+        con: 数据库连接对象（由调用方管理事务）
+        tables: 表对象字典
+        booking_sequence: 录入顺序
+        changes: 变更集 {表名: [(操作, 旧值, 新值)]}
+        batch_size: 每批的行数，为None时使用配置tree_write_batch_size
+
+    Returns:
+        int: 执行的语句数（即数据库往返次数，INSERT的executemany由驱动合并为一条多行INSERT）
+    """
+    batches = get_change_batches(
+        tables=tables,
+        booking_sequence=booking_sequence,
+        changes=changes,
+        batch_size=batch_size
+    )
+    for sql, params in batches:
+        rows = len(params['ids']) if isinstance(params, dict) else len(params)
+        # 多行UPDATE的CASE分支很长，只打印开头
+        sql_str = str(sql)
+        print(f'[sql] {sql_str[:200]}{"..." if len(sql_str) > 200 else ""} ({rows} rows)')
+        con.execute(sql, params)
+    return len(batches)
+
+
+def count_changes(changes):
+    """
+    统计变更集写入的行数和单元格数
+
+    与实际写入的一致：新增的单元格数为写入的列数（不含id、空值和SYSTEM_COLUMNS，见group_insert_records），
+    修改的单元格数为SET的列数（不含id和SYSTEM_COLUMNS），删除只计行数。
+
+    Args:
+        changes: 变更集 {表名: [(操作, 旧值, 新值)]}
+
+    Returns:
+        tuple: (行数, 单元格数)
+    """
+    rows = 0
+    cells = 0
+    for table_changes in changes.values():
+        for change in table_changes:
+            rows += 1
+            if change[0] == 'insert':
+                cells += len([
+                    key for key, value in change[1].items()
+                    if value is not None and key.replace('__new', '') not in ('id',) + SYSTEM_COLUMNS
+                ])
+            elif change[0] == 'update':
+                cells += len([key for key in change[1] if key != 'id' and key not in SYSTEM_COLUMNS])
+    return rows, cells
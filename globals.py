@@ -77,3 +77,27 @@ DB_CHARSET = CONF_CONF.get(SYS_MODE, 'db_charset')  # 数据库字符集
 DB_PARAMS = dict(CONF_CONF[SYS_MODE].items())
 DB_PARAMS.update(dict(CONF_ADMIN[SYS_MODE].items()))
 
+# 数据库连接池参数（每个schema、自动提交模式各一个连接池）
+DB_POOL_SIZE = CONF_CONF.getint('SYS', 'db_pool_size', fallback=5)            # 连接池保持的连接数
+DB_MAX_OVERFLOW = CONF_CONF.getint('SYS', 'db_max_overflow', fallback=10)     # 连接池可临时超出的连接数
+DB_POOL_RECYCLE = CONF_CONF.getint('SYS', 'db_pool_recycle', fallback=1800)   # 连接的最长复用时间（秒）
+DB_POOL_TIMEOUT = CONF_CONF.getint('SYS', 'db_pool_timeout', fallback=30)     # 等待空闲连接的超时时间（秒）
+
+# ==================== 数据查询配置 ====================
+# 树形数据查询时并发查询的最大线程数（1表示逐表顺序查询）
+TREE_FETCH_WORKERS = CONF_CONF.getint('SYS', 'tree_fetch_workers', fallback=4)
+# 树形数据查询时每条IN查询最多包含的值个数
+TREE_FETCH_CHUNK_SIZE = CONF_CONF.getint('SYS', 'tree_fetch_chunk_size', fallback=1000)
+# 树形数据查询时的类型转换：infer（由pandas推断）或meta（按表结构中的data_type转换）
+TREE_DTYPES = CONF_CONF.get('SYS', 'tree_dtypes', fallback='infer')
+# 数据树查询结果缓存的最大条目数（0表示不缓存，默认）
+# 缓存只在当前进程内失效，多进程部署时其他进程写入的数据最多在存活时间之后才能读到
+TREE_QUERY_CACHE_SIZE = CONF_CONF.getint('SYS', 'tree_query_cache_size', fallback=0)
+# 数据树查询结果缓存的存活时间（秒）
+TREE_QUERY_CACHE_TTL = CONF_CONF.getint('SYS', 'tree_query_cache_ttl', fallback=60)
+# 批量写入时每批（每次executemany）的最大行数
+TREE_WRITE_BATCH_SIZE = CONF_CONF.getint('SYS', 'tree_write_batch_size', fallback=1000)
+# 提交预览令牌的最大保存个数（0表示不保存，每次提交都重新比较）
+TREE_PREVIEW_TOKEN_SIZE = CONF_CONF.getint('SYS', 'tree_preview_token_size', fallback=256)
+# 提交预览令牌的有效时间（秒）
+TREE_PREVIEW_TOKEN_TTL = CONF_CONF.getint('SYS', 'tree_preview_token_ttl', fallback=600)
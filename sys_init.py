@@ -7,11 +7,13 @@
 2. 表结构信息从Excel文件同步到数据库
 3. 动态生成表对象和SQLAlchemy模型
 4. 数据库表创建
+5. 表关系树缓存预热
 """
 
 import shutil
 import os
 import sys
+from contextlib import contextmanager
 from sqlalchemy import text
 
 # 设置Python路径，确保可以导入父目录的模块
@@ -29,6 +31,8 @@ from mint.helper_function.hf_string import to_json_str, list_to_attr_code
 from mint.helper_function.wrappers import sub_wrapper
 from mint.meta.table_objs import get_tables_from_info
 from mint.meta import models
+from mint.db.tree import Tree, get_right_angle_trees_from_tree
+from mint.db.tree_index import get_schema_index, save_schema_index
 
 
 def get_schema(schema_tag):
@@ -61,6 +65,8 @@ def get_con(schema_tag=None, auto_commit=True):
 def get_engine(schema_tag=None, auto_commit=True):
     """
     获取数据库引擎对象
+
+    引擎由进程内的引擎注册表共用，不能dispose。
     
     Args:
         schema_tag (str, optional): schema标签，默认为None
@@ -69,7 +75,29 @@ def get_engine(schema_tag=None, auto_commit=True):
     Returns:
         Engine: 数据库引擎对象
     """
-    return get_engine_con_url(schema_tag=schema_tag, auto_commit=auto_commit)[0]
+    return db_get_engine(
+        **DB_PARAMS,
+        schema=_get_schema_name(schema_tag),
+        auto_commit=auto_commit
+    )
+
+
+@contextmanager
+def connect(schema_tag=None, auto_commit=True):
+    """
+    从连接池取出一个数据库连接，退出时归还（未提交的事务回滚）
+
+    使用连接的代码都应通过该函数取出连接，出现异常时连接也会归还连接池。
+
+    Args:
+        schema_tag (str, optional): schema标签，默认为None
+        auto_commit (bool): 是否自动提交，默认为True
+
+    Yields:
+        Connection: 数据库连接对象
+    """
+    with get_engine(schema_tag=schema_tag, auto_commit=auto_commit).connect() as con:
+        yield con
 
 
 def get_fg_data_con():
@@ -85,11 +113,16 @@ def get_fg_data_con():
     password = DB_PARAMS['db_fg_password']
     schema = 'soams_dxm'
     charset = DB_PARAMS['db_fg_charset']
-    url = str(
-        f'mysql+pymysql://{username}:{password}@{host}:{port}/'
-        f'{schema}?charset={charset}&autocommit=true'
+    engine = db_get_engine(
+        db_type='mysql+pymysql',
+        db_username=username,
+        db_password=password,
+        db_host=host,
+        db_port=port,
+        schema=schema,
+        db_charset=charset,
+        auto_commit=True
     )
-    engine = create_engine(url=url)
     con = engine.connect()
     return con
 
@@ -105,18 +138,17 @@ def get_engine_con_url(schema_tag=None, auto_commit=True):
     Returns:
         tuple: (engine, connection, url) 元组
     """
+    return db_connect_db(
+        **DB_PARAMS,
+        schema=_get_schema_name(schema_tag),
+        auto_commit=auto_commit
+    )
+
+
+def _get_schema_name(schema_tag=None):
     if schema_tag is None:
-        return db_connect_db(
-            **DB_PARAMS,
-            schema='',
-            auto_commit=auto_commit
-        )
-    else:
-        return db_connect_db(
-            **DB_PARAMS,
-            schema=get_schema(schema_tag=schema_tag),
-            auto_commit=auto_commit
-        )
+        return ''
+    return get_schema(schema_tag=schema_tag)
 
 
 def get_schema_tags():
@@ -126,10 +158,8 @@ def get_schema_tags():
     Returns:
         list: schema标签列表
     """
-    con_core = get_con('core')
-    schema_tags = db_get_schema_tags(con=con_core)
-    con_core.close()
-    return schema_tags
+    with connect('core') as con_core:
+        return db_get_schema_tags(con=con_core)
 
 
 def refresh_table_info_to_db():
@@ -300,7 +330,6 @@ def create_tables():
     如果schema不存在，会自动创建schema。
     """
     engine, con, url = get_engine_con_url('data')
-    engine = create_engine(url)
     print("creating tables")
     while True:
         try:
@@ -318,6 +347,34 @@ def create_tables():
     print("tables created")
     con.close()
 
+def warmup_tree_cache(tables=None):
+    """
+    预热表关系树缓存
+
+    为每张表编译录入顺序、祖先/后代闭包、树的JSON表示和直角树列表，
+    并写入快照目录，新启动的进程按元数据版本直接加载。
+
+    Args:
+        tables: 表对象字典，为None时使用data库的表
+
+    Returns:
+        str: 缓存文件路径
+    """
+    if tables is None:
+        tables = get_tables('data')
+    index = get_schema_index(tables)
+    print("warming up tree cache")
+    for root in tables.keys():
+        tree = Tree(con=None, tables=tables, root=root, schema_index=index)
+        tree.get_node_names()
+        tree.json_obj
+        for t in get_right_angle_trees_from_tree(tree):
+            t.json_obj
+    path = save_schema_index(index)
+    print(f"tree cache saved: {path}")
+    return path
+
+
 # 模块执行时的初始化逻辑
 print(__name__)
 if __name__ == 'api.py':
@@ -329,5 +386,11 @@ if __name__ == 'api.py':
 
 # 获取数据表对象并打印主机名
 TABLES = get_tables('data')
+# 加载（或编译）表关系索引，已预热时直接读取快照目录中的缓存
+get_schema_index(TABLES)
 print(f'host name: {HOST_NAME}')
 
+
+if __name__ == '__main__':
+    # 部署后执行 python sys_init.py 预热表关系树缓存
+    warmup_tree_cache(TABLES)